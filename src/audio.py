@@ -1,5 +1,9 @@
 import ffmpeg
+from decode import DecodedAudio
 from filters import TimeSegment
+from speech import SpeechMap, clip_to_speech
+from typing import NamedTuple, Optional
+import bisect, mmap, os, profiling, shutil, struct, subprocess, tempfile
 
 # def extract_audio(input_file: str, output_file: str):
 #   """Extracts the audio component of the input file at the sample rate required by Whisper."""
@@ -9,21 +13,371 @@ from filters import TimeSegment
 #   # stream = ffmpeg.overwrite_output(stream)
 #   ffmpeg.run(stream)
 
-def filter_audio(input_file: str, output_file: str, time_segments_to_mute: list[TimeSegment], padding: tuple[int,int]):
-  """Filters the given input file to mute the audio during the provided list of time segments."""
-  print("Applying filters")
-  stream = ffmpeg.input(input_file)
-  video = stream.video
-  audio = stream.audio
+def filter_audio(input_file: str, output_file: str, time_segments_to_mute: list[TimeSegment], padding: tuple[int,int],
+                 decoded_audio: Optional[DecodedAudio] = None, smart_render: bool = False, subtitles_script: Optional[str] = None,
+                 speech_map: Optional[SpeechMap] = None):
+  """
+  Filters the given input file to mute the audio during the provided list of time segments.
+  If the input's audio has already been decoded, the decoded copy is used instead of decoding the input's audio again.
+  If smart_render is set, only the audio around muted segments is re-encoded, and the rest is copied unchanged.
+  If a SubStation Alpha subtitles script is given, it is added as a subtitle track in the same pass.
+  If the input's speech map is given, muting is limited to speech, so padding doesn't mute music or other sounds around it.
+  """
+  with profiling.stage("filter_audio", file=input_file, smart_render=smart_render):
+    print("Applying filters")
+    is_wav_output = os.path.splitext(output_file)[1].lower() == ".wav" and subtitles_script is None
+    wav_format = _read_wav_format(input_file) if is_wav_output else None
+    if wav_format is not None:
+      # Uncompressed audio can be muted by overwriting samples, without decoding or encoding anything
+      if not os.path.exists(output_file) or not os.path.samefile(input_file, output_file):
+        shutil.copyfile(input_file, output_file)
+      count = mute_wav_in_place(output_file, plan_mute_segments(time_segments_to_mute, padding, speech_map), wav_format)
+      print(f"Muted {count} samples in place")
+      print(f"Saved filtered audio/video file to '{output_file}'")
+      return
+    if os.path.exists(output_file) and os.path.samefile(input_file, output_file):
+      raise ValueError("Only uncompressed WAV files can be filtered in place")
 
+    mute_segments = plan_mute_segments(time_segments_to_mute, padding, speech_map)
+    if smart_render:
+      try:
+        _smart_render(input_file, output_file, mute_segments, subtitles_script)
+        print(f"Saved filtered audio/video file to '{output_file}'")
+        return
+      except (ffmpeg.Error, OSError, ValueError) as e:
+        print(f"Couldn't re-encode just the muted audio ({e}), re-encoding all of it instead")
+        if os.path.exists(output_file):
+          os.remove(output_file)
+
+    stream = ffmpeg.input(input_file)
+    video = stream.video
+    audio = stream.audio
+    if decoded_audio is not None and decoded_audio.is_decoded:
+      audio = ffmpeg.input(decoded_audio.path, itsoffset=decoded_audio.start_time).audio
+
+    if len(mute_segments) > 0:
+      # A single volume node whose enable expression is a balanced search over the merged segments,
+      # so each audio frame costs O(log n) comparisons no matter how many words were filtered.
+      audio = ffmpeg.filter(audio, 'volume', volume=0, enable=_build_mute_expression(mute_segments))
+
+    _run_output(video, audio, output_file, subtitles_script, vcodec="copy", loglevel="warning")
+    print(f"Saved filtered audio/video file to '{output_file}'")
+
+def _run_output(video, audio, output_file: str, subtitles_script: Optional[str], **kwargs):
+  """Runs ffmpeg to write the given video and audio streams to a file, along with a subtitles script piped to ffmpeg if one is given."""
+  if subtitles_script is None:
+    stream = ffmpeg.output(video, audio, output_file, **kwargs)
+    # stream = ffmpeg.overwrite_output(stream)
+    _run_with_filter_script(stream)
+    return
+  subtitles = ffmpeg.input('pipe:', f='ass')
+  stream = ffmpeg.output(video, audio, subtitles, output_file, scodec="copy", **kwargs)
+  _run_with_filter_script(stream, input=subtitles_script.encode())
+
+def _run_with_filter_script(stream, input: Optional[bytes] = None):
+  """
+  Runs an ffmpeg graph like ffmpeg.run, but passes its filter graph to ffmpeg in a file rather than on the command line,
+  which has a length limit that the mute expressions of thousands of segments easily exceed.
+  """
+  args = ffmpeg.get_args(stream)
+  with tempfile.TemporaryDirectory() as temp_dir:
+    if "-filter_complex" in args:
+      i = args.index("-filter_complex")
+      script_file = os.path.join(temp_dir, "filter_graph.txt")
+      with open(script_file, "w") as file:
+        file.write(args[i + 1])
+      args = args[:i] + ["-filter_complex_script", script_file] + args[i + 2:]
+    process = subprocess.Popen(["ffmpeg"] + args, stdin=subprocess.PIPE if input is not None else None)
+    process.communicate(input)
+    if process.returncode != 0:
+      raise ffmpeg.Error('ffmpeg', None, None)
+
+def plan_mute_segments(time_segments: list[TimeSegment], padding: tuple[int,int], speech_map: Optional[SpeechMap] = None) -> list[TimeSegment]:
+  """
+  Applies padding to a list of time segments, then sorts them and merges any that overlap or touch.
+  If a speech map is given, the merged segments are then clipped to its speech regions, and any parts outside of speech are dropped.
+  """
   start_padding, end_padding = padding
-  for s in time_segments_to_mute:
-    padded_start = s.start - (start_padding / 1000.0)
-    padded_end = s.end + (end_padding / 1000.0)
-    audio = ffmpeg.filter(audio, 'volume', volume=0,
-                          enable=f"between(t,{padded_start:.3f},{padded_end:.3f})")
-  
-  stream = ffmpeg.output(video, audio, output_file, vcodec="copy", loglevel="warning")
-  # stream = ffmpeg.overwrite_output(stream)
-  ffmpeg.run(stream)
-  print(f"Saved filtered audio/video file to '{output_file}'")
+  padded = sorted(
+    (TimeSegment(max(s.start - (start_padding / 1000.0), 0.0), s.end + (end_padding / 1000.0)) for s in time_segments),
+    key=lambda s: s.start
+  )
+  merged: list[TimeSegment] = []
+  for s in padded:
+    if s.end <= s.start:
+      continue
+    if len(merged) > 0 and s.start <= merged[-1].end:
+      merged[-1].end = max(merged[-1].end, s.end)
+    else:
+      merged.append(s)
+  if speech_map is not None:
+    merged = [TimeSegment(start, end) for s in merged for start, end in clip_to_speech(speech_map, s.start, s.end)]
+  return merged
+
+def _smart_render(input_file: str, output_file: str, mute_segments: list[TimeSegment], subtitles_script: Optional[str] = None):
+  """
+  Mutes the given sorted, non-overlapping segments while re-encoding as little audio as possible. The audio is split into
+  pieces at packet boundaries, so every packet ends up in exactly one piece. The pieces around muted segments (plus a margin)
+  are decoded, muted and encoded again with the same codec, the others are kept unchanged, and all of them are joined with
+  ffmpeg's concat demuxer. Raises ValueError if the result doesn't line up with the input.
+  """
+  if len(mute_segments) == 0:
+    # Nothing to mute, so all of the audio can be copied
+    stream = ffmpeg.input(input_file)
+    _run_output(stream.video, stream["a:0"], output_file, subtitles_script, vcodec="copy", acodec="copy", loglevel="warning")
+    print("Copied the audio, since nothing had to be muted")
+    return
+
+  with tempfile.TemporaryDirectory() as temp_dir:
+    # NUT keeps exact timestamps for any codec, unlike Matroska's millisecond timestamps
+    audio_file = os.path.join(temp_dir, "audio.nut")
+    ffmpeg.run(ffmpeg.output(ffmpeg.input(input_file)["a:0"], audio_file, acodec="copy", loglevel="error"))
+    audio_info, packets = _probe_packets(audio_file)
+    # Muxers shift negative timestamps (e.g., an encoder's priming packets) to zero, so shift the segments to match
+    shift = packets[0][0] - _probe_packets(input_file, first_only=True)[1][0][0]
+    mute_segments = [TimeSegment(s.start + shift, s.end + shift) for s in mute_segments]
+    spans = _plan_render_spans(packets, mute_segments)
+    if len(spans) == 0:
+      raise ValueError("the muted segments are outside of the audio")
+
+    cuts = sorted({i for span in spans for i in span if 0 < i < len(packets)})
+    pieces = _split_at_packets(audio_file, packets, cuts, os.path.join(temp_dir, "piece"))
+    span_starts = {first for first, _ in spans}
+    parts = []
+    for i, (first, end) in enumerate(zip([0] + cuts, cuts + [len(packets)])):
+      path = pieces[i]
+      if first in span_starts:
+        offset = packets[first][0]
+        muted = [TimeSegment(s.start - offset, s.end - offset) for s in mute_segments if s.start < packets[end - 1][1] and s.end > offset]
+        path = _render_span(path, end - first, muted, audio_info, os.path.join(temp_dir, f"span{i}"))
+      parts.append(_concat_entry(path, packets[end - 1][1] - packets[first][0]))
+
+    list_file = os.path.join(temp_dir, "parts.txt")
+    with open(list_file, "w") as file:
+      file.write("\n".join(parts) + "\n")
+    audio = ffmpeg.input(list_file, f="concat", safe=0, itsoffset=-shift).audio
+    video = ffmpeg.input(input_file).video
+    _run_output(video, audio, output_file, subtitles_script, vcodec="copy", acodec="copy", loglevel="warning")
+
+  # ffmpeg doesn't fail on timestamp problems, so check that the audio still has the input's length
+  expected = _get_audio_duration(input_file)
+  duration = _get_audio_duration(output_file)
+  if expected is not None and (duration is None or abs(duration - expected) > max(end - start for start, end in packets)):
+    raise ValueError(f"the muted audio is {duration} seconds long instead of {expected:.3f}")
+  print(f"Re-encoded {sum(packets[end - 1][1] - packets[first][0] for first, end in spans):.1f} seconds of audio around " +
+        f"{len(mute_segments)} muted segments")
+
+# Packets decoded before and after each muted segment, so the encoder's priming and overlap don't reach copied audio
+_RENDER_MARGIN_PACKETS = 2
+
+def _probe_packets(path: str, first_only: bool = False) -> tuple[dict, list[tuple[float, float]]]:
+  """Returns the first audio stream of a file and the start and end times of its packets (or just the first one), in order."""
+  kwargs = dict(read_intervals="%+#1") if first_only else {}
+  probe = ffmpeg.probe(path, select_streams="a:0", show_packets=None, show_entries="packet=pts_time,duration_time", **kwargs)
+  packets = _get_packet_times(probe.get("packets", []))
+  if len(probe["streams"]) == 0 or len(packets) == 0:
+    raise ValueError("no audio stream")
+  return probe["streams"][0], packets[:1] if first_only else packets
+
+def _get_packet_times(packets: list[dict]) -> list[tuple[float, float]]:
+  """Returns the start and end times of the audio packets in an ffprobe packet list, in order."""
+  times = []
+  for packet in packets:
+    if packet.get("pts_time", "N/A") == "N/A" or packet.get("duration_time", "N/A") == "N/A":
+      raise ValueError("audio packets have no timestamps")
+    start = float(packet["pts_time"])
+    times.append((start, start + float(packet["duration_time"])))
+  times.sort()
+  return times
+
+def _plan_render_spans(packets: list[tuple[float, float]], mute_segments: list[TimeSegment]) -> list[tuple[int, int]]:
+  """
+  Finds the packets to re-encode: the ones each muted segment covers plus a margin. Returns ranges of packet indices
+  (the end is exclusive), merging ranges that overlap or touch.
+  """
+  starts = [start for start, _ in packets]
+  spans: list[tuple[int, int]] = []
+  for s in mute_segments:
+    first = max(bisect.bisect_right(starts, s.start) - 1 - _RENDER_MARGIN_PACKETS, 0)
+    end = min(bisect.bisect_left(starts, s.end) + _RENDER_MARGIN_PACKETS, len(packets))
+    if end <= first:
+      continue
+    if len(spans) > 0 and first <= spans[-1][1]:
+      spans[-1] = (spans[-1][0], max(spans[-1][1], end))
+    else:
+      spans.append((first, end))
+  return spans
+
+# The most cuts to pass to a single ffmpeg run, since they all go in one command line argument
+_MAX_SPLIT_CUTS = 500
+
+def _split_at_packets(path: str, packets: list[tuple[float, float]], cuts: list[int], prefix: str) -> list[str]:
+  """
+  Splits an audio file, without re-encoding, into pieces that start at the packets with the given indices. Every packet ends
+  up in exactly one piece, and each piece's timestamps start at zero. Returns the paths of the pieces, in order.
+  """
+  if len(cuts) == 0:
+    return [path]
+  if len(cuts) > _MAX_SPLIT_CUTS:
+    # Split at every few cuts first, then split each of those pieces at the cuts inside it
+    coarse_cuts = cuts[::len(cuts) // _MAX_SPLIT_CUTS + 1]
+    bounds = [0] + coarse_cuts + [len(packets)]
+    pieces = []
+    for i, piece in enumerate(_split_at_packets(path, packets, coarse_cuts, f"{prefix}c")):
+      first, end = bounds[i], bounds[i + 1]
+      offset = packets[first][0]
+      piece_packets = [(start - offset, end_time - offset) for start, end_time in packets[first:end]]
+      pieces += _split_at_packets(piece, piece_packets, [c - first for c in cuts if first < c < end], f"{prefix}{i}-")
+    return pieces
+  # The segment muxer starts a new piece at the first packet at or after each time, so cut a little before the packet
+  times = ",".join(f"{packets[i][0] - (packets[i][1] - packets[i][0]) / 4:.6f}" for i in cuts)
+  pattern = f"{prefix}%d{os.path.splitext(path)[1]}"
+  ffmpeg.run(ffmpeg.output(ffmpeg.input(path).audio, pattern, acodec="copy", f="segment", segment_times=times, reset_timestamps=1,
+                           loglevel="error"))
+  pieces = [pattern % i for i in range(len(cuts) + 1)]
+  if not all(os.path.exists(p) for p in pieces):
+    raise ValueError("couldn't split the audio at packet boundaries")
+  return pieces
+
+def _render_span(piece: str, packet_count: int, muted: list[TimeSegment], audio_info: dict, prefix: str) -> str:
+  """
+  Decodes a piece of audio, mutes the given segments of it and encodes it again with its original codec. Encoders add
+  priming packets before the audio, so only the last packets are kept, as many as the piece had. Returns their path.
+  """
+  encoded_file = f"{prefix}.nut"
+  audio = ffmpeg.filter(ffmpeg.input(piece).audio, 'volume', volume=0, enable=_build_mute_expression(muted))
+  encode_args = dict(acodec=audio_info["codec_name"], ar=audio_info["sample_rate"], ac=audio_info["channels"])
+  if "bit_rate" in audio_info:
+    encode_args["audio_bitrate"] = audio_info["bit_rate"]
+  _run_with_filter_script(ffmpeg.output(audio, encoded_file, loglevel="error", **encode_args))
+
+  _, encoded_packets = _probe_packets(encoded_file)
+  priming = len(encoded_packets) - packet_count
+  if priming < 0:
+    raise ValueError("the re-encoded audio is shorter than the original")
+  if priming == 0:
+    return encoded_file
+  return _split_at_packets(encoded_file, encoded_packets, [priming], f"{prefix}-")[1]
+
+def _concat_entry(path: str, duration: float) -> str:
+  """Creates an entry of a concat demuxer file list. The duration is given so the next file starts exactly where this one ends."""
+  return "\n".join(["file '" + path.replace("'", "'\\''") + "'", f"duration {duration:.6f}"])
+
+def _get_audio_duration(path: str) -> Optional[float]:
+  """Gets the duration of the first audio stream of a file, or of the whole file if the stream doesn't have one."""
+  probe = ffmpeg.probe(path, select_streams="a:0")
+  if len(probe["streams"]) == 0:
+    return None
+  duration = probe["streams"][0].get("duration", probe["format"].get("duration"))
+  return float(duration) if duration not in (None, "N/A") else None
+
+def _build_mute_expression(segments: list[TimeSegment]) -> str:
+  """
+  Builds an ffmpeg expression that is non-zero while t is inside any of the given sorted, non-overlapping segments.
+  The expression is a balanced binary search tree, so its evaluation depth is logarithmic in the number of segments.
+  """
+  if len(segments) == 1:
+    s = segments[0]
+    return f"between(t,{s.start:.3f},{s.end:.3f})"
+  mid = len(segments) // 2
+  left = _build_mute_expression(segments[:mid])
+  right = _build_mute_expression(segments[mid:])
+  return f"if(lt(t,{segments[mid].start:.3f}),{left},{right})"
+
+class WavFormat(NamedTuple):
+  sample_rate: int
+  block_align: int # Bytes per sample frame, across all channels
+  silence: bytes # The value of one silent byte
+  data_offset: int # Offset of the first sample in the file
+  data_size: int
+
+_MUTE_BLOCK_SIZE = 1 << 20
+_WAVE_FORMAT_PCM = 1
+_WAVE_FORMAT_IEEE_FLOAT = 3
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+def can_mute_in_place(path: str) -> bool:
+  """Returns whether a file is an uncompressed WAV file, whose samples mute_wav_in_place can overwrite."""
+  return _read_wav_format(path) is not None
+
+def _read_wav_format(path: str) -> Optional[WavFormat]:
+  """
+  Reads the sample layout of an uncompressed PCM or floating point WAV file, including RF64 files (WAV files larger than
+  4 GB, whose sizes are in a ds64 chunk). Returns None for anything else.
+  """
+  try:
+    with open(path, "rb") as file:
+      header = file.read(12)
+      if len(header) < 12 or header[:4] not in (b"RIFF", b"RF64", b"BW64") or header[8:12] != b"WAVE":
+        return None
+      file_size = os.fstat(file.fileno()).st_size
+      fmt = None
+      ds64_data_size = None
+      while True:
+        chunk = file.read(8)
+        if len(chunk) < 8:
+          return None
+        chunk_id, chunk_size = struct.unpack("<4sI", chunk)
+        if chunk_id == b"fmt ":
+          fmt = file.read(chunk_size)
+        elif chunk_id == b"ds64":
+          ds64 = file.read(chunk_size)
+          if len(ds64) < 16:
+            return None
+          ds64_data_size = struct.unpack_from("<Q", ds64, 8)[0]
+        elif chunk_id == b"data":
+          break
+        else:
+          file.seek(chunk_size, os.SEEK_CUR)
+        if chunk_size % 2 == 1:
+          file.seek(1, os.SEEK_CUR) # Chunks are padded to an even size
+      data_offset = file.tell()
+  except OSError:
+    return None
+
+  if fmt is None or len(fmt) < 16:
+    return None
+  format_tag, _, sample_rate, _, block_align, bits_per_sample = struct.unpack_from("<HHIIHH", fmt)
+  if format_tag == _WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+    format_tag = struct.unpack_from("<H", fmt, 24)[0] # First two bytes of the sub-format GUID
+  if format_tag not in (_WAVE_FORMAT_PCM, _WAVE_FORMAT_IEEE_FLOAT) or block_align == 0:
+    return None
+  # 8-bit PCM is unsigned, so silence is the midpoint; every other format is silent at zero
+  silence = b"\x80" if format_tag == _WAVE_FORMAT_PCM and bits_per_sample == 8 else b"\x00"
+  data_size = file_size - data_offset
+  if chunk_size == 0xFFFFFFFF and ds64_data_size is not None:
+    data_size = min(ds64_data_size, data_size)
+  elif chunk_size not in (0, 0xFFFFFFFF):
+    # Streamed WAV files have a placeholder data size (0 or the largest size), which means the data runs to the end of the file
+    data_size = min(chunk_size, data_size)
+  return WavFormat(sample_rate, block_align, silence, data_offset, data_size - data_size % block_align)
+
+def mute_wav_in_place(path: str, segments: list[TimeSegment], wav_format: Optional[WavFormat] = None) -> int:
+  """
+  Silences the given time segments of an uncompressed WAV file by overwriting its samples through a memory map.
+  Only the pages that hold muted samples are read or written, so the time taken depends on how much audio is muted,
+  not on the length of the file. Returns the number of sample frames that were muted.
+  """
+  if wav_format is None:
+    wav_format = _read_wav_format(path)
+    if wav_format is None:
+      raise ValueError(f"'{path}' is not an uncompressed WAV file")
+  frame_count = wav_format.data_size // wav_format.block_align
+  ranges = [(max(int(s.start * wav_format.sample_rate), 0), min(int(s.end * wav_format.sample_rate), frame_count)) for s in segments]
+  ranges = [(start, end) for start, end in ranges if start < end]
+  if len(ranges) == 0:
+    return 0
+
+  muted = 0
+  with open(path, "r+b") as file, mmap.mmap(file.fileno(), 0) as mapped:
+    for start, end in ranges:
+      offset = wav_format.data_offset + start * wav_format.block_align
+      size = (end - start) * wav_format.block_align
+      # Write in blocks, so muting a long stretch doesn't need a buffer of silence as large as the stretch
+      silence = wav_format.silence * min(size, _MUTE_BLOCK_SIZE)
+      for block_offset in range(offset, offset + size, len(silence)):
+        block_size = min(len(silence), offset + size - block_offset)
+        mapped[block_offset:block_offset + block_size] = silence[:block_size]
+      muted += end - start
+    mapped.flush()
+  return muted
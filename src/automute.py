@@ -1,15 +1,16 @@
-import argparse, pathlib
-from cli import confirm
+import argparse, glob, os, pathlib, tempfile
+from cli import confirm, parse_padding
+import profiling
 
 def _parse_arguments() -> argparse.Namespace:
   parser = argparse.ArgumentParser(
     prog='automute',
     description='A command-line tool for automatically muting specific words from audio and video files.'
   )
-  parser.add_argument('input',
-                      help='Audio or video file to apply filters to.')
+  parser.add_argument('input', nargs='+',
+                      help='Audio or video file to apply filters to. Can also be several files, directories or glob patterns to filter a batch of files.')
   parser.add_argument('-o', '--output',
-                      help='Name of the output file. (Default: <input file>-filtered.<extension>)')
+                      help='Name of the output file. Only allowed with a single input file. (Default: <input file>-filtered.<extension>)')
   parser.add_argument('-w', '--filter-word', default=[], action='append',
                       help='A word to filter out. Treated as a case-insensitive regular expression. Can be specified multiple times.')
   parser.add_argument('-f', '--filter-file', default=[], action='append',
@@ -18,75 +19,205 @@ def _parse_arguments() -> argparse.Namespace:
                       help='Before applying filters, enchiper transcribed words by replacing each letter with the one immediately after it in the alphabet ' +
                            '(looping around at the end; i.e., caesar cipher with a shift of 1). Use this if you need to filter out profanity but would prefer ' +
                            'not to read profanity when specifying your filters.')
-  parser.add_argument('-p', '--padding', default=(0,0), type=_parse_padding, 
+  parser.add_argument('-p', '--padding', default=(0,0), type=parse_padding, 
                       help='Padding in milliseconds to apply around filtered audio segments. Can be specified as a single integer or as two integers separated ' +
                            'by a comma to specify the start and end padding separately. (Default: 0)')
+  parser.add_argument('--in-place', default=False, action='store_true',
+                      help='Mute the input files themselves instead of writing filtered copies. Only supported for uncompressed WAV files, which are ' +
+                           'muted by overwriting just the affected samples.')
+  parser.add_argument('--smart-render', default=False, action='store_true',
+                      help='Only re-encode the audio around muted segments and copy the rest of the audio unchanged. Much faster when few words are ' +
+                           'muted, and avoids any loss of quality in the unmuted audio.')
   parser.add_argument('--whisper-model', default='small.en',
                       help='The faster_whisper model to use for audio transcription. Can be a model name (tiny, tiny.en, base, base.en, small, small.en, ' +
                            'distil-small.en, medium, medium.en, distil-medium.en, large, large-v1, large-v2, distil-large-v2, large-v3, or distil-large-v3), ' +
                            'a CTranslate2-converted model ID from Hugging Face, or a path to a local model. See faster-whisper docs. (Default: small.en)')
+  parser.add_argument('--coarse-model',
+                      help='Transcribe the whole input with this fast model first (e.g., tiny.en), and only transcribe the audio around possible ' +
+                           'matches with --whisper-model. Much faster for long inputs with few matches, at a small cost in accuracy.')
+  parser.add_argument('--coarse-context', default=2.0, type=float,
+                      help='Seconds of audio around each possible match from --coarse-model to transcribe again. (Default: 2)')
   parser.add_argument('--whisper-compute-type', default='auto', choices=['default','auto','int8','int8_float16','int8_bfloat16','int8_float32','int16','float16','bfloat16','float32'],
                       help='The compute type to use when loading the Whisper model. \'default\' explicitly uses the same quantization that the model is already using. ' + 
                            '\'auto\' selects the fasted option that is supported by the device used. (Default: auto)')
   parser.add_argument('--whisper-device', default='auto', choices=['auto','cpu','cuda'],
                       help='The compute device to use when running the Whisper model. (Default: auto)')
-  # parser.add_argument('--whisper-silence-ms', default=-1, type=int,
-  #                     help='The minimum duration in milliseconds for an audio segment with no detected speech to be skipped during transcription. -1 to disable. ' +
-  #                          '(Default: -1)')
+  parser.add_argument('--whisper-threads', type=int,
+                      help='The number of CPU threads the Whisper model uses. Ignored with --whisper-processes other than 1, which divides the cores ' +
+                           'between the processes. (Default: 8, or the tuned number with --auto-tune)')
+  parser.add_argument('--auto-tune', default=False, action='store_true',
+                      help='Choose the number of threads, the number of transcribe workers and the compute type that transcribe fastest on this ' +
+                           'machine, by timing them on a short sample of the input. The choice is stored per host and model in the cache directory ' +
+                           'and reused by later runs. Settings that are specified (--whisper-threads, --transcribe-workers, or a --whisper-compute-type ' +
+                           'other than auto) are kept. Since the compute type changes the transcription, it is part of the cache key.')
+  parser.add_argument('--retune', default=False, action='store_true',
+                      help='Like --auto-tune, but time the settings again even if a choice is already stored (e.g., after a hardware change).')
+  parser.add_argument('--whisper-processes', default=1, type=int,
+                      help='Split long inputs into chunks at silences and transcribe the chunks in this many processes. 0 picks a number based on ' +
+                           'the number of CPU cores. (Default: 1)')
+  parser.add_argument('--whisper-silence-ms', default=-1, type=int,
+                      help='The minimum duration in milliseconds for an audio segment with no detected speech to be skipped during transcription. -1 to disable. ' +
+                           'The speech found in each input is cached and reused when other settings change, and matches outside of speech aren\'t muted. ' +
+                           '(Default: -1)')
+  parser.add_argument('--transcribe-workers', type=int,
+                      help='The number of files to transcribe concurrently when filtering a batch of files. (Default: 1, or the tuned number with --auto-tune)')
+  parser.add_argument('--ffmpeg-workers', default=2, type=int,
+                      help='The number of ffmpeg processes to run concurrently when filtering a batch of files. (Default: 2)')
   parser.add_argument('--ignore-cached-transcriptions', default=False, action='store_true',
                       help='Ignore any cached transcriptions.')
+  parser.add_argument('--incremental', default=False, action='store_true',
+                      help='Split the audio into chunks at silences and cache the transcription of each chunk separately, so that when an edited ' +
+                           'version of a file is transcribed, only the chunks whose audio changed are transcribed again.')
+  parser.add_argument('--cache-dir',
+                      help='Directory to store cached transcriptions in. Can be shared between machines to reuse each other\'s transcriptions. ' +
+                           '(Default: $AUTOMUTE_CACHE_DIR or .transcription_cache)')
+  parser.add_argument('--cache-max-size', type=float,
+                      help='Maximum size of the transcription cache in megabytes. The least recently used transcriptions are removed when it grows ' +
+                           'larger. (Default: $AUTOMUTE_CACHE_MAX_MB or unlimited)')
+  parser.add_argument('--profile',
+                      help='Record the time, CPU time, peak memory and bytes read of each stage of the run, and write them to this file as a ' +
+                           'Chrome trace (viewable in chrome://tracing or ui.perfetto.dev) with a per-stage summary.')
+  parser.add_argument('--profile-stage',
+                      help='Also profile this stage (e.g., transcription or filter_audio) with cProfile, and write the statistics to <profile file>.prof.')
+  parser.add_argument('--fast-input-hash', default=False, action='store_true',
+                      help='Identify input files in the transcription cache by a fast, non-cryptographic fingerprint instead of a SHA-1 hash.')
   return parser.parse_args()
 
-def _parse_padding(padding_str: str) -> tuple[int,int]:
-  """Parses a padding tuple from a string of one or two integers."""
-  values = [int(x) for x in padding_str.split(',')]
-  if len(values) == 1:
-    return (values[0], values[0])
-  elif len(values) == 2:
-    return (values[0], values[1])
-  else:
-    raise argparse.ArgumentTypeError(f"{padding_str} is not a valid padding value")
-
 def _get_output_file_path(input_file: str) -> str:
   """Creates an output file path from an input file path."""
   input_path = pathlib.Path(input_file)
   return str(input_path.with_stem(input_path.stem + "-filtered"))
 
+# Extensions of the audio and video files that are filtered when a directory is given as input
+_MEDIA_EXTENSIONS = {
+  ".aac", ".ac3", ".aif", ".aiff", ".alac", ".amr", ".ape", ".au", ".caf", ".dts", ".flac", ".m4a", ".m4b", ".mka", ".mp2",
+  ".mp3", ".oga", ".ogg", ".opus", ".ra", ".wav", ".weba", ".wma", ".wv",
+  ".3g2", ".3gp", ".asf", ".avi", ".divx", ".dv", ".f4v", ".flv", ".m2ts", ".m4v", ".mkv", ".mov", ".mp4", ".mpeg", ".mpg",
+  ".mts", ".mxf", ".nut", ".ogm", ".ogv", ".rm", ".rmvb", ".ts", ".vob", ".webm", ".wmv",
+}
+
+def _expand_input_paths(inputs: list[str]) -> list[str]:
+  """
+  Expands any directories or glob patterns in a list of input paths. Only audio and video files in directories are included
+  (by their extension), and files that were filtered before are skipped.
+  """
+  paths = []
+  for path in inputs:
+    if os.path.isdir(path):
+      paths += sorted(str(p) for p in pathlib.Path(path).iterdir()
+                      if p.is_file() and p.suffix.lower() in _MEDIA_EXTENSIONS and not p.stem.endswith("-filtered"))
+    elif glob.has_magic(path):
+      paths += sorted(glob.glob(path))
+    else:
+      paths.append(path)
+  return paths
+
 def main():
   args = _parse_arguments()
+  if args.profile is not None:
+    profiling.start(args.profile_stage)
+  try:
+    _main(args)
+  finally:
+    if args.profile is not None:
+      profiling.write(args.profile)
 
-  input_file = args.input
-  output_file = args.output if args.output is not None else _get_output_file_path(input_file)
+def _main(args: argparse.Namespace):
+  input_files = _expand_input_paths(args.input)
+  if len(input_files) == 0:
+    print("No input files found")
+    exit(1)
+  if args.output is not None and len(input_files) != 1:
+    print("An output file can only be specified for a single input file")
+    exit(1)
+  if args.in_place and (args.output is not None or any(os.path.splitext(f)[1].lower() != ".wav" for f in input_files)):
+    print("Only WAV input files can be filtered in place, and no output file can be specified")
+    exit(1)
+  if args.in_place:
+    from audio import can_mute_in_place
+    unsupported = [f for f in input_files if not can_mute_in_place(f)]
+    if len(unsupported) > 0:
+      print(f"Only uncompressed PCM or floating point WAV files can be filtered in place, which '{unsupported[0]}' is not")
+      exit(1)
   
   from filters import compile_filters, find_time_segments_to_filter
   
-  filters = compile_filters(args.filter_word, args.filter_file)
+  with profiling.stage("compile_filters"):
+    filters = compile_filters(args.filter_word, args.filter_file, args.encipher_words)
   if len(filters) == 0 and not confirm("No filters configured. Continue anyways?", default=True):
     exit(0)
     
-  from transcribe import transcribe, TranscribeOptions
+  from transcribe import transcribe, transcribe_two_pass, TranscribeOptions
   from audio import filter_audio
+  from decode import DecodedAudio
+  import transcription_cache
+
+  transcription_cache.configure(args.cache_dir, args.cache_max_size)
 
-  text_segments = transcribe(
-    input_file,
-    TranscribeOptions(
-      model=args.whisper_model,
-      device=args.whisper_device,
-      compute_type=args.whisper_compute_type,
-      condition_on_previous_text='distil' not in args.whisper_model, # Distil models seem prone to repeating themselves
-      # hotwords=[decipher(word) if args.encipher_words else word for f in filters for word in [f.pattern[2:-2]]],
-      # vad_filter=args.whisper_silence_ms >= 0,
-      # vad_parameters=dict(
-      #   min_silence_duration_ms=args.whisper_silence_ms
-      # ) if args.whisper_silence_ms >= 0 else dict()
-    ),
-    ignore_cache=args.ignore_cached_transcriptions,
+  options = TranscribeOptions(
+    model=args.whisper_model,
+    device=args.whisper_device,
+    compute_type=args.whisper_compute_type,
+    processes=args.whisper_processes,
+    incremental=args.incremental,
+    condition_on_previous_text='distil' not in args.whisper_model, # Distil models seem prone to repeating themselves
+    # hotwords=[decipher(word) if args.encipher_words else word for f in filters.patterns for word in [f[2:-2]]],
+    vad_options=dict(min_silence_duration_ms=args.whisper_silence_ms) if args.whisper_silence_ms >= 0 else None,
   )
+  if args.whisper_threads is not None:
+    options = options._replace(cpu_threads=args.whisper_threads)
+  transcribe_workers = args.transcribe_workers if args.transcribe_workers is not None else 1
+  if args.auto_tune or args.retune:
+    from tuning import tune_options
+    options = tune_options(
+      options,
+      input_files[0],
+      cpu_threads=args.whisper_threads,
+      # Workers only help when several files are transcribed at once
+      num_workers=args.transcribe_workers if len(input_files) > 1 else 1,
+      compute_type=args.whisper_compute_type if args.whisper_compute_type != 'auto' else None,
+      recalibrate=args.retune,
+    )
+    transcribe_workers = options.num_workers
 
-  filter_segments = find_time_segments_to_filter(text_segments, filters, args.encipher_words)
-  print(f"Found {len(filter_segments)} audio segments that match filters")
-  
-  filter_audio(input_file, output_file, filter_segments, args.padding)
+  if len(input_files) > 1:
+    from batch import filter_files
+    failures = filter_files(
+      input_files,
+      input_files if args.in_place else [_get_output_file_path(input_file) for input_file in input_files],
+      filters,
+      options,
+      args.padding,
+      ignore_cache=args.ignore_cached_transcriptions,
+      fast_hash=args.fast_input_hash,
+      transcribe_workers=transcribe_workers,
+      ffmpeg_workers=args.ffmpeg_workers,
+      smart_render=args.smart_render,
+      coarse_model=args.coarse_model,
+      coarse_context=args.coarse_context,
+    )
+    exit(1 if failures > 0 else 0)
+
+  input_file = input_files[0]
+  output_file = input_file if args.in_place else args.output if args.output is not None else _get_output_file_path(input_file)
+  with tempfile.TemporaryDirectory() as temp_dir:
+    # If the audio has to be transcribed, it is decoded once and reused for muting
+    decoded_audio = DecodedAudio(input_file, temp_dir)
+    speech_maps = []
+    if args.coarse_model is not None:
+      text_segments = transcribe_two_pass(input_file, options, args.coarse_model, filters, args.coarse_context,
+                                          ignore_cache=args.ignore_cached_transcriptions, fast_hash=args.fast_input_hash,
+                                          audio_loader=decoded_audio.get_model_audio, on_speech_map=speech_maps.append)
+    else:
+      text_segments = transcribe(input_file, options, ignore_cache=args.ignore_cached_transcriptions, fast_hash=args.fast_input_hash,
+                                 audio_loader=decoded_audio.get_model_audio, on_speech_map=speech_maps.append)
+
+    with profiling.stage("find_segments", file=input_file):
+      filter_segments = find_time_segments_to_filter(text_segments, filters)
+    print(f"Found {len(filter_segments)} audio segments that match filters")
+    
+    speech_map = speech_maps[-1] if len(speech_maps) > 0 else None
+    filter_audio(input_file, output_file, filter_segments, args.padding, decoded_audio, args.smart_render, speech_map=speech_map)
   print("Done")
 
 if __name__ == "__main__":
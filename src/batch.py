@@ -0,0 +1,101 @@
+from transcribe import transcribe, transcribe_two_pass, get_cache_key, load_model, TranscribeOptions
+from filters import FilterSet, TimeSegment, find_time_segments_to_filter
+from audio import filter_audio
+from decode import DecodedAudio
+from speech import SpeechMap
+from concurrent.futures import Future, ThreadPoolExecutor
+import ffmpeg
+import os, profiling, tempfile, threading, time
+from typing import TYPE_CHECKING, Callable, Optional
+
+if TYPE_CHECKING:
+  from faster_whisper import WhisperModel
+
+def filter_files(input_files: list[str], output_files: list[str], filters: FilterSet, options: TranscribeOptions, padding: tuple[int,int],
+                 ignore_cache: bool = False, fast_hash: bool = False, transcribe_workers: int = 1, ffmpeg_workers: int = 2,
+                 smart_render: bool = False, coarse_model: Optional[str] = None, coarse_context: float = 2.0) -> int:
+  """
+  Filters a batch of audio/video files, sharing a single Whisper model between them.
+  Hashing, transcription and muting run as a pipeline, so while one file is being transcribed, the previous one can be muted
+  and the next one can be hashed. If a coarse model is given, files are transcribed in two passes (see transcribe_two_pass).
+  Returns the number of files that failed.
+  """
+  def shared_model(model_options: TranscribeOptions) -> Callable[[], 'WhisperModel']:
+    """Creates a loader that loads a model the first time it is called, and returns the same model after that."""
+    model = None
+    model_lock = threading.Lock()
+    def get_model():
+      nonlocal model
+      with model_lock:
+        if model is None:
+          model = load_model(model_options)
+        return model
+    return get_model
+  get_model = shared_model(options._replace(num_workers=transcribe_workers))
+  get_coarse_model = shared_model(options._replace(model=coarse_model, num_workers=transcribe_workers)) if coarse_model is not None else None
+
+  def prepare(input_file: str) -> tuple[tuple[str, dict], Optional[float]]:
+    with profiling.stage("hash", file=input_file):
+      return get_cache_key(input_file, options, fast_hash), _get_duration(input_file)
+
+  def find_segments(input_file: str, prepared: Future, decoded_audio: DecodedAudio) -> tuple[list[TimeSegment], Optional[SpeechMap]]:
+    cache_key, _ = prepared.result()
+    speech_maps = []
+    if coarse_model is not None:
+      segments = transcribe_two_pass(input_file, options, coarse_model, filters, coarse_context, ignore_cache=ignore_cache,
+                                     fast_hash=fast_hash, model_loader=get_model, audio_loader=decoded_audio.get_model_audio,
+                                     coarse_model_loader=get_coarse_model, on_speech_map=speech_maps.append)
+    else:
+      segments = transcribe(input_file, options, ignore_cache=ignore_cache, fast_hash=fast_hash, cache_key=cache_key, model_loader=get_model,
+                            audio_loader=decoded_audio.get_model_audio, on_speech_map=speech_maps.append)
+    with profiling.stage("find_segments", file=input_file):
+      filter_segments = find_time_segments_to_filter(segments, filters)
+    print(f"Found {len(filter_segments)} audio segments that match filters in '{input_file}'")
+    return filter_segments, speech_maps[-1] if len(speech_maps) > 0 else None
+
+  def mute(input_file: str, output_file: str, found: Future, decoded_audio: DecodedAudio):
+    try:
+      filter_segments, speech_map = found.result()
+      filter_audio(input_file, output_file, filter_segments, padding, decoded_audio, smart_render, speech_map=speech_map)
+    finally:
+      decoded_audio.remove()
+
+  start_time = time.perf_counter()
+  with tempfile.TemporaryDirectory() as temp_dir, \
+       ThreadPoolExecutor(1) as hash_pool, \
+       ThreadPoolExecutor(transcribe_workers) as transcribe_pool, \
+       ThreadPoolExecutor(ffmpeg_workers) as ffmpeg_pool:
+    jobs = []
+    for i, (input_file, output_file) in enumerate(zip(input_files, output_files)):
+      # Audio that is decoded for transcription is reused by the muting pass
+      decoded_audio = DecodedAudio(input_file, os.path.join(temp_dir, str(i)))
+      prepared = hash_pool.submit(prepare, input_file)
+      found = transcribe_pool.submit(find_segments, input_file, prepared, decoded_audio)
+      jobs.append((input_file, prepared, ffmpeg_pool.submit(mute, input_file, output_file, found, decoded_audio)))
+
+    failures = 0
+    total_duration = 0.0
+    for input_file, prepared, muted in jobs:
+      try:
+        muted.result()
+        total_duration += prepared.result()[1] or 0.0
+      except Exception as e:
+        print(f"Failed to filter '{input_file}': {e}")
+        failures += 1
+  elapsed = time.perf_counter() - start_time
+  if options.processes != 1 or options.incremental:
+    # Chunked transcriptions share one pool of worker processes for the whole batch
+    import chunking
+    chunking.shutdown_pools()
+
+  print(f"Filtered {len(jobs) - failures} of {len(jobs)} files " +
+        f"({total_duration / 3600:.2f} hours of audio in {elapsed / 3600:.2f} hours, " +
+        f"{total_duration / elapsed if elapsed > 0 else 0:.1f} audio-hours per wall-hour)")
+  return failures
+
+def _get_duration(input_file: str) -> Optional[float]:
+  """Gets the duration of a media file in seconds, only for reporting throughput. Returns None if it can't be probed."""
+  try:
+    return float(ffmpeg.probe(input_file)["format"]["duration"])
+  except (ffmpeg.Error, OSError, KeyError, ValueError):
+    return None
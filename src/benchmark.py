@@ -0,0 +1,219 @@
+"""
+Benchmarks for the hot paths that don't need a Whisper model: filter compilation and matching, subtitle layout, the
+transcription cache, and the muting pass. Transcripts and wordlists are generated synthetically, so the benchmarks run
+offline and give the same inputs on every machine. Results are written as JSON so that runs can be compared.
+"""
+import argparse, json, os, platform, random, shutil, statistics, sys, tempfile, time, wave
+from collections.abc import Callable
+from transcript import Segment, Word
+
+def _parse_arguments() -> argparse.Namespace:
+  parser = argparse.ArgumentParser(
+    prog='benchmark',
+    description='Benchmarks filtering, subtitle layout, the transcription cache and muting on synthetic inputs, and writes the timings as JSON.'
+  )
+  parser.add_argument('-o', '--output',
+                      help='File to write the results to. (Default: stdout)')
+  parser.add_argument('-k', '--select', default=[], action='append',
+                      help='Only run benchmarks whose name contains this string. Can be specified multiple times.')
+  parser.add_argument('--repeat', default=5, type=int,
+                      help='Number of times to run each benchmark. (Default: 5)')
+  parser.add_argument('--quick', default=False, action='store_true',
+                      help='Use smaller inputs, for a quick check rather than a measurement.')
+  parser.add_argument('--seed', default=0, type=int,
+                      help='Seed for generating the synthetic inputs. (Default: 0)')
+  return parser.parse_args()
+
+# A few words that the generated wordlists always contain, so every transcript has matches
+_FILTERED_WORDS = ['darn', 'heck', 'frick', 'shoot']
+_FILTERED_WORD_RATE = 0.005
+_WORDS_PER_SECOND = 2.5
+
+def generate_transcript(hours: float, rng: random.Random) -> list[Segment]:
+  """Generates a transcript of the given length, with a varying number of words per segment and sentence punctuation."""
+  vocabulary = [_random_word(rng) for _ in range(5000)]
+  segments = []
+  position = 0.0
+  duration = hours * 3600
+  while position < duration:
+    words = []
+    for _ in range(rng.randint(1, 30)):
+      text = rng.choice(_FILTERED_WORDS) if rng.random() < _FILTERED_WORD_RATE else rng.choice(vocabulary)
+      if rng.random() < 0.1:
+        text += rng.choice('.,!?')
+      length = rng.uniform(0.5, 1.5) / _WORDS_PER_SECOND
+      words.append(Word(position, position + length, ' ' + text, rng.uniform(0.1, 1.0)))
+      position += length
+    segments.append(Segment(
+      id=len(segments) + 1,
+      seek=int(words[0].start * 100),
+      start=words[0].start,
+      end=words[-1].end,
+      text=''.join(w.word for w in words),
+      tokens=[rng.randrange(50000) for _ in words],
+      temperature=0.0,
+      avg_logprob=rng.uniform(-1.5, 0.0),
+      compression_ratio=rng.uniform(1.0, 2.5),
+      no_speech_prob=rng.uniform(0.0, 0.1),
+      words=words,
+    ))
+    position += rng.uniform(0.0, 2.0)
+  return segments
+
+def generate_wordlist(size: int, rng: random.Random) -> list[str]:
+  """Generates the lines of a filter file with the given number of entries, including a few phrases."""
+  words = _FILTERED_WORDS + [_random_word(rng) for _ in range(max(size - len(_FILTERED_WORDS) - 2, 0))]
+  return words[:max(size - 2, 0)] + ['what the heck', 'oh my gosh'][:size]
+
+def _random_word(rng: random.Random) -> str:
+  return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 10)))
+
+def _write_tone_video(path: str, seconds: float):
+  """Writes a video with a sine tone and a blank picture, for benchmarking the muting pass."""
+  import ffmpeg
+  audio = ffmpeg.input(f'sine=frequency=440:duration={seconds}', f='lavfi').audio
+  video = ffmpeg.input(f'color=size=64x64:rate=5:duration={seconds}', f='lavfi').video
+  ffmpeg.run(ffmpeg.output(video, audio, path, vcodec='mpeg4', acodec='aac', loglevel='error'), overwrite_output=True)
+
+def _write_tone_wav(path: str, seconds: float, sample_rate: int = 48000):
+  """Writes a 16-bit stereo WAV file with a sine tone, without needing ffmpeg."""
+  import numpy as np
+  samples = (np.sin(np.arange(int(seconds * sample_rate)) * (2 * np.pi * 440 / sample_rate)) * 16000).astype('<i2')
+  with wave.open(path, 'wb') as file:
+    file.setnchannels(2)
+    file.setsampwidth(2)
+    file.setframerate(sample_rate)
+    file.writeframes(np.repeat(samples, 2).tobytes())
+
+class _Runner:
+  """Times benchmarks and collects their results."""
+
+  def __init__(self, repeat: int, select: list[str]):
+    self.repeat = repeat
+    self.select = select
+    self.results = []
+
+  def wants(self, name: str) -> bool:
+    return len(self.select) == 0 or any(s in name for s in self.select)
+
+  def run(self, name: str, params: dict, function: Callable[[], object], setup: Callable[[], object] = None):
+    """Runs a benchmark several times. If a setup function is given, it runs before each repetition and isn't timed."""
+    if not self.wants(name):
+      return
+    times = []
+    for _ in range(self.repeat):
+      if setup is not None:
+        setup()
+      start = time.perf_counter()
+      function()
+      times.append(time.perf_counter() - start)
+    self.results.append(dict(name=name, params=params, min=min(times), median=statistics.median(times), repeat=len(times)))
+    print(f"{name} {json.dumps(params)}: {statistics.median(times) * 1000:.2f} ms", file=sys.stderr)
+
+  def skip(self, name: str, params: dict, reason: str):
+    if self.wants(name):
+      self.results.append(dict(name=name, params=params, skipped=reason))
+      print(f"{name} {json.dumps(params)}: skipped ({reason})", file=sys.stderr)
+
+def run_benchmarks(runner: _Runner, quick: bool, seed: int):
+  from audio import filter_audio, plan_mute_segments, _build_mute_expression
+  from filters import TimeSegment, compile_filters, filter_transcription, find_time_segments_to_filter
+  from subtitles import create_subtitles_script, layout_subtitles
+  import ffmpeg
+  import transcription_cache
+
+  rng = random.Random(seed)
+  hours_list = [1 / 60, 0.25] if quick else [1 / 6, 1, 10]
+  wordlist_sizes = [10, 1000] if quick else [10, 100, 1000, 10000]
+
+  with tempfile.TemporaryDirectory() as temp_dir:
+    # Filter compilation, from wordlist files like real runs
+    filter_sets = {}
+    for size in wordlist_sizes:
+      path = os.path.join(temp_dir, f'wordlist{size}.txt')
+      with open(path, 'w') as file:
+        file.write('\n'.join(generate_wordlist(size, rng)) + '\n')
+      runner.run('compile_filters', dict(wordlist=size), lambda: compile_filters([], [path]))
+      filter_sets[size] = compile_filters([], [path])
+
+    for hours in hours_list:
+      segments = generate_transcript(hours, rng)
+      params = dict(hours=round(hours, 3), words=sum(len(s.words) for s in segments))
+
+      # Filter matching
+      for size, filters in filter_sets.items():
+        runner.run('find_time_segments_to_filter', dict(params, wordlist=size), lambda: find_time_segments_to_filter(segments, filters))
+        runner.run('filter_transcription', dict(params, wordlist=size), lambda: filter_transcription(segments, filters, '[__]'))
+
+      # Subtitles
+      filtered, _ = filter_transcription(segments, filter_sets[wordlist_sizes[-1]], '[__]')
+      runner.run('layout_subtitles', params, lambda: layout_subtitles(filtered, respect_segments=False))
+      subtitles = layout_subtitles(filtered, respect_segments=False)
+      runner.run('create_subtitles_script', params, lambda: create_subtitles_script(subtitles))
+
+      # Transcription cache
+      transcription_cache.configure(cache_dir=os.path.join(temp_dir, 'cache'))
+      key = transcription_cache.get_chunk_cache_key(str(hours).encode(), dict(model_kwargs={}, transcribe_kwargs=dict(hotwords=None)))
+      runner.run('cache_save', params, lambda: transcription_cache.cache_transcription(key, segments))
+      runner.run('cache_load', params, lambda: transcription_cache.get_cached_transcription(key))
+      runner.run('cache_load_and_filter', dict(params, wordlist=wordlist_sizes[-1]),
+                 lambda: find_time_segments_to_filter(transcription_cache.get_cached_transcription(key), filter_sets[wordlist_sizes[-1]]))
+
+      # Muting: building the ffmpeg filter graph, which doesn't need ffmpeg to be installed
+      mute_segments = find_time_segments_to_filter(segments, filter_sets[wordlist_sizes[-1]])
+      def build_graph():
+        stream = ffmpeg.input('input.mp4')
+        audio = ffmpeg.filter(stream.audio, 'volume', volume=0, enable=_build_mute_expression(plan_mute_segments(mute_segments, (100, 100))))
+        return ffmpeg.compile(ffmpeg.output(stream.video, audio, 'output.mp4', vcodec='copy'))
+      runner.run('filter_audio_graph', dict(params, segments=len(mute_segments)), build_graph)
+
+    # Muting a generated tone file
+    seconds = 60 if quick else 600
+    mute_segments = [TimeSegment(t, t + 0.5) for t in range(5, seconds, 10)]
+    params = dict(seconds=seconds, segments=len(mute_segments))
+    wav_file = os.path.join(temp_dir, 'tone.wav')
+    _write_tone_wav(wav_file, seconds)
+    runner.run('filter_audio_wav', params, lambda: filter_audio(wav_file, os.path.join(temp_dir, 'tone-filtered.wav'), mute_segments, (0, 0)))
+    runner.run('filter_audio_wav_in_place', params, lambda: filter_audio(wav_file, wav_file, mute_segments, (0, 0)))
+
+    video_file = os.path.join(temp_dir, 'tone.mp4')
+    output_file = os.path.join(temp_dir, 'tone-filtered.mp4')
+    remove_output = lambda: os.path.exists(output_file) and os.remove(output_file)
+    if shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None:
+      runner.skip('filter_audio', params, 'ffmpeg is not installed')
+      runner.skip('filter_audio_smart_render', params, 'ffmpeg is not installed')
+    else:
+      _write_tone_video(video_file, seconds)
+      runner.run('filter_audio', params, lambda: filter_audio(video_file, output_file, mute_segments, (0, 0)), setup=remove_output)
+      runner.run('filter_audio_smart_render', params, lambda: filter_audio(video_file, output_file, mute_segments, (0, 0), smart_render=True),
+                 setup=remove_output)
+
+def main():
+  args = _parse_arguments()
+  runner = _Runner(args.repeat, args.select)
+  # Keep the progress output of the code being benchmarked out of the results
+  stdout = sys.stdout
+  sys.stdout = sys.stderr
+  try:
+    run_benchmarks(runner, args.quick, args.seed)
+  finally:
+    sys.stdout = stdout
+
+  report = dict(
+    python=platform.python_version(),
+    platform=platform.platform(),
+    processor=platform.processor() or platform.machine(),
+    cpu_count=os.cpu_count(),
+    quick=args.quick,
+    seed=args.seed,
+    results=runner.results,
+  )
+  if args.output is not None:
+    with open(args.output, 'w') as file:
+      json.dump(report, file, indent=2)
+  else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+  main()
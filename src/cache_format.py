@@ -0,0 +1,195 @@
+"""
+A compact, columnar binary format for cached transcriptions.
+
+A file starts with a magic number, a format version and a JSON header (the cache key and the number of segments, words
+and tokens). The rest of the file holds one array per field (e.g., the start times of all words), followed by the text of
+all segments and words as UTF-8 blobs. The arrays are optionally compressed with zlib as a whole.
+Loading only copies these arrays into memory; Segment and Word objects are created lazily when they are accessed.
+"""
+from transcript import Segment, Transcript, Word
+from array import array
+from collections.abc import Sequence
+from itertools import accumulate
+from typing import BinaryIO
+import json, struct, sys, zlib
+
+_MAGIC = b"AMTC"
+_VERSION = 1
+_PREAMBLE = struct.Struct("<4sHI") # magic, version, header length
+
+_SEGMENT_COLUMNS = [
+  ("id", "i"), ("seek", "i"), ("start", "d"), ("end", "d"), ("temperature", "d"),
+  ("avg_logprob", "d"), ("compression_ratio", "d"), ("no_speech_prob", "d"),
+  ("word_count", "i"), ("token_count", "i"), ("text_length", "i"),
+]
+_WORD_COLUMNS = [("start", "d"), ("end", "d"), ("probability", "d"), ("text_length", "i")]
+_NO_WORDS = -1 # word_count of a segment transcribed without word timestamps
+
+class FormatError(Exception):
+  pass
+
+def encode_transcription(key_dict: dict, segments: Sequence[Segment], compress: bool = True) -> bytes:
+  """Encodes a transcription and its cache key into the binary cache format."""
+  segment_columns = {name: array(typecode) for name, typecode in _SEGMENT_COLUMNS}
+  word_columns = {name: array(typecode) for name, typecode in _WORD_COLUMNS}
+  tokens = array("i")
+  segment_text = []
+  word_text = []
+  for segment in segments:
+    for name, _ in _SEGMENT_COLUMNS[:8]:
+      segment_columns[name].append(getattr(segment, name))
+    text = segment.text.encode()
+    segment_text.append(text)
+    segment_columns["text_length"].append(len(text))
+    segment_columns["token_count"].append(len(segment.tokens))
+    tokens.extend(segment.tokens)
+    if segment.words is None:
+      segment_columns["word_count"].append(_NO_WORDS)
+      continue
+    segment_columns["word_count"].append(len(segment.words))
+    for word in segment.words:
+      word_columns["start"].append(word.start)
+      word_columns["end"].append(word.end)
+      word_columns["probability"].append(word.probability)
+      text = word.word.encode()
+      word_text.append(text)
+      word_columns["text_length"].append(len(text))
+
+  columns = [*segment_columns.values(), *word_columns.values(), tokens]
+  payload = b"".join(_to_little_endian(c).tobytes() for c in columns) + b"".join(segment_text) + b"".join(word_text)
+  if compress:
+    payload = zlib.compress(payload, 1)
+
+  header = json.dumps(dict(
+    key=key_dict,
+    compressed=compress,
+    segments=len(segment_text),
+    words=len(word_text),
+    tokens=len(tokens),
+    segment_text_bytes=sum(len(t) for t in segment_text),
+  )).encode()
+  return _PREAMBLE.pack(_MAGIC, _VERSION, len(header)) + header + payload
+
+def read_key(file: BinaryIO) -> dict:
+  """Reads just the cache key from a file in the binary cache format, without reading the rest of the file."""
+  preamble = file.read(_PREAMBLE.size)
+  _, header_length = _unpack_preamble(preamble)
+  return json.loads(file.read(header_length))["key"]
+
+def decode_transcription(data: bytes) -> tuple[dict, Sequence[Segment]]:
+  """Decodes data in the binary cache format. Returns the cache key and a lazily-materialized list of segments."""
+  header, payload_offset = _decode_header(data)
+  payload = memoryview(data)[payload_offset:]
+  if header["compressed"]:
+    payload = memoryview(zlib.decompress(payload))
+
+  offset = 0
+  def read_column(typecode: str, count: int) -> array:
+    nonlocal offset
+    column = array(typecode)
+    size = column.itemsize * count
+    column.frombytes(payload[offset:offset + size])
+    offset += size
+    return _to_little_endian(column)
+
+  segment_columns = {name: read_column(typecode, header["segments"]) for name, typecode in _SEGMENT_COLUMNS}
+  word_columns = {name: read_column(typecode, header["words"]) for name, typecode in _WORD_COLUMNS}
+  tokens = read_column("i", header["tokens"])
+  segment_text = bytes(payload[offset:offset + header["segment_text_bytes"]])
+  word_text = bytes(payload[offset + header["segment_text_bytes"]:])
+  return header["key"], _CachedSegments(segment_columns, word_columns, tokens, segment_text, word_text)
+
+def _decode_header(data: bytes) -> tuple[dict, int]:
+  preamble_size, header_length = _unpack_preamble(data)
+  header_end = preamble_size + header_length
+  return json.loads(bytes(data[preamble_size:header_end])), header_end
+
+def _unpack_preamble(data: bytes) -> tuple[int, int]:
+  """Checks the preamble at the start of the given data. Returns the size of the preamble and the length of the header."""
+  if len(data) < _PREAMBLE.size:
+    raise FormatError("File is too short")
+  magic, version, header_length = _PREAMBLE.unpack_from(data)
+  if magic != _MAGIC:
+    raise FormatError("Not a transcription cache file")
+  if version != _VERSION:
+    raise FormatError(f"Unsupported cache format version {version}")
+  return _PREAMBLE.size, header_length
+
+def _to_little_endian(column: array) -> array:
+  """Byte-swaps an array on big-endian machines, so the file format is the same everywhere. The swap is its own inverse."""
+  if sys.byteorder == "big":
+    column = array(column.typecode, column)
+    column.byteswap()
+  return column
+
+def _offsets(lengths) -> list[int]:
+  return [0, *accumulate(max(n, 0) for n in lengths)]
+
+class _CachedSegments(Sequence):
+  """A read-only list of segments backed by the columns of a cache file. Segments are created when they are accessed."""
+
+  def __init__(self, segment_columns: dict[str, array], word_columns: dict[str, array], tokens: array, segment_text: bytes, word_text: bytes):
+    self._segments = segment_columns
+    self._words = word_columns
+    self._tokens = tokens
+    self._segment_text = segment_text
+    self._word_text = word_text
+    self._word_offsets = _offsets(segment_columns["word_count"])
+    self._token_offsets = _offsets(segment_columns["token_count"])
+    self._segment_text_offsets = _offsets(segment_columns["text_length"])
+    self._word_text_offsets = _offsets(word_columns["text_length"])
+
+  def __len__(self) -> int:
+    return len(self._segments["id"])
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in range(*index.indices(len(self)))]
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError("segment index out of range")
+    s = self._segments
+    words = None
+    if s["word_count"][index] != _NO_WORDS:
+      words = [self._get_word(i) for i in range(self._word_offsets[index], self._word_offsets[index + 1])]
+    return Segment(
+      id=s["id"][index],
+      seek=s["seek"][index],
+      start=s["start"][index],
+      end=s["end"][index],
+      text=self._segment_text[self._segment_text_offsets[index]:self._segment_text_offsets[index + 1]].decode(),
+      tokens=self._tokens[self._token_offsets[index]:self._token_offsets[index + 1]].tolist(),
+      temperature=s["temperature"][index],
+      avg_logprob=s["avg_logprob"][index],
+      compression_ratio=s["compression_ratio"][index],
+      no_speech_prob=s["no_speech_prob"][index],
+      words=words,
+    )
+
+  def to_transcript(self) -> Transcript:
+    """Creates a Transcript directly from the columns, without creating any Segment or Word objects."""
+    text = self._word_text.decode()
+    if len(text) == len(self._word_text):
+      text_offsets = array("i", self._word_text_offsets) # ASCII, so byte offsets are character offsets
+    else:
+      offsets = self._word_text_offsets
+      text_offsets = array("i", accumulate((len(self._word_text[offsets[i]:offsets[i + 1]].decode()) for i in range(len(offsets) - 1)), initial=0))
+    return Transcript(
+      starts=self._words["start"],
+      ends=self._words["end"],
+      probabilities=self._words["probability"],
+      text=text,
+      text_offsets=text_offsets,
+      segment_offsets=array("i", self._word_offsets),
+      segment_avg_logprobs=self._segments["avg_logprob"],
+    )
+
+  def _get_word(self, index: int) -> Word:
+    w = self._words
+    return Word(
+      start=w["start"][index],
+      end=w["end"][index],
+      word=self._word_text[self._word_text_offsets[index]:self._word_text_offsets[index + 1]].decode(),
+      probability=w["probability"][index],
+    )
@@ -0,0 +1,190 @@
+from faster_whisper import WhisperModel
+from faster_whisper.audio import decode_audio
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+from transcript import Segment, from_whisper_segment, offset_segment
+from speech import SpeechMap, SpeechTimeline
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterator, Optional
+import numpy as np
+import json, multiprocessing, os, threading, transcription_cache
+
+SAMPLING_RATE = 16000
+_MIN_CHUNK_SECONDS = 30
+_MAX_CHUNK_SECONDS = 600
+_CHUNKS_PER_PROCESS = 4
+_MIN_CONTENT_CHUNK_SAMPLES = 20 * SAMPLING_RATE
+_MIN_CUT_SILENCE_SAMPLES = SAMPLING_RATE
+_QUIET_THRESHOLD = 1e-3
+
+def get_process_count(processes: int) -> int:
+  """Resolves a requested process count, where 0 means choosing one based on the number of CPU cores."""
+  if processes > 0:
+    return processes
+  return max(1, (os.cpu_count() or 1) // 4)
+
+def transcribe_in_chunks(audio, model_kwargs: dict, transcribe_kwargs: dict, processes: int,
+                         vad_options: Optional[VadOptions] = None, start_time: float = 0.0,
+                         cache_settings: Optional[dict] = None, speech_map: Optional[SpeechMap] = None) -> tuple[Iterator[Segment], float]:
+  """
+  Splits the audio of the input file (or an array of 16 kHz samples) into chunks at silences and transcribes them in
+  parallel using a pool of processes.
+  Audio before start_time is skipped. Returns a generator of the stitched segments, in order, and the duration of the audio.
+
+  If cache settings are given, the chunks are content-defined and each one is cached by a hash of its audio, so when a file
+  is edited, only the chunks whose audio changed need to be transcribed again. The hash is of the decoded samples, so this
+  only helps when the unchanged parts decode to bit-identical audio (e.g., a cut without re-encoding the audio), not when
+  the whole file was re-encoded. Chunks are saved without evicting anything; the caller saves the whole transcription
+  afterwards, which trims the cache once (see transcription_cache.cache_chunk_transcription).
+  If a speech map is given, chunks are planned from it instead of running the VAD, and only their speech is transcribed.
+  """
+  if isinstance(audio, str):
+    audio = decode_audio(audio, sampling_rate=SAMPLING_RATE)
+  duration = len(audio) / SAMPLING_RATE
+  start_sample = int(start_time * SAMPLING_RATE)
+  speech = None
+  if speech_map is not None:
+    speech = [dict(start=max(round(start * SAMPLING_RATE) - start_sample, 0), end=round(end * SAMPLING_RATE) - start_sample)
+              for start, end in speech_map if round(end * SAMPLING_RATE) > start_sample]
+  if cache_settings is not None:
+    chunks = plan_content_defined_chunks(audio[start_sample:], vad_options, speech)
+  else:
+    chunks = plan_chunks(audio[start_sample:], processes, vad_options, speech)
+  chunks = [(start + start_sample, end + start_sample) for start, end in chunks]
+  cpu_threads = max(1, (os.cpu_count() or 1) // processes)
+
+  def generate_segments() -> Iterator[Segment]:
+    # Trim quiet audio from the ends of each chunk, so its hash doesn't depend on exactly where in a silence it was cut
+    trimmed_chunks = [_trim_quiet_samples(audio, start, end) for start, end in chunks] if cache_settings is not None else chunks
+    keys = [transcription_cache.get_chunk_cache_key(audio[start:end].tobytes(), cache_settings) for start, end in trimmed_chunks] \
+           if cache_settings is not None else [None] * len(chunks)
+    timelines = [_get_chunk_timeline(speech_map, start, end) for start, end in trimmed_chunks] if speech_map is not None else [None] * len(chunks)
+    cached = [[] if start == end or (timeline is not None and len(timeline.regions) == 0) else
+              transcription_cache.get_cached_transcription(key) if key is not None else None
+              for (start, end), key, timeline in zip(trimmed_chunks, keys, timelines)]
+    if cache_settings is not None:
+      print(f"Reusing {sum(c is not None for c in cached)} of {len(chunks)} chunks from the transcription cache")
+
+    pool = _get_pool(model_kwargs, processes, cpu_threads) if any(c is None for c in cached) else None
+    futures = [pool.submit(_transcribe_chunk, audio[start:end] if timeline is None else timeline.collect(audio[start:end]), transcribe_kwargs)
+               if c is None else None
+               for (start, end), c, timeline in zip(trimmed_chunks, cached, timelines)]
+    try:
+      segment_id = 1
+      for (start, _), key, chunk_segments, future, timeline in zip(trimmed_chunks, keys, cached, futures, timelines):
+        if chunk_segments is None:
+          chunk_segments = [from_whisper_segment(segment) for segment in future.result()]
+          if timeline is not None:
+            chunk_segments = [timeline.restore_segment(segment) for segment in chunk_segments]
+          if key is not None:
+            transcription_cache.cache_chunk_transcription(key, chunk_segments)
+        for segment in chunk_segments:
+          yield offset_segment(segment, start / SAMPLING_RATE)._replace(id=segment_id)
+          segment_id += 1
+    except BrokenProcessPool:
+      _discard_pool(pool)
+      raise
+    finally:
+      # Chunks that haven't started yet aren't needed if the transcription stopped early (e.g., on an error)
+      for future in futures:
+        if future is not None:
+          future.cancel()
+
+  return generate_segments(), duration
+
+def plan_chunks(audio, processes: int, vad_options: Optional[VadOptions] = None, speech: Optional[list[dict]] = None) -> list[tuple[int,int]]:
+  """
+  Splits audio into contiguous chunks of samples, cutting only in the middle of silences found by the VAD (or given as speech
+  timestamps in samples, to skip running the VAD).
+  Chunks are sized so each process gets a few of them, which keeps the pool busy even when chunk lengths vary.
+  """
+  total_seconds = len(audio) / SAMPLING_RATE
+  target_seconds = min(max(total_seconds / (processes * _CHUNKS_PER_PROCESS), _MIN_CHUNK_SECONDS), _MAX_CHUNK_SECONDS)
+  target_samples = int(target_seconds * SAMPLING_RATE)
+
+  if speech is None:
+    speech = get_speech_timestamps(audio, vad_options if vad_options is not None else VadOptions())
+  chunks = []
+  chunk_start = 0
+  for current, following in zip(speech, speech[1:]):
+    if current["end"] - chunk_start >= target_samples:
+      cut = (current["end"] + following["start"]) // 2
+      chunks.append((chunk_start, cut))
+      chunk_start = cut
+  chunks.append((chunk_start, len(audio)))
+  return chunks
+
+def plan_content_defined_chunks(audio, vad_options: Optional[VadOptions] = None, speech: Optional[list[dict]] = None) -> list[tuple[int,int]]:
+  """
+  Splits audio into contiguous chunks of samples at silences, choosing cut points based only on the nearby audio.
+  This means that after an edit (e.g., trimming the intro), the cut points quickly fall back onto the same places in the
+  audio as before, so most chunks are identical to the ones from the unedited file.
+  """
+  if speech is None:
+    speech = get_speech_timestamps(audio, vad_options if vad_options is not None else VadOptions())
+  chunks = []
+  chunk_start = 0
+  for current, following in zip(speech, speech[1:]):
+    gap_start, gap_end = current["end"], following["start"]
+    if gap_end - gap_start >= _MIN_CUT_SILENCE_SAMPLES and gap_start - chunk_start >= _MIN_CONTENT_CHUNK_SAMPLES:
+      # Cut at the quietest sample near the middle of the silence, which doesn't move when the VAD's windows shift
+      middle = (gap_start + gap_end) // 2
+      window_start = middle - _MIN_CUT_SILENCE_SAMPLES // 4
+      cut = window_start + int(np.argmin(np.abs(audio[window_start:middle + _MIN_CUT_SILENCE_SAMPLES // 4])))
+      chunks.append((chunk_start, cut))
+      chunk_start = cut
+  chunks.append((chunk_start, len(audio)))
+  return chunks
+
+def _get_chunk_timeline(speech_map: SpeechMap, start: int, end: int) -> SpeechTimeline:
+  """Finds the speech in a chunk of samples, measured from the start of the chunk."""
+  return SpeechTimeline(speech_map, start, end)
+
+def _trim_quiet_samples(audio, start: int, end: int) -> tuple[int,int]:
+  """Narrows a range of samples to exclude any nearly silent samples at either end."""
+  loud = np.flatnonzero(np.abs(audio[start:end]) > _QUIET_THRESHOLD)
+  if len(loud) == 0:
+    return start, start
+  return start + int(loud[0]), start + int(loud[-1]) + 1
+
+_pools: dict[str, ProcessPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(model_kwargs: dict, processes: int, cpu_threads: int) -> ProcessPoolExecutor:
+  """
+  Returns a pool of worker processes that have loaded the given model. Pools are kept until shutdown_pools is called, so a
+  batch of files loads the model in each worker once instead of once per file.
+  """
+  key = json.dumps(dict(model_kwargs=model_kwargs, processes=processes, cpu_threads=cpu_threads), sort_keys=True)
+  with _pools_lock:
+    if key not in _pools:
+      # Spawned workers don't inherit the parent's threads and locks (e.g., the batch pipeline's), unlike forked ones
+      _pools[key] = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_load_worker_model, initargs=(model_kwargs, cpu_threads))
+    return _pools[key]
+
+def _discard_pool(pool: ProcessPoolExecutor):
+  """Forgets a pool whose workers died, so the next transcription starts a new one."""
+  with _pools_lock:
+    for key, p in list(_pools.items()):
+      if p is pool:
+        del _pools[key]
+  pool.shutdown(wait=False, cancel_futures=True)
+
+def shutdown_pools():
+  """Stops the worker processes of all pools (see _get_pool)."""
+  with _pools_lock:
+    pools = list(_pools.values())
+    _pools.clear()
+  for pool in pools:
+    pool.shutdown()
+
+_worker_model: Optional[WhisperModel] = None
+
+def _load_worker_model(model_kwargs: dict, cpu_threads: int):
+  global _worker_model
+  _worker_model = WhisperModel(cpu_threads=cpu_threads, **model_kwargs)
+
+def _transcribe_chunk(audio, transcribe_kwargs: dict) -> list:
+  segments, _ = _worker_model.transcribe(audio=audio, **transcribe_kwargs)
+  return list(segments)
@@ -1,20 +1,23 @@
 def encipher(s: str) -> str:
   """Enciphers a given string by applying a simple caesar cipher.
   This lets users choose to avoid having profanity in human-readable form."""
-  return ''.join(_shift_letter(c, 1) for c in s)
+  return s.translate(_ENCIPHER_TABLE)
 
 def decipher(s: str) -> str:
   """The inverse of encipher."""
-  return ''.join(_shift_letter(c, -1) for c in s)
+  return s.translate(_DECIPHER_TABLE)
 
 # This array can be modified for other languages.
 _ALPHABET = ['a','b','c','d','e','f','g','h','i','j','k','l','m','n','o','p','q','r','s','t','u','v','w','x','y','z']
 
-def _shift_letter(c: str, offset: int) -> str:
-  """Rotates a character through the alphabet, if it is a letter."""
-  c_lower = c.lower()
-  if c_lower not in _ALPHABET:
-    return c
-  
-  o_lower = _ALPHABET[(_ALPHABET.index(c_lower) + offset) % len(_ALPHABET)]
-  return o_lower if c.islower() else o_lower.upper()
+def _make_shift_table(offset: int) -> dict[int, str]:
+  """Creates a str.translate table that rotates each letter of the alphabet by the given offset, preserving case."""
+  table = {}
+  for i, c in enumerate(_ALPHABET):
+    o = _ALPHABET[(i + offset) % len(_ALPHABET)]
+    table[ord(c)] = o
+    table[ord(c.upper())] = o.upper()
+  return table
+
+_ENCIPHER_TABLE = _make_shift_table(1)
+_DECIPHER_TABLE = _make_shift_table(-1)
@@ -1,3 +1,5 @@
+import argparse
+
 def confirm(prompt: str, default: bool | None = None) -> bool:
   """Prompts the user to confirm some action."""
   options = "[y/n]" if default is None else ("[Y/n]" if default else "[y/N]")
@@ -8,3 +10,13 @@ def confirm(prompt: str, default: bool | None = None) -> bool:
     return default
   else:
     return answer in ["yes", "y"]
+
+def parse_padding(padding_str: str) -> tuple[int,int]:
+  """Parses a padding tuple from a string of one or two integers."""
+  values = [int(x) for x in padding_str.split(',')]
+  if len(values) == 1:
+    return (values[0], values[0])
+  elif len(values) == 2:
+    return (values[0], values[1])
+  else:
+    raise argparse.ArgumentTypeError(f"{padding_str} is not a valid padding value")
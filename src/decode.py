@@ -0,0 +1,110 @@
+import ffmpeg
+import os, profiling, threading
+
+class DecodedAudio:
+  """
+  Decodes the audio track of a media file at most once, and shares the result between transcription and muting.
+  A single ffmpeg pass produces both the 16 kHz mono samples that Whisper needs and a full-quality PCM copy of the audio,
+  which the muting pass can read instead of decoding the input again. It is safe to use from several threads: a caller
+  that asks for the audio while it is being decoded waits for that decode to finish instead of starting another one that
+  writes the same file. A decode that turns out not to be needed (e.g., after a cache hit) can be stopped with cancel.
+  """
+
+  def __init__(self, input_file: str, directory: str):
+    self.input_file = input_file
+    self.path = os.path.join(directory, "decoded_audio.wav")
+    self._model_audio = None
+    self._lock = threading.Lock()
+    self._state_lock = threading.Lock() # Guards the fields below, which cancel uses while a decode holds _lock
+    self._process = None # The running ffmpeg process, while decoding
+    self._callers = 0 # The callers that are decoding or waiting for a decode
+    self._cancelled = False
+    self.start_time = 0.0 # When the decoded audio starts on the input's timeline, since the WAV copy always starts at zero
+
+  @property
+  def is_decoded(self) -> bool:
+    return self._model_audio is not None
+
+  def get_model_audio(self, sampling_rate: int = 16000):
+    """Returns the audio as an array of mono float32 samples at the given rate, decoding the input if it hasn't been decoded yet."""
+    import numpy as np
+    with self._state_lock:
+      self._callers += 1
+    try:
+      with self._lock:
+        if self._model_audio is None:
+          data = self._decode(sampling_rate)
+          self.start_time = _get_audio_start_time(self.input_file)
+          self._model_audio = np.frombuffer(data, np.float32)
+    finally:
+      with self._state_lock:
+        self._callers -= 1
+    return self._model_audio
+
+  def _decode(self, sampling_rate: int) -> bytes:
+    print("Decoding audio")
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    audio = ffmpeg.input(self.input_file)["a:0"]
+    full_rate = ffmpeg.output(audio, self.path, acodec="pcm_f32le")
+    model_rate = ffmpeg.output(audio, "pipe:", format="f32le", acodec="pcm_f32le", ac=1, ar=sampling_rate)
+    stream = ffmpeg.merge_outputs(full_rate, model_rate).global_args("-loglevel", "warning")
+    stream = ffmpeg.overwrite_output(stream)
+    with profiling.stage("decode", file=self.input_file):
+      with self._state_lock:
+        if self._cancelled:
+          self._cancelled = False
+          raise DecodeCancelled("Decoding was cancelled")
+        self._process = ffmpeg.run_async(stream, pipe_stdout=True)
+      try:
+        data, _ = self._process.communicate()
+      finally:
+        with self._state_lock:
+          process, self._process = self._process, None
+          cancelled, self._cancelled = self._cancelled, False
+    if process.returncode != 0:
+      if os.path.exists(self.path):
+        os.remove(self.path)
+      if cancelled:
+        raise DecodeCancelled("Decoding was cancelled")
+      raise ffmpeg.Error("ffmpeg", data, None)
+    return data
+
+  def cancel(self) -> bool:
+    """
+    Stops a decode that is running or about to start, unless another caller is waiting for it. The decode starts over if the
+    audio is asked for again. Returns False if there is nothing left to stop, because the audio is already decoded or
+    another caller needs it.
+    """
+    with self._state_lock:
+      if self._model_audio is not None or self._callers > 1:
+        return False
+      if self._callers == 1:
+        self._cancelled = True
+        if self._process is not None:
+          self._process.kill()
+      return True
+
+  def remove(self):
+    """Deletes the decoded copy of the audio, if there is one, after waiting for a decode that is still running."""
+    with self._lock:
+      if os.path.exists(self.path):
+        os.remove(self.path)
+
+class DecodeCancelled(Exception):
+  pass
+
+def _get_audio_start_time(input_file: str) -> float:
+  """Gets the start time of the first audio stream of a file, which containers like MP4 and MPEG-TS don't always put at zero."""
+  try:
+    streams = ffmpeg.probe(input_file, select_streams="a:0")["streams"]
+    return float(streams[0].get("start_time", 0.0)) if len(streams) > 0 else 0.0
+  except (ffmpeg.Error, ValueError):
+    return 0.0
+
+def decode_sample(input_file: str, start: float, duration: float, sampling_rate: int = 16000):
+  """Decodes part of the audio of a media file, as an array of mono float32 samples at the given rate, without decoding the rest."""
+  import numpy as np
+  stream = ffmpeg.input(input_file, ss=start, t=duration)["a:0"]
+  stream = ffmpeg.output(stream, "pipe:", format="f32le", acodec="pcm_f32le", ac=1, ar=sampling_rate).global_args("-loglevel", "warning")
+  data, _ = ffmpeg.run(stream, capture_stdout=True)
+  return np.frombuffer(data, np.float32)
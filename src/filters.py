@@ -1,97 +1,289 @@
-from faster_whisper.transcribe import Segment, Word
+from transcript import Segment, Transcript, as_transcript
 from dataclasses import dataclass
 from cipher import encipher, decipher
-import re
+from collections.abc import Sequence
+from typing import Optional, Union
+import bisect, re
 
 @dataclass
 class TimeSegment:
   start: float
   end: float
 
-def compile_filters(words: list[str], files: list[str]) -> list[re.Pattern]:
-  """Compiles a list of filters from a list of words and filter files."""
-  filters = [re.compile(word, re.IGNORECASE) for word in words]
+class FilterSet:
+  """
+  A compiled set of filters that can be matched against text in a single pass, regardless of how many filters it contains.
+  Whole-word literals (e.g., most lines of a wordlist) are looked up in a hash set, and literal phrases of several words are
+  merged into one alternation. All other patterns are regular expressions, which are matched against one word at a time.
+
+  If the patterns are enciphered, literals are deciphered once up front so they can be compared to plain text directly.
+  Only the remaining regular expressions need an enciphered copy of the text being matched.
+  """
+
+  def __init__(self, patterns: list[str], enciphered: bool = False):
+    self.patterns = patterns
+    self.enciphered = enciphered
+    self._words: dict[str, str] = {}
+    phrases: list[str] = []
+    self._regex_patterns: list[str] = []
+    for pattern in patterns:
+      literal = _get_literal_words(pattern)
+      if literal is None:
+        self._regex_patterns.append(pattern)
+        continue
+      if enciphered:
+        literal = [decipher(word) for word in literal]
+      if len(literal) == 1:
+        self._words.setdefault(literal[0].casefold(), pattern)
+      else:
+        phrases.append(r'\s+'.join(re.escape(word) for word in literal))
+    self._phrase_regex = re.compile(r'(?<!\w)(?:' + '|'.join(phrases) + r')(?!\w)', re.IGNORECASE) if len(phrases) > 0 else None
+    # Regular expressions are merged into as few alternations as possible, so each word is scanned once however many there are
+    self._word_regexes = _combine_patterns(self._regex_patterns)
+    self._fuzzy_words: Optional[dict[str, list[tuple[str, str]]]] = None # Fuzzy variant -> (phonetic key, pattern)
+
+  def __len__(self) -> int:
+    return len(self.patterns)
+
+  def find_match(self, text: str) -> Optional[str]:
+    """Returns the source pattern of the first filter that matches the given string, or None if no filters match."""
+    if len(self._words) > 0:
+      for word in _WORD_PATTERN.findall(text):
+        pattern = self._words.get(word.casefold())
+        if pattern is not None:
+          return pattern
+    if len(self._word_regexes) > 0 and self.enciphered:
+      text = encipher(text)
+    for regex in self._word_regexes:
+      match = regex.search(text)
+      if match is not None:
+        return self._get_source_pattern(regex, match)
+    return None
+
+  def _get_source_pattern(self, regex: re.Pattern, match: re.Match) -> str:
+    """Finds which of the original patterns produced a match from one of the combined regexes."""
+    if match.lastgroup is not None and match.lastgroup.startswith(_GROUP_PREFIX):
+      return self._regex_patterns[int(match.lastgroup[len(_GROUP_PREFIX):])]
+    return regex.pattern
+
+  def find_fuzzy_match(self, text: str) -> Optional[str]:
+    """
+    Like find_match, but whole-word literal filters also match words that sound alike or have one consonant more or less,
+    as a less accurate transcription might spell them. Regular expression filters still have to match exactly.
+    """
+    pattern = self.find_match(text)
+    if pattern is not None or len(self._words) == 0:
+      return pattern
+    if self._fuzzy_words is None:
+      self._fuzzy_words = {}
+      for word, pattern in self._words.items():
+        key = _get_phonetic_key(word)
+        for variant in _get_fuzzy_variants(key):
+          self._fuzzy_words.setdefault(variant, []).append((key, pattern))
+    for word in _WORD_PATTERN.findall(text):
+      key = _get_phonetic_key(word)
+      for variant in _get_fuzzy_variants(key):
+        for filter_key, pattern in self._fuzzy_words.get(variant, []):
+          if _is_fuzzy_match(key, filter_key):
+            return pattern
+    return None
+
+  def find_spans(self, text: str, word_offsets: Sequence[int]) -> list[tuple[int, int]]:
+    """
+    Returns the start and end index of every part of the given string that matches any filter, sorted and with overlapping
+    matches merged. The string is the text of several words joined together, where word i is text[word_offsets[i]:word_offsets[i + 1]].
+    Literal phrases can match across words, but regular expressions are matched against each word on its own, so that
+    patterns like 'damn.*' or '^damn$' mean the same as when they are matched against single words.
+    """
+    spans = []
+    if len(self._words) > 0:
+      # Look up each distinct word once, then find all occurrences of the ones that matched in a single scan
+      matched_words = [word for word in set(_WORD_PATTERN.findall(text)) if word.casefold() in self._words]
+      if len(matched_words) > 0:
+        regex = re.compile(r'(?<!\w)(?:' + '|'.join(re.escape(word) for word in matched_words) + r')(?!\w)')
+        spans += [m.span() for m in regex.finditer(text)]
+    if self._phrase_regex is not None:
+      spans += [m.span() for m in self._phrase_regex.finditer(text)]
+    if len(self._word_regexes) > 0:
+      # Transcripts repeat the same words a lot, so each distinct word is only matched once
+      word_matches: dict[str, list[tuple[int, int]]] = {}
+      for i in range(len(word_offsets) - 1):
+        word_start = word_offsets[i]
+        word = text[word_start:word_offsets[i + 1]]
+        matches = word_matches.get(word)
+        if matches is None:
+          matches = word_matches[word] = self._find_regex_spans(word)
+        spans += [(word_start + start, word_start + end) for start, end in matches]
+    spans.sort()
+    merged: list[tuple[int, int]] = []
+    for start, end in spans:
+      if len(merged) > 0 and start < merged[-1][1]:
+        merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+      else:
+        merged.append((start, end))
+    return merged
+
+  def _find_regex_spans(self, word: str) -> list[tuple[int, int]]:
+    """Finds the non-empty matches of the regular expression filters in a single word."""
+    if self.enciphered:
+      word = encipher(word) # Each character is enciphered in place, so match positions are the same in the original text
+    return [m.span() for regex in self._word_regexes for m in regex.finditer(word) if m.end() > m.start()]
+
+_WORD_PATTERN = re.compile(r'\w+')
+_LITERAL_PATTERN = re.compile(r'\\b(\w+(?: \w+)*)\\b')
+_GLOBAL_FLAGS_PATTERN = re.compile(r'\(\?([aiLmsux]+)\)')
+_GROUP_PREFIX = '_filter'
+
+_PHONETIC_REPLACEMENTS = [('ph', 'f'), ('ck', 'k'), ('c', 'k'), ('q', 'k'), ('x', 'ks'), ('z', 's')]
+_VOWELS = frozenset('aeiouy')
+_MIN_FUZZY_KEY_LENGTH = 4 # Shorter keys only match exactly, since nearly every short word is one edit away from another
+
+def _get_phonetic_key(word: str) -> str:
+  """
+  Reduces a word to a rough phonetic key, where letters and pairs of letters that sound alike are merged.
+  Words that a transcription might spell differently (e.g., 'phuck' and 'fuck') get the same key.
+  """
+  key = word.casefold()
+  for old, new in _PHONETIC_REPLACEMENTS:
+    key = key.replace(old, new)
+  return key
+
+def _get_fuzzy_variants(key: str) -> list[str]:
+  """
+  Returns a key and every variant of it with one consonant after the first letter deleted. Keys that are one consonant apart
+  (see _is_fuzzy_match) always have a variant in common, so the variants can be used to look up candidates in a hash table.
+  The candidates still have to be checked with _is_fuzzy_match, since keys that differ in other ways can share a variant too.
+  """
+  if len(key) < _MIN_FUZZY_KEY_LENGTH:
+    return [key]
+  return [key] + [key[:i] + key[i + 1:] for i in range(1, len(key)) if key[i] not in _VOWELS]
+
+def _is_fuzzy_match(a: str, b: str) -> bool:
+  """
+  Returns whether two phonetic keys are the same, or one is the other with one consonant inserted (e.g., 'shits' and 'shit').
+  Other changes, like a different vowel or first letter, make a different word more often than a misspelling.
+  """
+  if a == b:
+    return True
+  longer, shorter = (a, b) if len(a) > len(b) else (b, a)
+  if len(shorter) < _MIN_FUZZY_KEY_LENGTH or len(longer) != len(shorter) + 1:
+    return False
+  return any(longer[i] not in _VOWELS and longer[:i] + longer[i + 1:] == shorter for i in range(1, len(longer)))
+
+def _get_literal_words(pattern: str) -> Optional[list[str]]:
+  """Returns the words matched by a pattern of the form \\bword\\b or \\bsome words\\b, or None if the pattern is anything more complex."""
+  match = _LITERAL_PATTERN.fullmatch(pattern)
+  return match.group(1).split(' ') if match is not None else None
+
+def _combine_patterns(patterns: list[str]) -> list[re.Pattern]:
+  """
+  Merges a list of regular expressions into as few compiled patterns as possible: one alternation for each set of global
+  flags the patterns start with. Patterns that use their own groups (e.g., backreferences) can't safely be merged and are
+  compiled separately.
+  """
+  groups: dict[str, list[tuple[int, str]]] = {}
+  separate = []
+  for i, pattern in enumerate(patterns):
+    compiled = re.compile(pattern, re.IGNORECASE)
+    flags = _GLOBAL_FLAGS_PATTERN.match(pattern)
+    if compiled.groups > 0:
+      separate.append(compiled)
+    elif flags is not None:
+      groups.setdefault(''.join(sorted(flags.group(1))), []).append((i, pattern[flags.end():]))
+    else:
+      groups.setdefault('', []).append((i, pattern))
+  combined = []
+  for flags, members in groups.items():
+    prefix = f'(?{flags})' if len(flags) > 0 else ''
+    end = '\n)' if 'x' in flags else ')' # A comment in a verbose pattern runs to the end of the line
+    combined.append(re.compile(prefix + '|'.join(f'(?P<{_GROUP_PREFIX}{i}>{pattern}{end}' for i, pattern in members), re.IGNORECASE))
+  return combined + separate
+
+def compile_filters(words: list[str], files: list[str], enciphered: bool = False) -> FilterSet:
+  """
+  Compiles a list of filters from a list of words and filter files.
+  If enciphered is set, the filters are assumed to have been written with the same cipher as cipher.encipher.
+  """
+  patterns = list(words)
   for file in files:
-    filters += _compile_filters_from_file(file)
-  return filters
+    patterns += _read_filters_from_file(file)
+  return FilterSet(patterns, enciphered)
 
-def _compile_filters_from_file(file_path: str) -> list[re.Pattern]:
-  """Compiles a list of filters from the lines of a filter file."""
+def _read_filters_from_file(file_path: str) -> list[str]:
+  """Reads a list of filter patterns from the lines of a filter file."""
   with open(file_path) as file:
     words = []
     for line in file:
       word = line.rstrip()
       if len(word) > 0 and not word.startswith("#"):
-        words.append(re.compile(f'\\b{word}\\b', re.IGNORECASE))
+        words.append(f'\\b{word}\\b')
     return words
 
-def find_time_segments_to_filter(transcription_segments: list[Segment], filters: list[re.Pattern], encipher_words: bool) -> list[TimeSegment]:
-  """Creates a list of audio segments to filter out based on the provided transcription and filters."""
-  words = _flatten_transcription(transcription_segments)
-  return _find_filter_segments(words, filters, encipher_words)
-
-def _flatten_transcription(segments: list[Segment]) -> list[Word]:
-  """Turns a list of transcription segments into a list of words."""
-  return [word for segment in segments for word in segment.words]
+def find_time_segments_to_filter(transcription: Union[Sequence[Segment], Transcript], filters: FilterSet, fuzzy: bool = False) -> list[TimeSegment]:
+  """
+  Creates a sorted list of audio segments to filter out based on the provided transcription and filters.
+  Filters are matched against the text of the whole transcription at once, so literal phrases can match several words.
+  If fuzzy is set, words that nearly match a filter are included too (see FilterSet.find_fuzzy_match).
+  """
+  transcript = as_transcript(transcription)
+  return _find_filter_segments(transcript, filters, fuzzy)
 
-def filter_transcription(transcription_segments: list[Segment], filters: list[re.Pattern], replacement_text: str, encipher_text: bool) -> tuple[list[Segment], int]:
+def filter_transcription(transcription: Union[Sequence[Segment], Transcript], filters: FilterSet, replacement_text: str) -> tuple[Transcript, int]:
   """
   Applies the list of filters to a transcription, replacing any matches with the given replacement string.
-  Returns the filtered transcription and the number of matches that were found.
-  """
-  new_segments: list[Segment] = []
-  total_matches = 0
-  for segment in transcription_segments:
-    new_words: list[Word] = []
-    for word in segment.words:
-      filtered_word, matches = _filter_text(word.word, filters, replacement_text, encipher_text)
-      total_matches += matches
-      new_words.append(Word(
-        start=word.start,
-        end=word.end,
-        word=filtered_word,
-        probability=word.probability
-      ))
-    new_segments.append(Segment(
-      id=segment.id,
-      seek=segment.seek,
-      start=segment.start,
-      end=segment.end,
-      text=''.join(w.word for w in new_words),
-      tokens=segment.tokens,
-      temperature=segment.temperature,
-      avg_logprob=segment.avg_logprob,
-      compression_ratio=segment.compression_ratio,
-      no_speech_prob=segment.no_speech_prob,
-      words=new_words
-    ))
-  return new_segments, total_matches
-
-def _matches_any(word: str, filters: list[re.Pattern], encipher_words: bool) -> bool:
-  """Checks if the given string matches any pattern from the given list."""
-  if encipher_words:
-    word = encipher(word)
-  return any(filter.search(word) is not None for filter in filters)
-
-def _find_filter_segments(words: list[Word], filters: list[re.Pattern], encipher_words: bool) -> list[TimeSegment]:
-  """Creates a list of audio segments to filter out based on a list of words and filters."""
-  return [TimeSegment(word.start, word.end) for word in words
-          if _matches_any(word.word, filters, encipher_words)]
-
-def _filter_text(text: str, filters: list[re.Pattern], replacement_text: str, encipher_text: bool) -> tuple[str, int]:
-  """
-  Applies the list of filters to a string, replacing any matches with the given replacement string.
-  Returns the filtered string and the number of matches that were found.
-  """
-  if encipher_text:
-    text = encipher(text)
-    replacement_text = encipher(replacement_text)
-  total_matches = 0
-  for filter in filters:
-    matches = len(filter.findall(text))
-    if matches > 0:
-      text = filter.sub(replacement_text, text)
-      total_matches += matches
-  if encipher_text:
-    text = decipher(text)
-  return text, total_matches
+  A match that spans several words is replaced in the first of them, and its text is removed from the others.
+  Returns the filtered transcript, with the replacements as an overlay on the original words, and the number of matches that were found.
+  """
+  transcript = as_transcript(transcription)
+  spans = filters.find_spans(transcript.text, transcript.text_offsets)
+  offsets = transcript.text_offsets
+  # Group the matches by the words they touch
+  word_spans: dict[int, list[tuple[int, int]]] = {}
+  for span in spans:
+    first, last = _get_span_words(transcript, span)
+    for i in range(first, last + 1):
+      word_spans.setdefault(i, []).append(span)
+  replacements = {}
+  for i, spans_in_word in word_spans.items():
+    word_start, word_end = offsets[i], offsets[i + 1]
+    pieces = []
+    position = word_start
+    for start, end in spans_in_word:
+      if start >= word_start:
+        pieces.append(transcript.text[position:start])
+        pieces.append(replacement_text)
+      position = max(position, min(end, word_end))
+    pieces.append(transcript.text[position:word_end])
+    replacements[i] = ''.join(pieces)
+  return transcript.with_replacements(replacements), len(spans)
+
+def _get_span_words(transcript: Transcript, span: tuple[int, int]) -> tuple[int, int]:
+  """Finds the first and last word that a span of the transcript's text overlaps, by binary search over the word offsets."""
+  start, end = span
+  first = bisect.bisect_right(transcript.text_offsets, start) - 1
+  last = bisect.bisect_right(transcript.text_offsets, end - 1) - 1
+  return first, last
+
+def _find_filter_segments(transcript: Transcript, filters: FilterSet, fuzzy: bool = False) -> list[TimeSegment]:
+  """Creates a sorted list of audio segments to filter out based on the text of a transcript and filters."""
+  segments = []
+  matched_words = set()
+  for span in filters.find_spans(transcript.text, transcript.text_offsets):
+    first, last = _get_span_words(transcript, span)
+    segments.append(TimeSegment(transcript.starts[first], transcript.ends[last]))
+    matched_words.update(range(first, last + 1))
+  if fuzzy:
+    # Near matches are only found within single words that don't match exactly already.
+    # Transcripts repeat the same words a lot, so each distinct word is only matched once.
+    matched: dict[str, bool] = {}
+    for i in range(len(transcript)):
+      if i in matched_words:
+        continue
+      text = transcript.word_text(i)
+      is_match = matched.get(text)
+      if is_match is None:
+        is_match = matched[text] = filters.find_fuzzy_match(text) is not None
+      if is_match:
+        segments.append(TimeSegment(transcript.starts[i], transcript.ends[i]))
+    segments.sort(key=lambda s: s.start)
+  return segments
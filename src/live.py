@@ -0,0 +1,181 @@
+import argparse, sys, time
+from cli import parse_padding
+
+def _parse_arguments() -> argparse.Namespace:
+  parser = argparse.ArgumentParser(
+    prog='live',
+    description='A command-line tool for automatically muting specific words from a live audio stream. Muted audio is written to stdout ' +
+                'as raw signed 16-bit little-endian PCM, behind a fixed delay.'
+  )
+  parser.add_argument('input', nargs='?', default='pipe:',
+                      help='Audio or video source that ffmpeg can read, such as a stream URL or device. (Default: stdin)')
+  parser.add_argument('-w', '--filter-word', default=[], action='append',
+                      help='A word to filter out. Treated as a case-insensitive regular expression. Can be specified multiple times.')
+  parser.add_argument('-f', '--filter-file', default=[], action='append',
+                      help="A file of words to filter out. Each line is treated as a case-insentive regular expression.")
+  parser.add_argument('-e', '--encipher-words', default=False, action='store_true',
+                      help='Treat filters as enciphered with a caesar cipher with a shift of 1. See automute --help.')
+  parser.add_argument('-p', '--padding', default=(0,0), type=parse_padding,
+                      help='Padding in milliseconds to apply around filtered audio segments. Can be specified as a single integer or as two integers separated ' +
+                           'by a comma to specify the start and end padding separately. (Default: 0)')
+  parser.add_argument('--delay', default=4.0, type=float,
+                      help='Seconds of delay between reading audio and writing it out. Words have to be transcribed within this time to be muted. (Default: 4)')
+  parser.add_argument('--max-lag', default=5.0, type=float,
+                      help='Seconds that transcription may fall behind the live input before incoming audio is muted without being transcribed, ' +
+                           'until it has caught up. This keeps the output from drifting further and further behind. (Default: 5)')
+  parser.add_argument('--window', default=10.0, type=float,
+                      help='Seconds of recent audio to transcribe at each step. (Default: 10)')
+  parser.add_argument('--step', default=1.0, type=float,
+                      help='Seconds of new audio to read between transcriptions. (Default: 1)')
+  parser.add_argument('--sample-rate', default=48000, type=int,
+                      help='Sample rate of the output audio. (Default: 48000)')
+  parser.add_argument('--channels', default=1, type=int,
+                      help='Number of channels in the output audio. (Default: 1)')
+  parser.add_argument('--whisper-model', default='small.en',
+                      help='The faster_whisper model to use for audio transcription. See automute --help. (Default: small.en)')
+  parser.add_argument('--whisper-compute-type', default='auto', choices=['default','auto','int8','int8_float16','int8_bfloat16','int8_float32','int16','float16','bfloat16','float32'],
+                      help='The compute type to use when loading the Whisper model. (Default: auto)')
+  parser.add_argument('--whisper-device', default='auto', choices=['auto','cpu','cuda'],
+                      help='The compute device to use when running the Whisper model. (Default: auto)')
+  parser.add_argument('--whisper-threads', default=8, type=int,
+                      help='The number of CPU threads the Whisper model uses. (Default: 8)')
+  return parser.parse_args()
+
+def stream(source: str, filters, options, padding: tuple[int,int], delay: float, window: float, step: float, sample_rate: int, channels: int,
+           max_lag: float = 5.0):
+  """
+  Reads audio from the given source, transcribes it in overlapping windows as it arrives, and writes it to stdout after a fixed delay
+  with any words that match the filters muted. Progress, including the real-time factor of transcription, is reported on stderr.
+  If transcription is slower than real time, reading falls behind the source. Once it is more than max_lag seconds behind, new
+  audio is muted instead of transcribed (which is safer than letting it through unchecked) until reading has caught up.
+  """
+  import ffmpeg
+  import numpy as np
+  from audio import plan_mute_segments
+  from filters import TimeSegment, find_time_segments_to_filter
+  from transcribe import load_model, transcribe_audio
+  from transcript import offset_segment
+
+  if delay <= step:
+    raise ValueError("The delay must be longer than the step")
+
+  decoder = ffmpeg.input(source).output('pipe:', format='f32le', ac=channels, ar=sample_rate, loglevel='error').run_async(pipe_stdout=True)
+  model = load_model(options)
+  model_rate = model.feature_extractor.sampling_rate
+
+  step_samples = int(step * sample_rate)
+  window_samples = int(window * sample_rate)
+  delay_samples = int(delay * sample_rate)
+  buffer = np.zeros((0, channels), dtype=np.float32)
+  buffer_start = 0 # Index of the first sample in the buffer, counted from the start of the stream
+  emitted = 0 # Index of the next sample to write out
+  found: list[TimeSegment] = []
+  real_time_factor = 0.0
+  skipped: list[TimeSegment] = [] # Audio that was muted without being transcribed, to catch up with the source
+  muted_count = 0
+  late_count = 0
+  skipped_seconds = 0.0
+  stream_start = None # When the stream would have started, if it had been read in real time since the first block
+  output = sys.stdout.buffer
+
+  def emit(until: int):
+    nonlocal emitted
+    samples = buffer[emitted - buffer_start:until - buffer_start].copy()
+    for s in [*plan_mute_segments(found, padding), *skipped]:
+      mute_start = max(int(s.start * sample_rate), emitted)
+      mute_end = min(int(s.end * sample_rate), until)
+      if mute_start < mute_end:
+        samples[mute_start - emitted:mute_end - emitted] = 0
+    output.write((np.clip(samples, -1.0, 1.0) * 32767).astype('<i2').tobytes())
+    output.flush()
+    emitted = until
+
+  while True:
+    data = decoder.stdout.read(step_samples * channels * 4)
+    if not data:
+      break
+    block = np.frombuffer(data[:len(data) - len(data) % (channels * 4)], dtype='<f4').reshape(-1, channels)
+    buffer = np.concatenate([buffer, block])
+    total = buffer_start + len(buffer)
+    if stream_start is None:
+      stream_start = time.perf_counter() - total / sample_rate
+    lag = time.perf_counter() - stream_start - total / sample_rate
+
+    if lag > max_lag:
+      # Transcription can't keep up, so mute this block unheard rather than fall further behind
+      block_segment = TimeSegment((total - len(block)) / sample_rate, total / sample_rate)
+      if len(skipped) > 0 and skipped[-1].end >= block_segment.start:
+        skipped[-1].end = block_segment.end
+      else:
+        skipped.append(block_segment)
+      skipped_seconds += len(block) / sample_rate
+    else:
+      # Transcribe the most recent window of audio, and remember any words that match the filters
+      start_time = time.perf_counter()
+      window_start = max(total - window_samples, buffer_start)
+      mono = buffer[window_start - buffer_start:].mean(axis=1)
+      model_audio = _resample(mono, sample_rate, model_rate)
+      for segment in transcribe_audio(model, model_audio, options):
+        for s in find_time_segments_to_filter([offset_segment(segment, window_start / sample_rate)], filters):
+          # Overlapping windows find the same word several times, so only count words that haven't been found yet
+          if not any(s.start < f.end and f.start < s.end for f in found):
+            muted_count += 1
+            if s.start - padding[0] / 1000.0 < emitted / sample_rate:
+              late_count += 1
+          found.append(s)
+      real_time_factor = (time.perf_counter() - start_time) / (len(block) / sample_rate)
+
+    # Write out audio that is older than the delay, and forget anything that is no longer needed
+    if total - delay_samples > emitted:
+      emit(total - delay_samples)
+    keep_from = min(emitted, total - window_samples)
+    if keep_from > buffer_start:
+      buffer = buffer[keep_from - buffer_start:]
+      buffer_start = keep_from
+    found = [s for s in found if s.end + padding[1] / 1000.0 >= emitted / sample_rate]
+    skipped = [s for s in skipped if s.end >= emitted / sample_rate]
+
+    print(f"\r{total / sample_rate:.1f} seconds | real-time factor {real_time_factor:.2f} | delay {delay + max(lag, 0.0):.1f} seconds | " +
+          f"{muted_count} muted ({late_count} too late) | {skipped_seconds:.1f} seconds muted to catch up", end='', file=sys.stderr)
+
+  emit(buffer_start + len(buffer))
+  decoder.wait()
+  print(file=sys.stderr)
+
+def _resample(samples, from_rate: int, to_rate: int):
+  """Resamples audio with linear interpolation. Good enough for transcription."""
+  import numpy as np
+  if from_rate == to_rate:
+    return samples.astype(np.float32)
+  count = int(len(samples) * to_rate / from_rate)
+  positions = np.arange(count) * (from_rate / to_rate)
+  return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+def main():
+  args = _parse_arguments()
+
+  from filters import compile_filters
+  from transcribe import TranscribeOptions
+
+  filters = compile_filters(args.filter_word, args.filter_file, args.encipher_words)
+  stream(
+    args.input,
+    filters,
+    TranscribeOptions(
+      model=args.whisper_model,
+      device=args.whisper_device,
+      compute_type=args.whisper_compute_type,
+      cpu_threads=args.whisper_threads,
+      condition_on_previous_text=False, # Each window is transcribed independently
+    ),
+    args.padding,
+    delay=args.delay,
+    window=args.window,
+    step=args.step,
+    sample_rate=args.sample_rate,
+    channels=args.channels,
+    max_lag=args.max_lag,
+  )
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,169 @@
+"""
+A long-running local server that keeps Whisper models loaded between runs of automute and subtitles.
+Start it with `python src/model_server.py`; transcribe() will then use it automatically when its socket exists.
+"""
+from transcript import Segment
+from strong_typing import serialization
+from typing import Iterator, Optional
+import argparse, getpass, json, os, socket, socketserver, tempfile, threading
+
+class ModelServerError(RuntimeError):
+  """Raised when the model server can't be reached or fails to start a transcription."""
+
+def get_default_socket_path() -> Optional[str]:
+  """
+  Gets the path of the model server's socket: the AUTOMUTE_MODEL_SERVER environment variable, or a path in the temporary
+  directory for the current user. Returns None on platforms without Unix sockets, where the server isn't supported.
+  """
+  if not hasattr(socket, "AF_UNIX"):
+    return None
+  user = os.getuid() if hasattr(os, "getuid") else getpass.getuser()
+  return os.environ.get("AUTOMUTE_MODEL_SERVER", os.path.join(tempfile.gettempdir(), f"automute-model-server-{user}.sock"))
+
+def is_running(socket_path: Optional[str] = None) -> bool:
+  """Returns whether a model server's socket exists at the given path, or at the default path if none is given."""
+  socket_path = socket_path or get_default_socket_path()
+  return socket_path is not None and os.path.exists(socket_path)
+
+class ModelServerConnection:
+  """A connection to a running model server, used to request a single transcription."""
+
+  def __init__(self, sock: socket.socket):
+    self._socket = sock
+    self._file = sock.makefile('rwb')
+
+  def transcribe(self, input_file: str, model_kwargs: dict, transcribe_kwargs: dict, cpu_threads: int) -> tuple[Iterator[Segment], float]:
+    """
+    Starts a transcription on the server. Returns a generator of segments and the duration of the audio.
+    Raises ModelServerError if the transcription couldn't be started, in which case the connection is closed.
+    """
+    try:
+      _write_message(self._file, dict(
+        input_file=os.path.abspath(input_file),
+        model_kwargs=model_kwargs,
+        transcribe_kwargs=_to_json_kwargs(transcribe_kwargs),
+        cpu_threads=cpu_threads,
+      ))
+      response = _read_message(self._file)
+    except OSError as e:
+      self.close()
+      raise ModelServerError(str(e)) from e
+    if "error" in response:
+      self.close()
+      raise ModelServerError(response['error'])
+    return self._read_segments(), response["duration"]
+
+  def close(self):
+    self._file.close()
+    self._socket.close()
+
+  def _read_segments(self) -> Iterator[Segment]:
+    try:
+      while True:
+        message = _read_message(self._file)
+        if "segment" in message:
+          yield serialization.json_to_object(Segment, message["segment"])
+        elif "error" in message:
+          raise ModelServerError(message['error'])
+        else:
+          return
+    finally:
+      self.close()
+
+def connect(socket_path: Optional[str] = None) -> Optional[ModelServerConnection]:
+  """Connects to the model server at the given path, or at the default path if none is given. Returns None if no server is running."""
+  socket_path = socket_path or get_default_socket_path()
+  if not is_running(socket_path):
+    return None
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path)
+  except OSError:
+    sock.close()
+    return None
+  return ModelServerConnection(sock)
+
+def _to_json_kwargs(kwargs: dict) -> dict:
+  """Converts any NamedTuple values (e.g., VadOptions) to dictionaries so they survive a round trip through JSON."""
+  return {k: v._asdict() if hasattr(v, "_asdict") else v for k, v in kwargs.items()}
+
+def _write_message(file, message: dict):
+  file.write(json.dumps(message).encode() + b"\n")
+  file.flush()
+
+def _read_message(file) -> dict:
+  line = file.readline()
+  if not line:
+    raise ConnectionError("Model server closed the connection")
+  return json.loads(line)
+
+class _ModelCache:
+  """Keeps loaded models resident, keyed by their settings."""
+
+  def __init__(self):
+    self._models = {}
+    self._locks: dict[tuple, threading.Lock] = {}
+    self._lock = threading.Lock()
+
+  def get(self, model_kwargs: dict, cpu_threads: int):
+    """Returns the model for the given settings, loading it if necessary, along with a lock for using it."""
+    from faster_whisper import WhisperModel
+    key = (model_kwargs["model_size_or_path"], model_kwargs["device"], model_kwargs["compute_type"], cpu_threads)
+    with self._lock:
+      if key not in self._models:
+        print(f"Loading model {key}")
+        self._models[key] = WhisperModel(cpu_threads=cpu_threads, **model_kwargs)
+        self._locks[key] = threading.Lock()
+      return self._models[key], self._locks[key]
+
+class _TranscriptionHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    request = _read_message(self.rfile)
+    try:
+      model, lock = self.server.models.get(request["model_kwargs"], request["cpu_threads"])
+      with lock:
+        segments_generator, info = model.transcribe(audio=request["input_file"], **request["transcribe_kwargs"])
+        _write_message(self.wfile, dict(duration=info.duration))
+        for segment in segments_generator:
+          _write_message(self.wfile, dict(segment=serialization.object_to_json(segment)))
+      _write_message(self.wfile, dict(done=True))
+    except (BrokenPipeError, ConnectionResetError):
+      print("Client disconnected")
+    except Exception as e:
+      _write_message(self.wfile, dict(error=str(e)))
+
+class _ModelServer(socketserver.ThreadingUnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, socket_path: str):
+    super().__init__(socket_path, _TranscriptionHandler)
+    self.models = _ModelCache()
+
+def _parse_arguments() -> argparse.Namespace:
+  parser = argparse.ArgumentParser(
+    prog='model_server',
+    description='A local server that keeps Whisper models loaded so that automute and subtitles can skip loading them on every run.'
+  )
+  default_socket_path = get_default_socket_path()
+  parser.add_argument('--socket', default=default_socket_path,
+                      help=f'Path of the Unix socket to listen on. Can also be set with the AUTOMUTE_MODEL_SERVER environment variable. (Default: {default_socket_path})')
+  return parser.parse_args()
+
+def main():
+  if not hasattr(socket, "AF_UNIX"):
+    print("The model server needs Unix domain sockets, which this platform doesn't support")
+    exit(1)
+  args = _parse_arguments()
+  if os.path.exists(args.socket):
+    os.remove(args.socket)
+  with _ModelServer(args.socket) as server:
+    print(f"Listening on '{args.socket}'")
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      os.remove(args.socket)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,130 @@
+"""
+Lightweight instrumentation of the stages of a run (hashing, cache lookup, model loading, transcription, filtering, ffmpeg).
+Stages are only recorded after start() has been called, so the instrumentation costs next to nothing otherwise.
+
+The trace is written in Chrome's trace event format, which can be opened in chrome://tracing or https://ui.perfetto.dev.
+The same file also holds a per-stage summary under "stages", for reading or comparing runs without a trace viewer.
+"""
+from contextlib import contextmanager
+from typing import Iterator, Optional
+import json, os, sys, threading, time
+
+try:
+  import resource
+except ImportError:
+  resource = None # Peak memory isn't available on Windows
+
+class _Trace:
+  def __init__(self, profile_stage: Optional[str]):
+    self.start_time = time.perf_counter()
+    self.events: list[dict] = []
+    self.lock = threading.Lock()
+    self.profile_stage = profile_stage
+    self.profiled = False
+    self.profiler = None
+
+_trace: Optional[_Trace] = None
+
+def start(profile_stage: Optional[str] = None):
+  """Starts recording stages. If a stage name is given, the first run of that stage is also profiled with cProfile."""
+  global _trace
+  _trace = _Trace(profile_stage)
+
+@contextmanager
+def stage(name: str, **args) -> Iterator[dict]:
+  """
+  Records the wall time, CPU time, peak memory and bytes read of a stage of a run. Yields a dictionary that the stage can add
+  details to (e.g., the duration of the audio it transcribed, to compute its real-time factor).
+  CPU time and bytes read are counted for the whole process, so stages that run at the same time count each other's work.
+  """
+  trace = _trace
+  if trace is None:
+    yield args
+    return
+
+  profiler = None
+  with trace.lock:
+    if name == trace.profile_stage and not trace.profiled:
+      import cProfile
+      trace.profiled = True
+      profiler = trace.profiler = cProfile.Profile()
+  start_wall = time.perf_counter()
+  start_cpu = time.process_time()
+  start_read = _get_bytes_read()
+  if profiler is not None:
+    profiler.enable()
+  try:
+    yield args
+  finally:
+    if profiler is not None:
+      profiler.disable()
+    end_wall = time.perf_counter()
+    read = _get_bytes_read()
+    args = dict(
+      args,
+      cpu_seconds=round(time.process_time() - start_cpu, 6),
+      peak_rss_mb=_get_peak_rss_mb(),
+      bytes_read=read - start_read if read is not None and start_read is not None else None,
+    )
+    event = dict(
+      name=name,
+      ph="X",
+      ts=round((start_wall - trace.start_time) * 1e6),
+      dur=round((end_wall - start_wall) * 1e6),
+      pid=os.getpid(),
+      tid=threading.get_ident(),
+      args=args,
+    )
+    with trace.lock:
+      trace.events.append(event)
+
+def write(path: str):
+  """Writes the recorded stages to a trace file, and the cProfile statistics (if any) to <path>.prof."""
+  trace = _trace
+  if trace is None:
+    return
+  with trace.lock:
+    events = list(trace.events)
+  with open(path, "w") as file:
+    json.dump(dict(traceEvents=events, displayTimeUnit="ms", stages=_summarize(events)), file, indent=1)
+  print(f"Saved profile to '{path}'", file=sys.stderr)
+  if trace.profiler is not None:
+    trace.profiler.dump_stats(path + ".prof")
+    print(f"Saved cProfile statistics of '{trace.profile_stage}' to '{path}.prof'", file=sys.stderr)
+
+def _summarize(events: list[dict]) -> list[dict]:
+  """Totals the recorded events of each stage, in the order the stages first started."""
+  stages: dict[str, dict] = {}
+  for event in sorted(events, key=lambda e: e["ts"]):
+    summary = stages.setdefault(event["name"], dict(name=event["name"], count=0, wall_seconds=0.0, cpu_seconds=0.0, bytes_read=0, peak_rss_mb=None))
+    summary["count"] += 1
+    summary["wall_seconds"] += event["dur"] / 1e6
+    summary["cpu_seconds"] += event["args"]["cpu_seconds"]
+    if event["args"]["bytes_read"] is not None:
+      summary["bytes_read"] += event["args"]["bytes_read"]
+    if event["args"]["peak_rss_mb"] is not None:
+      summary["peak_rss_mb"] = max(summary["peak_rss_mb"] or 0, event["args"]["peak_rss_mb"])
+    if "audio_seconds" in event["args"]:
+      summary["audio_seconds"] = summary.get("audio_seconds", 0.0) + event["args"]["audio_seconds"]
+  for summary in stages.values():
+    if summary.get("audio_seconds"):
+      summary["real_time_factor"] = summary["wall_seconds"] / summary["audio_seconds"]
+  return list(stages.values())
+
+def _get_peak_rss_mb() -> Optional[float]:
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS reports bytes
+  return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def _get_bytes_read() -> Optional[int]:
+  """Returns the number of bytes the process has read so far, from files and pipes alike, or None if it can't be measured."""
+  try:
+    with open("/proc/self/io") as file:
+      for line in file:
+        if line.startswith("rchar:"):
+          return int(line.split()[1])
+  except OSError:
+    pass
+  return None
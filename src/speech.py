@@ -0,0 +1,122 @@
+"""
+Speech maps: the regions of an input that contain speech, found by a voice activity detection (VAD) pass over its audio.
+A speech map only depends on the audio and the VAD settings, so it is cached separately from transcriptions and reused when
+the model or other transcription settings change. Only the speech is sent to the model, which saves decoding music and
+silence and keeps Whisper from hallucinating words there; SpeechTimeline maps the timestamps back onto the original audio.
+"""
+from transcript import Segment, offset_segment
+from itertools import accumulate
+from typing import TYPE_CHECKING, Any, Callable, Optional, Union
+import bisect, dataclasses, profiling, transcription_cache
+
+if TYPE_CHECKING:
+  from faster_whisper.vad import VadOptions
+
+_SAMPLING_RATE = 16000
+
+# The speech regions of an input, as sorted, non-overlapping (start, end) times in seconds
+SpeechMap = list[tuple[float, float]]
+
+def get_vad_parameters(vad_options: Union['VadOptions', dict]) -> dict:
+  """
+  Converts VAD options to a dictionary, for cache keys and for faster_whisper (which has used both named tuples and
+  dataclasses for them). The options can also be given as a dictionary of the fields to change from their defaults, which
+  doesn't need faster_whisper to be imported.
+  """
+  if isinstance(vad_options, dict):
+    return vad_options
+  return vad_options._asdict() if hasattr(vad_options, "_asdict") else dataclasses.asdict(vad_options)
+
+def get_speech_map(input_file: str, vad_options: Union['VadOptions', dict], audio_loader: Optional[Callable[[], Any]] = None, fast_hash: bool = False,
+                   ignore_cache: bool = False) -> SpeechMap:
+  """
+  Gets the speech map of an input file, from the cache if possible. Otherwise, the VAD is run on the audio (from the audio
+  loader if one is given, or decoded from the file) and the result is cached.
+  """
+  key = _get_cache_key(input_file, vad_options, fast_hash)
+  speech_map = transcription_cache.get_cached_speech_map(key) if not ignore_cache else None
+  if speech_map is not None:
+    return speech_map
+
+  from faster_whisper.vad import VadOptions, get_speech_timestamps
+  if audio_loader is not None:
+    audio = audio_loader()
+  else:
+    from faster_whisper.audio import decode_audio
+    audio = decode_audio(input_file, sampling_rate=_SAMPLING_RATE)
+  with profiling.stage("vad", file=input_file, audio_seconds=len(audio) / _SAMPLING_RATE):
+    timestamps = get_speech_timestamps(audio, VadOptions(**get_vad_parameters(vad_options)))
+  speech_map = [(t["start"] / _SAMPLING_RATE, t["end"] / _SAMPLING_RATE) for t in timestamps]
+  transcription_cache.cache_speech_map(key, speech_map)
+  return speech_map
+
+def get_cached_speech_map(input_file: str, vad_options: Optional[Union['VadOptions', dict]], fast_hash: bool = False) -> Optional[SpeechMap]:
+  """Gets the speech map of an input file if it is already cached, without running the VAD. Returns None if no VAD options are given."""
+  if vad_options is None:
+    return None
+  return transcription_cache.get_cached_speech_map(_get_cache_key(input_file, vad_options, fast_hash))
+
+def _get_cache_key(input_file: str, vad_options: Union['VadOptions', dict], fast_hash: bool) -> tuple[str, dict]:
+  return transcription_cache.get_cache_key(input_file, dict(speech_map=get_vad_parameters(vad_options)), fast_hash)
+
+def clip_to_speech(speech_map: SpeechMap, start: float, end: float) -> list[tuple[float, float]]:
+  """Returns the parts of the given time range that are inside speech regions."""
+  i = max(bisect.bisect_right(speech_map, (start, float("inf"))) - 1, 0)
+  parts = []
+  while i < len(speech_map) and speech_map[i][0] < end:
+    part = (max(start, speech_map[i][0]), min(end, speech_map[i][1]))
+    if part[1] > part[0]:
+      parts.append(part)
+    i += 1
+  return parts
+
+class SpeechTimeline:
+  """
+  Maps between the original timeline of some audio and the timeline of its speech regions joined together, so that a
+  transcription of just the speech can be placed back where it was spoken. Positions are kept as whole samples, so the
+  joined audio and the mapping agree exactly however many regions there are.
+  """
+
+  def __init__(self, speech_map: SpeechMap, start_sample: int = 0, end_sample: Optional[int] = None):
+    # Only speech between start_sample and end_sample is included (e.g., a chunk, or the rest of a resumed transcription),
+    # and all positions are measured from start_sample
+    self.regions: list[tuple[int, int]] = []
+    for start, end in speech_map:
+      start = max(_to_samples(start), start_sample)
+      end = min(_to_samples(end), end_sample) if end_sample is not None else _to_samples(end)
+      if end > start:
+        self.regions.append((start - start_sample, end - start_sample))
+    self.joined_starts = list(accumulate((end - start for start, end in self.regions[:-1]), initial=0))
+
+  def collect(self, audio):
+    """Joins the speech regions of an array of 16 kHz samples that starts at start_sample."""
+    import numpy as np
+    parts = [audio[start:end] for start, end in self.regions]
+    return np.concatenate(parts) if len(parts) > 0 else audio[:0]
+
+  def to_original_time(self, time: float, is_end: bool = False) -> float:
+    """
+    Maps a time in the joined speech back onto the original timeline, in seconds from start_sample. A time exactly at the
+    seam between two regions is placed at the end of the earlier region if it is the end of something, and at the start
+    of the later one otherwise.
+    """
+    if len(self.regions) == 0:
+      return time
+    position = time * _SAMPLING_RATE
+    i = (bisect.bisect_left if is_end else bisect.bisect_right)(self.joined_starts, position) - 1
+    i = max(i, 0)
+    start, end = self.regions[i]
+    return min(start + position - self.joined_starts[i], end) / _SAMPLING_RATE
+
+  def restore_segment(self, segment: Segment) -> Segment:
+    """Moves a segment transcribed from the joined speech back onto the original timeline."""
+    start = self.to_original_time(segment.start)
+    return offset_segment(segment, start - segment.start)._replace(
+      end=self.to_original_time(segment.end, is_end=True),
+      words=[w._replace(start=self.to_original_time(w.start), end=self.to_original_time(w.end, is_end=True)) for w in segment.words]
+            if segment.words is not None else None,
+    )
+
+def _to_samples(time: float) -> int:
+  # Speech maps are made from sample positions, so rounding recovers them exactly
+  return round(time * _SAMPLING_RATE)
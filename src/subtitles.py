@@ -1,20 +1,33 @@
-from faster_whisper.transcribe import Segment, Word
+from transcript import Segment, Transcript, Word, as_transcript
 from transcribe import transcribe, TranscribeOptions
-from filters import compile_filters, filter_transcription
+import transcription_cache
+from audio import filter_audio
+from decode import DecodedAudio
+from filters import compile_filters, filter_transcription, find_time_segments_to_filter
 import ffmpeg
-import os, pathlib, argparse
-from cli import confirm
+import os, pathlib, argparse, tempfile
+from cli import confirm, parse_padding
+import profiling
+from collections.abc import Iterable, Sequence
 from dataclasses import dataclass
-import math
+from typing import Optional, Union
 
 @dataclass
 class Subtitle:
   start: float
   end: float
-  words: list[Word]
+  transcript: Transcript
+  word_indices: list[int]
 
-def layout_subtitles(segments: list[Segment], respect_segments: bool) -> list[Subtitle]:
-  """Transforms a list of transcription segments into a list of subtitles."""
+  @property
+  def words(self) -> list[Word]:
+    return [self.transcript.word(i) for i in self.word_indices]
+
+def layout_subtitles(transcription: Union[Sequence[Segment], Transcript], respect_segments: bool,
+                     segment_indices: Optional[Iterable[int]] = None) -> list[Subtitle]:
+  """
+  Transforms a transcription into a list of subtitles. If segment indices are given, only the words of those segments are used.
+  """
   # Conventions to follow: https://engagemedia.org/help/best-practices-for-online-subtitling/
   # - Max = 2 lines
   # - In general, appear and disappear with timing of spoken text.
@@ -26,46 +39,55 @@ def layout_subtitles(segments: list[Segment], respect_segments: bool) -> list[Su
   # - 40 characters per line
   # - >=1.5, <=6 seconds per subtitle
   # - 0.125 second gap between subtitles
-  sentences = [s.words for s in segments] if respect_segments else _group_sentences(segments)
+  transcript = as_transcript(transcription)
+  if segment_indices is None:
+    segment_indices = range(transcript.segment_count)
+  segment_words = [transcript.segment_words(i) for i in segment_indices]
+  sentences = segment_words if respect_segments else _group_sentences(transcript, segment_words)
+  starts = transcript.starts
+  ends = transcript.ends
   subtitles = []
   subtitle_char_count = 0
   subtitle_words = []
   for sentence in sentences:
+    if len(sentence) == 0:
+      continue
     if len(subtitle_words) > 0:
-      start = subtitle_words[0].start
-      next_start = sentence[0].start
+      start = starts[subtitle_words[0]]
+      next_start = starts[sentence[0]]
       if start + 1.5 < next_start - 0.125:
-        end = max(start + 1.5, subtitle_words[-1].end)
+        end = max(start + 1.5, ends[subtitle_words[-1]])
         end = min(end, next_start - 0.125)
-        subtitles.append(Subtitle(start, end, subtitle_words))
+        subtitles.append(Subtitle(start, end, transcript, subtitle_words))
         subtitle_words = []
         subtitle_char_count = 0
 
     for word in sentence:
-      if subtitle_char_count + len(word.word) > 80:
-        subtitles.append(Subtitle(subtitle_words[0].start, word.start, subtitle_words))
+      word_length = len(transcript.word_text(word))
+      if subtitle_char_count + word_length > 80:
+        subtitles.append(Subtitle(starts[subtitle_words[0]], starts[word], transcript, subtitle_words))
         subtitle_words = []
         subtitle_char_count = 0
 
       subtitle_words.append(word)
-      subtitle_char_count += len(word.word)
+      subtitle_char_count += word_length
     # TODO: Skip subtitles/sentences/phrases with low average probability
   
   if len(subtitle_words) > 0:
-    start = subtitle_words[0].start
-    end = max(start + 1.5, subtitle_words[-1].end)
-    subtitles.append(Subtitle(start, end, subtitle_words))
+    start = starts[subtitle_words[0]]
+    end = max(start + 1.5, ends[subtitle_words[-1]])
+    subtitles.append(Subtitle(start, end, transcript, subtitle_words))
 
   return subtitles
 
-def _group_sentences(segments: list[Segment]) -> list[list[Word]]:
-  """Groups words from a list into sentences based on punctuation."""
+def _group_sentences(transcript: Transcript, segment_words: list[range]) -> list[list[int]]:
+  """Groups the words of the given segments into sentences based on punctuation. Returns the indices of each sentence's words."""
   sentences = []
   current_sentence = []
-  for segment in segments:
-    for word in segment.words:
+  for words in segment_words:
+    for word in words:
       current_sentence.append(word)
-      text = word.word
+      text = transcript.word_text(word)
       if text.endswith('.') or text.endswith('!') or text.endswith('?'):
         sentences.append(current_sentence)
         current_sentence = []
@@ -104,12 +126,12 @@ def create_subtitles_script(subtitles: list[Subtitle]) -> str:
     end = _seconds_to_ts(subtitle.end)
     text = ""
     first = True
-    for word in subtitle.words:
-      word_text = word.word
+    for word in subtitle.word_indices:
+      word_text = subtitle.transcript.word_text(word)
       if first:
         word_text = word_text.lstrip()
         first = False
-      text += WORD_FORMAT.format(alpha=_probability_to_alpha(word.probability), text=word_text)
+      text += WORD_FORMAT.format(alpha=_probability_to_alpha(subtitle.transcript.probabilities[word]), text=word_text)
     contents.append(LINE_FORMAT.format(start=start, end=end, text=text.strip()))
   return ''.join(contents)
 
@@ -131,13 +153,16 @@ def _probability_to_alpha(probability: float) -> int:
   lerp = 1.0 - min(max((probability - MIN_PROBABILITY) / (MAX_PROBABILITY - MIN_PROBABILITY), 0.0), 1.0)
   return MIN_ALPHA + int(lerp * (MAX_ALPHA - MIN_ALPHA))
 
-def add_subtitles_to_video(video_file: str, subtitles_script: str, output_file: str):
+def _confirm_overwrite(output_file: str):
   if os.path.isfile(output_file):
     if confirm("Output file already exists. Overwrite it?", default=False):
       os.remove(output_file)
     else:
       print("Canceled")
       exit(1)
+
+def add_subtitles_to_video(video_file: str, subtitles_script: str, output_file: str):
+  _confirm_overwrite(output_file)
   av = ffmpeg.input(video_file)
   subtitles = ffmpeg.input('pipe:')
   stream = ffmpeg.output(av, subtitles, output_file, c="copy", loglevel="error")
@@ -154,6 +179,13 @@ def _parse_arguments() -> argparse.Namespace:
   )
   parser.add_argument('input',
                       help='Audio or video file to add subtitles to.')
+  parser.add_argument('-m', '--mute', default=False, action='store_true',
+                      help='Mute filtered words in the input and add subtitles in a single pass, instead of adding subtitles to ' +
+                           '<input file>-filtered created by an earlier run of automute.')
+  parser.add_argument('-p', '--padding', default=(0,0), type=parse_padding,
+                      help='Padding in milliseconds to apply around muted audio segments with --mute. See automute --help. (Default: 0)')
+  parser.add_argument('--smart-render', default=False, action='store_true',
+                      help='With --mute, only re-encode the audio around muted segments. See automute --help.')
   parser.add_argument('-o', '--output',
                       help='Name of the output file. (Default: <input file>-subtitled.mkv)')
   parser.add_argument('-w', '--filter-word', default=[], action='append',
@@ -173,15 +205,45 @@ def _parse_arguments() -> argparse.Namespace:
                            '\'auto\' selects the fasted option that is supported by the device used. (Default: auto)')
   parser.add_argument('--whisper-device', default='auto', choices=['auto','cpu','cuda'],
                       help='The compute device to use when running the Whisper model. (Default: auto)')
+  parser.add_argument('--whisper-threads', type=int,
+                      help='The number of CPU threads the Whisper model uses. Ignored with --whisper-processes other than 1, which divides the cores ' +
+                           'between the processes. (Default: 8, or the tuned number with --auto-tune)')
+  parser.add_argument('--auto-tune', default=False, action='store_true',
+                      help='Choose the number of threads and the compute type that transcribe fastest on this machine, by timing them on a short ' +
+                           'sample of the input. The choice is stored per host and model in the cache directory and reused by later runs. Settings ' +
+                           'that are specified (--whisper-threads, or a --whisper-compute-type other than auto) are kept. Since the compute type ' +
+                           'changes the transcription, it is part of the cache key.')
+  parser.add_argument('--retune', default=False, action='store_true',
+                      help='Like --auto-tune, but time the settings again even if a choice is already stored (e.g., after a hardware change).')
+  parser.add_argument('--whisper-processes', default=1, type=int,
+                      help='Split long inputs into chunks at silences and transcribe the chunks in this many processes. 0 picks a number based on ' +
+                           'the number of CPU cores. (Default: 1)')
   parser.add_argument('--respect-segments', default=False, action='store_true',
                       help="Use the segment boundaries from the Whisper transcription. This is sometimes useful for videos that primarily contain lyrics.")
-  # parser.add_argument('--whisper-silence-ms', default=-1, type=int,
-  #                     help='The minimum duration in milliseconds for an audio segment with no detected speech to be skipped during transcription. -1 to disable. ' +
-  #                          '(Default: -1)')
+  parser.add_argument('--whisper-silence-ms', default=-1, type=int,
+                      help='The minimum duration in milliseconds for an audio segment with no detected speech to be skipped during transcription. -1 to disable. ' +
+                           'The speech found in each input is cached and reused when other settings change, and matches outside of speech aren\'t muted. ' +
+                           '(Default: -1)')
   parser.add_argument('--min-logprob', default=-1.2, type=float,
                       help="The minimum average log probabilty that a transcription segment must have to be included in subtitles. (Default: -1.2)")
   parser.add_argument('--ignore-cached-transcriptions', default=False, action='store_true',
                       help='Ignore any cached transcriptions.')
+  parser.add_argument('--incremental', default=False, action='store_true',
+                      help='Split the audio into chunks at silences and cache the transcription of each chunk separately, so that when an edited ' +
+                           'version of a file is transcribed, only the chunks whose audio changed are transcribed again.')
+  parser.add_argument('--cache-dir',
+                      help='Directory to store cached transcriptions in. Can be shared between machines to reuse each other\'s transcriptions. ' +
+                           '(Default: $AUTOMUTE_CACHE_DIR or .transcription_cache)')
+  parser.add_argument('--cache-max-size', type=float,
+                      help='Maximum size of the transcription cache in megabytes. The least recently used transcriptions are removed when it grows ' +
+                           'larger. (Default: $AUTOMUTE_CACHE_MAX_MB or unlimited)')
+  parser.add_argument('--profile',
+                      help='Record the time, CPU time, peak memory and bytes read of each stage of the run, and write them to this file as a ' +
+                           'Chrome trace (viewable in chrome://tracing or ui.perfetto.dev) with a per-stage summary.')
+  parser.add_argument('--profile-stage',
+                      help='Also profile this stage (e.g., transcription or filter_audio) with cProfile, and write the statistics to <profile file>.prof.')
+  parser.add_argument('--fast-input-hash', default=False, action='store_true',
+                      help='Identify input files in the transcription cache by a fast, non-cryptographic fingerprint instead of a SHA-1 hash.')
   return parser.parse_args()
 
 def _get_filtered_video_path(input_file: str) -> str:
@@ -194,44 +256,80 @@ def _get_output_file_path(input_file: str) -> str:
   input_path = pathlib.Path(input_file)
   return str(input_path.with_stem(input_path.stem + "-subtitled").with_suffix(".mkv"))
 
-def _avg_word_log_prob(segment: Segment) -> float:
-  return sum(math.log10(word.probability) for word in segment.words) / len(segment.words)
-
 def main():
   args = _parse_arguments()
+  if args.profile is not None:
+    profiling.start(args.profile_stage)
+  try:
+    _main(args)
+  finally:
+    if args.profile is not None:
+      profiling.write(args.profile)
 
+def _main(args: argparse.Namespace):
   input_file = args.input
   filtered_file = _get_filtered_video_path(input_file)
   output_file = args.output if args.output is not None else _get_output_file_path(input_file)
   
-  filters = compile_filters(args.filter_word, args.filter_file)
+  with profiling.stage("compile_filters"):
+    filters = compile_filters(args.filter_word, args.filter_file, args.encipher_words)
+  transcription_cache.configure(args.cache_dir, args.cache_max_size)
 
-  segments = transcribe(
-    input_file,
-    TranscribeOptions(
+  with tempfile.TemporaryDirectory() as temp_dir:
+    # With --mute, audio that is decoded for transcription is reused for muting
+    decoded_audio = DecodedAudio(input_file, temp_dir)
+    options = TranscribeOptions(
       model=args.whisper_model,
       device=args.whisper_device,
       compute_type=args.whisper_compute_type,
+      processes=args.whisper_processes,
+      incremental=args.incremental,
       condition_on_previous_text='distil' not in args.whisper_model, # Distil models seem prone to repeating themselves
-      # hotwords=[decipher(word) if args.encipher_words else word for f in filters for word in [f.pattern[2:-2]]],
-      # vad_filter=args.whisper_silence_ms >= 0,
-      # vad_parameters=dict(
-      #   min_silence_duration_ms=args.whisper_silence_ms
-      # ) if args.whisper_silence_ms >= 0 else dict()
-    ),
-    ignore_cache=args.ignore_cached_transcriptions,
-  )
-  min_logprob = args.min_logprob
-  segments = [s for s in segments if s.avg_logprob >= min_logprob and _avg_word_log_prob(s) >= min_logprob]
+      # hotwords=[decipher(word) if args.encipher_words else word for f in filters.patterns for word in [f[2:-2]]],
+      vad_options=dict(min_silence_duration_ms=args.whisper_silence_ms) if args.whisper_silence_ms >= 0 else None,
+    )
+    if args.whisper_threads is not None:
+      options = options._replace(cpu_threads=args.whisper_threads)
+    if args.auto_tune or args.retune:
+      from tuning import tune_options
+      options = tune_options(options, input_file, cpu_threads=args.whisper_threads, num_workers=1,
+                             compute_type=args.whisper_compute_type if args.whisper_compute_type != 'auto' else None, recalibrate=args.retune)
+    speech_maps = []
+    segments = transcribe(
+      input_file,
+      options,
+      ignore_cache=args.ignore_cached_transcriptions,
+      fast_hash=args.fast_input_hash,
+      audio_loader=decoded_audio.get_model_audio if args.mute else None,
+      on_speech_map=speech_maps.append,
+    )
+    transcript = as_transcript(segments)
+    if args.mute:
+      # Everything that matches is muted, even in segments that are too uncertain to show in the subtitles
+      with profiling.stage("find_segments", file=input_file):
+        mute_segments = find_time_segments_to_filter(transcript, filters)
+      print(f"Found {len(mute_segments)} audio segments that match filters")
+    min_logprob = args.min_logprob
+    confident_segments = [i for i, (avg_logprob, word_log_prob) in enumerate(zip(transcript.segment_avg_logprobs, transcript.segment_word_log_probs()))
+                          if avg_logprob >= min_logprob and word_log_prob >= min_logprob]
 
-  segments, matches = filter_transcription(segments, filters, '[__]', args.encipher_words)
-  if len(filters) > 0:
-    print(f"Found {matches} matches for filters")
+    with profiling.stage("filter_transcription", file=input_file):
+      transcript, matches = filter_transcription(transcript, filters, '[__]')
+    if len(filters) > 0:
+      print(f"Found {matches} matches for filters")
 
-  subtitles = layout_subtitles(segments, respect_segments=args.respect_segments)
-  script = create_subtitles_script(subtitles)
+    with profiling.stage("layout_subtitles", file=input_file):
+      subtitles = layout_subtitles(transcript, respect_segments=args.respect_segments, segment_indices=confident_segments)
+      script = create_subtitles_script(subtitles)
 
-  add_subtitles_to_video(filtered_file, script, output_file)
+    if args.mute:
+      _confirm_overwrite(output_file)
+      speech_map = speech_maps[-1] if len(speech_maps) > 0 else None
+      filter_audio(input_file, output_file, mute_segments, args.padding, decoded_audio, args.smart_render, subtitles_script=script,
+                   speech_map=speech_map)
+    else:
+      with profiling.stage("add_subtitles", file=filtered_file):
+        add_subtitles_to_video(filtered_file, script, output_file)
   print("Done")
 
 if __name__ == "__main__":
@@ -1,10 +1,16 @@
-from faster_whisper import WhisperModel
-from faster_whisper.transcribe import Segment
-from faster_whisper.vad import VadOptions
+from transcript import Segment, Word, from_whisper_segment, offset_segment
 from tqdm import tqdm
-import hashlib, json, os
-from strong_typing import serialization
-from typing import NamedTuple, Optional
+from collections.abc import Sequence
+from typing import TYPE_CHECKING, Any, Callable, Iterator, NamedTuple, Optional, Union
+import bisect, model_server, profiling, speech, threading, transcription_cache
+
+if TYPE_CHECKING:
+  # faster_whisper is only imported when a transcription actually has to run, so cache hits stay fast
+  from faster_whisper import WhisperModel
+  from faster_whisper.vad import VadOptions
+  from filters import FilterSet
+
+_SAMPLING_RATE = 16000 # The sample rate of the audio that Whisper models expect
 
 class TranscribeOptions(NamedTuple):
   # WhisperModel parameters
@@ -12,127 +18,367 @@ class TranscribeOptions(NamedTuple):
   device: str = 'auto'
   compute_type: str = 'auto'
   cpu_threads: int = 8
+  num_workers: int = 1
+  processes: int = 1 # Transcribe chunks of the input in this many processes; 0 picks a number based on CPU cores
+  incremental: bool = False # Cache the transcription of each chunk, so edited files only re-transcribe the chunks that changed
   # transcribe() parameters
   language: Optional[str] = None
   condition_on_previous_text: bool = True
-  vad_options: Optional[VadOptions] = None
+  vad_options: Optional[Union['VadOptions', dict]] = None # Only speech found with these VAD settings is transcribed (see speech.py)
   hallucination_silence_threshold: Optional[float] = None
   hotwords: list[str] = []
 
-def transcribe(input_file: str, options: TranscribeOptions, ignore_cache: bool = False) -> list[Segment]:
-  """Transcribes the given input file using the specified Whisper model and settings."""
-  # Setup kwargs for cache search
-  model_kwargs = dict(
-    model_size_or_path=options.model,
-    device=options.device,
-    compute_type=options.compute_type,
-  )
-  transcribe_kwargs = dict(
-    language=options.language,
-    condition_on_previous_text=options.condition_on_previous_text,
-    vad_filter=options.vad_options is not None,
-    vad_parameters=options.vad_options,
-    hallucination_silence_threshold=options.hallucination_silence_threshold,
-    hotwords=' '.join(options.hotwords) if len(options.hotwords) > 0 else None,
-    word_timestamps=True,
-  )
+def transcribe(input_file: str, options: TranscribeOptions, ignore_cache: bool = False, fast_hash: bool = False,
+               cache_key: Optional[tuple[str, dict]] = None, model_loader: Optional[Callable[[], 'WhisperModel']] = None,
+               audio_loader: Optional[Callable[[], Any]] = None,
+               on_speech_map: Optional[Callable[['speech.SpeechMap'], None]] = None) -> Sequence[Segment]:
+  """
+  Transcribes the given input file using the specified Whisper model and settings.
+  A precomputed cache key (from get_cache_key) can be given to skip hashing the file, and a model loader can be given
+  to share one model between several transcriptions. If fast_hash is set, the input file is identified in the cache by a
+  non-cryptographic fingerprint instead of its SHA-1 hash. An audio loader (e.g., DecodedAudio.get_model_audio) can be given to
+  provide already decoded 16 kHz samples, which are then only decoded if a transcription is actually needed.
+  If VAD options are set, on_speech_map is called with the speech map of the input (e.g., to limit muting to speech), as
+  long as one was found or cached for it. If the audio loader is a method of an object with a cancel method (like DecodedAudio),
+  a decode that was started in the background is stopped once the transcription is found in the cache. cancel should return
+  whether the decode can still be stopped.
+  """
+  # If the file has to be read to hash it and doesn't look like it's in the cache, load the model and decode the audio meanwhile
+  prefetch = None
+  if ignore_cache or (cache_key is None and not transcription_cache.is_probably_cached(input_file, _get_cache_settings(options), fast_hash)):
+    prefetch = _TranscriptionPrefetch(options, model_loader, audio_loader)
+    model_loader, audio_loader = prefetch.model_loader, prefetch.audio_loader
 
   # Check cache
-  cache_key = _get_cache_key(input_file, dict(
-    model_kwargs=model_kwargs,
-    transcribe_kwargs=transcribe_kwargs,
-  ))
+  if cache_key is None:
+    with profiling.stage("hash", file=input_file):
+      cache_key = get_cache_key(input_file, options, fast_hash)
   if not ignore_cache:
-    cached = _get_cached_transcription(cache_key)
+    with profiling.stage("cache_lookup", file=input_file):
+      cached = transcription_cache.get_cached_transcription(cache_key)
     if cached is not None:
-      print("Found cached transcription")
-      return cached
-  
-  # Prepare model and segments generator
-  model = WhisperModel(
-    cpu_threads=options.cpu_threads,
-    **model_kwargs
-  )
-  segments_generator, info = model.transcribe(
-    audio=input_file,
-    **transcribe_kwargs
-  )
+      return _use_cached_transcription(cached, input_file, options, fast_hash, prefetch, on_speech_map)
+
+  # Hold the cache entry's lock while transcribing, so other processes that want the same transcription wait for this one
+  with transcription_cache.lock_entry(cache_key) as waited:
+    if waited and not ignore_cache:
+      with profiling.stage("cache_lookup", file=input_file):
+        cached = transcription_cache.get_cached_transcription(cache_key)
+      if cached is not None:
+        return _use_cached_transcription(cached, input_file, options, fast_hash, prefetch, on_speech_map)
+
+    # Save segments as they are transcribed, so an interrupted transcription can be resumed
+    partial = transcription_cache.PartialTranscription(cache_key, resume=not ignore_cache)
+    try:
+      if partial.segment_count > 0:
+        print(f"Resuming transcription from {partial.resume_time:.1f} seconds")
+      start_time = partial.resume_time
+      with profiling.stage("transcription", file=input_file, model=options.model) as stage:
+        for segment in _transcribe_uncached(input_file, options, model_loader, audio_loader, start_time, fast_hash, on_speech_map):
+          partial.append(segment._replace(id=partial.segment_count + 1))
+          stage["audio_seconds"] = segment.end - start_time
+      segments = partial.load_segments()
+    finally:
+      partial.close()
+
+    # Cache result
+    with profiling.stage("cache_save", file=input_file):
+      transcription_cache.cache_transcription(cache_key, segments)
+    partial.remove()
+
+  return segments
+
+def _use_cached_transcription(cached: Sequence[Segment], input_file: str, options: TranscribeOptions, fast_hash: bool,
+                              prefetch: Optional['_TranscriptionPrefetch'],
+                              on_speech_map: Optional[Callable[['speech.SpeechMap'], None]]) -> Sequence[Segment]:
+  """Stops any prefetching once a transcription is found in the cache, and reports the speech map it was made from."""
+  print("Found cached transcription")
+  if prefetch is not None:
+    prefetch.cancel()
+  if on_speech_map is not None:
+    speech_map = speech.get_cached_speech_map(input_file, options.vad_options, fast_hash)
+    if speech_map is not None:
+      on_speech_map(speech_map)
+  return cached
+
+class _Prefetch:
+  """
+  Runs a function on a background thread, so that it overlaps with other work. The thread is a daemon thread, so a prefetch
+  whose result turns out not to be needed (e.g., a model load after a cache hit) doesn't keep the process alive.
+  If the prefetch is cancelled before the thread gets to run the function, the function isn't run at all.
+  """
+
+  def __init__(self, name: str, function: Callable[[], Any]):
+    self._function = function
+    self._cancelled = threading.Event()
+    self._done = threading.Event()
+    self._result = None
+    self._error: Optional[BaseException] = None
+    threading.Thread(target=self._run, name=name, daemon=True).start()
+
+  def _run(self):
+    try:
+      if not self._cancelled.is_set():
+        self._result = self._function()
+    except BaseException as e:
+      self._error = e
+    finally:
+      self._function = None
+      self._done.set()
+
+  def wait(self, timeout: float) -> bool:
+    return self._done.wait(timeout)
+
+  def result(self):
+    self._done.wait()
+    if self._error is not None:
+      raise self._error
+    return self._result
+
+  def cancel(self):
+    self._cancelled.set()
+
+class _TranscriptionPrefetch:
+  """
+  Loads the Whisper model and decodes the audio of an input in the background while the cache is checked. Only the work that
+  the transcription would do itself is prefetched: the model isn't loaded if the transcription will be chunked (each worker
+  process loads its own) or sent to a running model server, and the audio is only decoded if an audio loader is given.
+  model_loader and audio_loader wait for the prefetched results, and are the original loaders for anything not prefetched.
+  """
+
+  def __init__(self, options: TranscribeOptions, model_loader: Optional[Callable[[], 'WhisperModel']],
+               audio_loader: Optional[Callable[[], Any]]):
+    self._model: Optional[_Prefetch] = None
+    self._audio: Optional[_Prefetch] = None
+    self.model_loader = model_loader
+    self.audio_loader = audio_loader
+    self._cancel_audio: Optional[Callable[[], None]] = getattr(getattr(audio_loader, "__self__", None), "cancel", None)
+    if audio_loader is not None:
+      self._audio = _Prefetch("decode", audio_loader)
+      self.audio_loader = self._audio.result
+    chunked = options.processes != 1 or options.incremental
+    server_running = model_loader is None and options.vad_options is None and model_server.is_running()
+    if not chunked and not server_running:
+      def load():
+        with profiling.stage("model_load", model=options.model, prefetch=True):
+          return model_loader() if model_loader is not None else load_model(options)
+      self._model = _Prefetch("model_load", load)
+      self.model_loader = self._model.result
+
+  def cancel(self):
+    """
+    Stops the prefetching. A model load that hasn't started yet is skipped and a running decode is stopped, if the audio
+    loader supports that. A model load that is already running finishes in the background and is discarded.
+    """
+    for prefetch in (self._model, self._audio):
+      if prefetch is not None:
+        prefetch.cancel()
+    if self._audio is not None and self._cancel_audio is not None:
+      # The decode may be about to start, so keep trying to stop it until the prefetch thread is done with it
+      while self._cancel_audio() and not self._audio.wait(0.01):
+        pass
+    self._model = None
+    self._audio = None
+    self.model_loader = None
+    self.audio_loader = None
+
+def transcribe_two_pass(input_file: str, options: TranscribeOptions, coarse_model: str, filters: 'FilterSet', context: float = 2.0,
+                        ignore_cache: bool = False, fast_hash: bool = False, model_loader: Optional[Callable[[], 'WhisperModel']] = None,
+                        audio_loader: Optional[Callable[[], Any]] = None,
+                        coarse_model_loader: Optional[Callable[[], 'WhisperModel']] = None,
+                        on_speech_map: Optional[Callable[['speech.SpeechMap'], None]] = None) -> list[Segment]:
+  """
+  Transcribes the given input file with a fast, less accurate model first, and then transcribes only the audio around words
+  that (nearly) match the filters again with the model in the given options. Returns the transcription of the whole file,
+  where words near possible matches come from the accurate model and all other words come from the fast model.
+  Both passes are cached: the fast pass like any other transcription, and the accurate pass by the audio of each window.
+  Loaders can be given for both models, to share them between the files of a batch. on_speech_map is called as in transcribe.
+  """
+  from filters import TimeSegment, find_time_segments_to_filter
+
+  coarse_segments = transcribe(input_file, options._replace(model=coarse_model), ignore_cache=ignore_cache, fast_hash=fast_hash,
+                               model_loader=coarse_model_loader, audio_loader=audio_loader, on_speech_map=on_speech_map)
+  duration = max((s.end for s in coarse_segments), default=0.0)
+
+  # Re-transcribe a window of context around each candidate, so the accurate model hears whole phrases
+  windows: list[TimeSegment] = []
+  for candidate in find_time_segments_to_filter(coarse_segments, filters, fuzzy=True):
+    window = TimeSegment(max(candidate.start - context, 0.0), candidate.end + context)
+    if len(windows) > 0 and window.start <= windows[-1].end:
+      windows[-1].end = max(windows[-1].end, window.end)
+    else:
+      windows.append(window)
+  fine_duration = sum(w.end - w.start for w in windows)
+  print(f"Found {len(windows)} windows with possible matches, {fine_duration:.1f} of {duration:.1f} seconds of audio")
+
+  fine_segments: list[Segment] = []
+  if len(windows) > 0:
+    audio = audio_loader() if audio_loader is not None else _decode_audio(input_file)
+    model_kwargs, transcribe_kwargs = _get_kwargs(options)
+    cache_settings = dict(model_kwargs=model_kwargs, transcribe_kwargs=transcribe_kwargs)
+    model = None
+    for window in tqdm(windows, desc="Transcribing windows", unit=" windows"):
+      window_audio = audio[int(window.start * _SAMPLING_RATE):int(window.end * _SAMPLING_RATE)]
+      key = transcription_cache.get_chunk_cache_key(window_audio.tobytes(), cache_settings)
+      segments = transcription_cache.get_cached_transcription(key) if not ignore_cache else None
+      if segments is None:
+        if model is None:
+          model = model_loader() if model_loader is not None else load_model(options)
+        segments = list(transcribe_audio(model, window_audio, options))
+        transcription_cache.cache_chunk_transcription(key, segments)
+      fine_segments += [offset_segment(s, window.start) for s in segments]
+    if model is not None:
+      transcription_cache.trim()
+
+  # Each word comes from the accurate pass if it's inside a window, and from the fast pass otherwise
+  window_starts = [w.start for w in windows]
+  def in_window(word: Word) -> bool:
+    i = bisect.bisect_right(window_starts, (word.start + word.end) / 2) - 1
+    return i >= 0 and (word.start + word.end) / 2 < windows[i].end
+  merged = [s for s in (_keep_words(s, lambda w: not in_window(w)) for s in coarse_segments) if s is not None]
+  merged += [s for s in (_keep_words(s, in_window) for s in fine_segments) if s is not None]
+  merged.sort(key=lambda s: s.start)
+
+  print(f"Transcribed {duration:.1f} seconds of audio with {coarse_model} and {fine_duration:.1f} seconds " +
+        f"({fine_duration / duration if duration > 0 else 0:.1%}) with {options.model}")
+  return [s._replace(id=i + 1) for i, s in enumerate(merged)]
+
+def _keep_words(segment: Segment, keep: Callable[[Word], bool]) -> Optional[Segment]:
+  """Removes the words that don't satisfy the given predicate from a segment. Returns None if no words are left."""
+  words = [w for w in segment.words or [] if keep(w)]
+  if len(words) == 0:
+    return None
+  if len(words) == len(segment.words):
+    return segment
+  return segment._replace(start=words[0].start, end=words[-1].end, text=''.join(w.word for w in words), words=words)
+
+def _transcribe_uncached(input_file: str, options: TranscribeOptions, model_loader: Optional[Callable[[], 'WhisperModel']],
+                         audio_loader: Optional[Callable[[], Any]],
+                         start_time: float = 0.0, fast_hash: bool = False,
+                         on_speech_map: Optional[Callable[['speech.SpeechMap'], None]] = None) -> Iterator[Segment]:
+  """
+  Transcribes the given input file with Whisper, without checking the cache. Audio before start_time is skipped.
+  If VAD options are set, only the speech in the input's (cached) speech map is sent to the model.
+  """
+  model_kwargs, transcribe_kwargs = _get_kwargs(options)
+  # Chunks are cached with the same settings as whole transcriptions, which include the VAD options
+  cache_settings = dict(model_kwargs=model_kwargs, transcribe_kwargs=transcribe_kwargs) if options.incremental else None
+
+  speech_map = None
+  if options.vad_options is not None:
+    audio = audio_loader() if audio_loader is not None else _decode_audio(input_file)
+    audio_loader = lambda: audio
+    speech_map = speech.get_speech_map(input_file, options.vad_options, audio_loader, fast_hash)
+    print(f"Found {sum(end - start for start, end in speech_map):.1f} of {len(audio) / _SAMPLING_RATE:.1f} seconds of speech")
+    if on_speech_map is not None:
+      on_speech_map(speech_map)
+    # The speech map already did the VAD's work, so faster_whisper doesn't run it again
+    transcribe_kwargs = dict(transcribe_kwargs, vad_filter=False, vad_parameters=None)
+
+  # Prepare model and segments generator, using the model server if one is running (it runs faster_whisper's own VAD, so not with a speech map)
+  chunked = options.processes != 1 or options.incremental
+  server = model_server.connect() if not chunked and model_loader is None and start_time == 0 and speech_map is None else None
+  if chunked:
+    import chunking
+    processes = chunking.get_process_count(options.processes)
+    if processes > 1:
+      print(f"Transcribing in {processes} processes")
+    audio = audio_loader() if audio_loader is not None else input_file
+    segments_generator, duration = chunking.transcribe_in_chunks(audio, model_kwargs, transcribe_kwargs, processes, options.vad_options, start_time,
+                                                                 cache_settings, speech_map)
+  elif server is not None:
+    print("Using model server")
+    try:
+      segments_generator, duration = server.transcribe(input_file, model_kwargs, transcribe_kwargs, options.cpu_threads)
+    except model_server.ModelServerError as e:
+      print(f"Couldn't transcribe with the model server ({e}), loading the model instead")
+      server = None
+  if not chunked and server is None:
+    with profiling.stage("model_load", model=options.model):
+      model = model_loader() if model_loader is not None else load_model(options)
+    audio = audio_loader() if audio_loader is not None else input_file
+    if speech_map is not None:
+      start_sample = int(start_time * _SAMPLING_RATE)
+      timeline = speech.SpeechTimeline(speech_map, start_sample)
+      speech_audio = timeline.collect(audio[start_sample:])
+      segments_generator = iter([])
+      if len(speech_audio) > 0:
+        segments_generator, _ = model.transcribe(audio=speech_audio, **transcribe_kwargs)
+      segments_generator = (offset_segment(timeline.restore_segment(from_whisper_segment(s)), start_sample / _SAMPLING_RATE)
+                            for s in segments_generator)
+      duration = len(audio) / _SAMPLING_RATE
+    else:
+      if start_time > 0:
+        if isinstance(audio, str):
+          audio = _decode_audio(audio)
+        audio = audio[int(start_time * _SAMPLING_RATE):]
+      segments_generator, info = model.transcribe(
+        audio=audio,
+        **transcribe_kwargs
+      )
+      duration = info.duration + start_time
+      if start_time > 0:
+        segments_generator = (offset_segment(from_whisper_segment(s), start_time) for s in segments_generator)
   
   # Transcribe audio
   # https://github.com/SYSTRAN/faster-whisper/issues/80#issuecomment-1502174272
-  total_duration = round(info.duration, 2)
-  segments = []
-  with tqdm(desc="Transcribing audio", total=total_duration, unit=" seconds of audio") as progress:
+  total_duration = round(duration, 2)
+  with tqdm(desc="Transcribing audio", total=total_duration, initial=round(start_time, 2), unit=" seconds of audio") as progress:
     for segment in segments_generator:
       progress.update(segment.end - progress.n)
-      segments.append(segment)
+      yield from_whisper_segment(segment)
     progress.update(total_duration - progress.n)
 
-  # Cache result
-  _cache_transcription(cache_key, segments)
+def load_model(options: TranscribeOptions) -> 'WhisperModel':
+  """Loads the Whisper model specified by the given settings."""
+  from faster_whisper import WhisperModel
+  model_kwargs, _ = _get_kwargs(options)
+  return WhisperModel(
+    cpu_threads=options.cpu_threads,
+    num_workers=options.num_workers,
+    **model_kwargs
+  )
 
-  return segments
+def transcribe_audio(model: 'WhisperModel', audio, options: TranscribeOptions) -> Iterator[Segment]:
+  """Transcribes an array of 16 kHz mono samples with an already loaded model, without caching. Yields segments as they are transcribed."""
+  _, transcribe_kwargs = _get_kwargs(options)
+  segments_generator, _ = model.transcribe(audio=audio, **transcribe_kwargs)
+  for segment in segments_generator:
+    yield from_whisper_segment(segment)
 
-_TRANSCRIPTION_CACHE_DIR = ".transcription_cache"
-
-def _get_file_sha1_digest(path: str) -> str:
-  """Computes the SHA-1 hash of the file at the given path."""
-  sha1 = hashlib.sha1()
-  with open(path, 'rb') as file:
-    while True:
-      b = file.read(1024)
-      if not b:
-        break
-      sha1.update(b)
-  return sha1.hexdigest()
-
-def _get_cache_key(path: str, settings: dict) -> tuple[str, dict]:
-  """Computes the cache key for a given path with the given settings. Returns both a hashkey and a dictionary."""
-  if settings["transcribe_kwargs"]["hotwords"]:
-    new_kwargs = {**settings["transcribe_kwargs"]}
-    new_kwargs["hotwords"] = hashlib.sha1(new_kwargs["hotwords"].encode()).hexdigest()
-    settings["transcribe_kwargs"] = new_kwargs
-  key_dict = dict(
-    input_file_sha1=_get_file_sha1_digest(path),
-    settings=settings
-  )
-  key_hash = hashlib.sha1(json.dumps(key_dict).encode()).hexdigest()
-  return key_hash, key_dict
-
-def _get_cached_transcription(key: tuple[str, dict]) -> list[Segment]:
-  """Attempts to find a cached transcription for a file with the given SHA-1 digest."""
-  key_hash, key_dict = key
-  path = os.path.join(_TRANSCRIPTION_CACHE_DIR, f"{key_hash}.json")
-  if not os.path.isfile(path):
-    return None
+def get_cache_key(input_file: str, options: TranscribeOptions, fast_hash: bool = False) -> tuple[str, dict]:
+  """Computes the transcription cache key for the given input file and settings. The file is only read if it changed since it was last hashed."""
+  return transcription_cache.get_cache_key(input_file, _get_cache_settings(options), fast_hash)
 
-  data = None
-  with open(path) as file:
-    try:
-      data = json.load(file)
-    except json.JSONDecodeError:
-      print("Failed to parse cached transcription")
-      return None
-  
-  if data["key"] != key_dict:
-    return None
+def _get_cache_settings(options: TranscribeOptions) -> dict:
+  model_kwargs, transcribe_kwargs = _get_kwargs(options)
+  settings = dict(
+    model_kwargs=model_kwargs,
+    transcribe_kwargs=transcribe_kwargs,
+  )
+  if options.processes != 1 or options.incremental:
+    # Chunk boundaries can change the transcription slightly
+    settings["chunked"] = True
+  return settings
 
-  try:
-    return serialization.json_to_object(list[Segment], data["segments"])
-  except:
-    print("Failed to parse cached transcription")
-    return None
+def _decode_audio(input_file: str):
+  from faster_whisper.audio import decode_audio
+  return decode_audio(input_file, sampling_rate=_SAMPLING_RATE)
 
-def _cache_transcription(key: tuple[str, dict], segments: list[Segment]):
-  """Saves a transcription to the transcription cache."""
-  key_hash, key_dict = key
-  json_obj = serialization.object_to_json({
-    "key": key_dict,
-    "segments": segments
-  })
-
-  os.makedirs(_TRANSCRIPTION_CACHE_DIR, exist_ok=True)
-  path = os.path.join(_TRANSCRIPTION_CACHE_DIR, f"{key_hash}.json")
-  with open(path, 'w') as file:
-    json.dump(json_obj, file, indent=True)
-  print("Added transcription to cache")
+def _get_kwargs(options: TranscribeOptions) -> tuple[dict, dict]:
+  """Creates the keyword arguments for WhisperModel and WhisperModel.transcribe from the given settings."""
+  model_kwargs = dict(
+    model_size_or_path=options.model,
+    device=options.device,
+    compute_type=options.compute_type,
+  )
+  transcribe_kwargs = dict(
+    language=options.language,
+    condition_on_previous_text=options.condition_on_previous_text,
+    vad_filter=options.vad_options is not None,
+    vad_parameters=speech.get_vad_parameters(options.vad_options) if options.vad_options is not None else None,
+    hallucination_silence_threshold=options.hallucination_silence_threshold,
+    hotwords=' '.join(options.hotwords) if len(options.hotwords) > 0 else None,
+    word_timestamps=True,
+  )
+  return model_kwargs, transcribe_kwargs
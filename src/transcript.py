@@ -0,0 +1,140 @@
+"""
+The transcription data model. This mirrors faster_whisper's Segment and Word types so that code which only works with
+transcriptions (filters, subtitles, the transcription cache) doesn't have to import faster_whisper and its ML stack.
+Transcript is a columnar view of the same data, for code that scans every word of long transcriptions.
+"""
+from array import array
+from collections.abc import Sequence
+from itertools import accumulate
+from typing import NamedTuple, Optional, Union
+
+_FRAMES_PER_SECOND = 100 # Whisper's mel frames, which Segment.seek is measured in
+
+class Word(NamedTuple):
+  start: float
+  end: float
+  word: str
+  probability: float
+
+class Segment(NamedTuple):
+  id: int
+  seek: int
+  start: float
+  end: float
+  text: str
+  tokens: list[int]
+  temperature: float
+  avg_logprob: float
+  compression_ratio: float
+  no_speech_prob: float
+  words: Optional[list[Word]]
+
+def from_whisper_segment(segment) -> Segment:
+  """Converts a segment produced by faster_whisper into a Segment."""
+  return Segment(
+    id=segment.id,
+    seek=segment.seek,
+    start=segment.start,
+    end=segment.end,
+    text=segment.text,
+    tokens=segment.tokens,
+    temperature=segment.temperature,
+    avg_logprob=segment.avg_logprob,
+    compression_ratio=segment.compression_ratio,
+    no_speech_prob=segment.no_speech_prob,
+    words=[Word(w.start, w.end, w.word, w.probability) for w in segment.words] if segment.words is not None else None,
+  )
+
+def offset_segment(segment: Segment, offset: float) -> Segment:
+  """Shifts a segment that was transcribed from part of an audio file back onto the timeline of the whole file."""
+  return segment._replace(
+    seek=segment.seek + round(offset * _FRAMES_PER_SECOND),
+    start=segment.start + offset,
+    end=segment.end + offset,
+    words=[w._replace(start=w.start + offset, end=w.end + offset) for w in segment.words] if segment.words is not None else None,
+  )
+
+class Transcript:
+  """
+  A compact, columnar view of the words of a transcription, for code that scans every word (filters, subtitle layout).
+  The start times, end times and probabilities of all words are stored in parallel arrays, and the text of all words in one
+  string with an array of offsets into it, so no Word objects are created to read them. Replacement text for some words
+  (e.g., from filtering) is kept as an overlay on top of the original text instead of copying the transcript.
+  """
+  __slots__ = ('starts', 'ends', 'probabilities', 'text', 'text_offsets', 'segment_offsets', 'segment_avg_logprobs', 'replacements')
+
+  def __init__(self, starts: array, ends: array, probabilities: array, text: str, text_offsets: array, segment_offsets: array,
+               segment_avg_logprobs: array, replacements: Optional[dict[int, str]] = None):
+    self.starts = starts
+    self.ends = ends
+    self.probabilities = probabilities
+    self.text = text # The text of every word, concatenated
+    self.text_offsets = text_offsets # Word i's text is text[text_offsets[i]:text_offsets[i + 1]]
+    self.segment_offsets = segment_offsets # Segment i's words are words segment_offsets[i] to segment_offsets[i + 1] - 1
+    self.segment_avg_logprobs = segment_avg_logprobs
+    self.replacements = replacements if replacements is not None else {}
+
+  @classmethod
+  def from_segments(cls, segments: Sequence[Segment]) -> 'Transcript':
+    """Creates a transcript from a list of segments."""
+    words = [word for segment in segments for word in segment.words or []]
+    texts = [word.word for word in words]
+    return cls(
+      starts=array('d', (word.start for word in words)),
+      ends=array('d', (word.end for word in words)),
+      probabilities=array('d', (word.probability for word in words)),
+      text=''.join(texts),
+      text_offsets=array('i', accumulate((len(t) for t in texts), initial=0)),
+      segment_offsets=array('i', accumulate((len(segment.words or []) for segment in segments), initial=0)),
+      segment_avg_logprobs=array('d', (segment.avg_logprob for segment in segments)),
+    )
+
+  def __len__(self) -> int:
+    """Returns the number of words in the transcript."""
+    return len(self.starts)
+
+  @property
+  def segment_count(self) -> int:
+    return len(self.segment_avg_logprobs)
+
+  def word_text(self, index: int) -> str:
+    """Returns the text of a word, with any replacement applied."""
+    text = self.replacements.get(index)
+    if text is None:
+      text = self.text[self.text_offsets[index]:self.text_offsets[index + 1]]
+    return text
+
+  def word(self, index: int) -> Word:
+    return Word(self.starts[index], self.ends[index], self.word_text(index), self.probabilities[index])
+
+  def segment_words(self, index: int) -> range:
+    """Returns the indices of the words in a segment."""
+    return range(self.segment_offsets[index], self.segment_offsets[index + 1])
+
+  def with_replacements(self, replacements: dict[int, str]) -> 'Transcript':
+    """Returns a transcript that shares this one's arrays, with the given words' text replaced."""
+    return Transcript(self.starts, self.ends, self.probabilities, self.text, self.text_offsets, self.segment_offsets,
+                      self.segment_avg_logprobs, {**self.replacements, **replacements})
+
+  def segment_word_log_probs(self) -> list[float]:
+    """Returns the average base-10 log probability of the words in each segment, or -inf for segments without words."""
+    import numpy as np
+    with np.errstate(divide='ignore', invalid='ignore'):
+      log_probs = np.log10(np.frombuffer(self.probabilities, dtype=np.float64))
+      sums = np.concatenate(([0.0], np.cumsum(log_probs)))
+      offsets = np.frombuffer(self.segment_offsets, dtype=np.int32)
+      counts = np.diff(offsets)
+      averages = (sums[offsets[1:]] - sums[offsets[:-1]]) / counts
+    return np.where(counts > 0, averages, -np.inf).tolist()
+
+def as_transcript(segments: Union[Sequence[Segment], Transcript]) -> Transcript:
+  """
+  Returns a transcript of the given segments. Segments loaded from the transcription cache are converted directly from
+  their columns, without creating Segment objects.
+  """
+  if isinstance(segments, Transcript):
+    return segments
+  to_transcript = getattr(segments, 'to_transcript', None)
+  if to_transcript is not None:
+    return to_transcript()
+  return Transcript.from_segments(segments)
@@ -0,0 +1,536 @@
+"""
+The transcription cache. This module is deliberately lightweight (no faster_whisper imports) so that a cache hit can be
+served without loading the ML stack.
+"""
+from transcript import Segment
+from strong_typing import serialization
+from collections.abc import Sequence
+from contextlib import contextmanager
+from typing import IO, BinaryIO, Iterator, Optional
+import cache_format
+import hashlib, json, os, threading, time, zlib
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None # File locking isn't available on Windows, so concurrent runs may duplicate work there
+
+# The cache directory can be shared between machines (e.g., on a network filesystem) so that they can reuse each other's results
+_cache_dir = os.environ.get("AUTOMUTE_CACHE_DIR", ".transcription_cache")
+_max_size_bytes: Optional[int] = int(float(os.environ["AUTOMUTE_CACHE_MAX_MB"]) * 1024 * 1024) if "AUTOMUTE_CACHE_MAX_MB" in os.environ else None
+_HASH_INDEX_DIR = "hash_index"
+_LEGACY_HASH_INDEX_NAME = "hash_index.json" # The index used to be a single file, which had to be rewritten for every new file
+_TUNING_PROFILES_NAME = "tuning_profiles.json"
+_HASH_BUFFER_SIZE = 1024 * 1024
+_FINGERPRINT_SAMPLE_SIZE = 1024 * 1024
+_STALE_PARTIAL_SECONDS = 7 * 24 * 60 * 60
+
+def get_file_digest(path: str, fast: bool = False) -> str:
+  """
+  Gets a digest of the contents of the file at the given path. Digests are stored in an index keyed by the file's path, device
+  and inode, along with its size and modification time, so unchanged files don't need to be read again.
+  If fast is set, a non-cryptographic fingerprint is used instead of SHA-1.
+  """
+  digest = _get_indexed_digest(path, fast)
+  if digest is not None:
+    return digest
+
+  entry_name, attributes = _get_index_entry(path, fast)
+  digest = _get_file_fingerprint(path) if fast else _get_file_sha1_digest(path)
+  _save_index_entry(entry_name, dict(**attributes, digest=digest))
+  _save_index_entry(_get_sample_entry_name(path, fast), dict(digest=digest))
+  return digest
+
+def is_probably_cached(path: str, settings: dict, fast_hash: bool = False) -> bool:
+  """
+  Guesses whether a transcription of the file at the given path with the given settings is cached, without reading the
+  whole file. The file's digest is looked up in the index, or if the file hasn't been indexed (e.g., when the cache directory
+  is shared with another machine), taken from a file with the same size and first and last megabytes that was hashed before.
+  """
+  digest = _get_indexed_digest(path, fast_hash)
+  if digest is None:
+    digest = _load_json(os.path.join(_HASH_INDEX_DIR, _get_sample_entry_name(path, fast_hash))).get("digest")
+  if digest is None:
+    return False
+  key_hash, _ = _make_cache_key(digest, settings, fast_hash)
+  return os.path.isfile(os.path.join(_cache_dir, f"{key_hash}.bin")) or os.path.isfile(os.path.join(_cache_dir, f"{key_hash}.json"))
+
+def _get_indexed_digest(path: str, fast: bool) -> Optional[str]:
+  entry_name, attributes = _get_index_entry(path, fast)
+  entry = _load_json(os.path.join(_HASH_INDEX_DIR, entry_name))
+  if entry.get("digest") is not None and all(entry.get(k) == v for k, v in attributes.items()):
+    return entry["digest"]
+  return None
+
+def _get_index_entry(path: str, fast: bool) -> tuple[str, dict]:
+  """
+  Returns the name of a file's entry in the digest index, and the file attributes that have to match for its digest to be reused.
+  Each file has its own small entry, so looking up or adding a digest doesn't depend on how many files have been indexed.
+  """
+  stat = os.stat(path)
+  index_key = f"{'fast' if fast else 'sha1'}:{stat.st_dev}:{stat.st_ino}:{os.path.abspath(path)}"
+  entry_name = f"{hashlib.sha1(index_key.encode()).hexdigest()}.json"
+  return entry_name, dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+def _get_sample_entry_name(path: str, fast: bool) -> str:
+  """Returns the name of the digest index entry for files with the same size and first and last megabytes as the given one."""
+  with open(path, 'rb') as file:
+    sample = _get_content_sample(file)
+  index_key = f"{'fast' if fast else 'sha1'}:sample:{sample}"
+  return f"{hashlib.sha1(index_key.encode()).hexdigest()}.json"
+
+def _save_index_entry(entry_name: str, entry: dict):
+  """
+  Adds an entry to the digest index. The entry is also listed under its digest, so it can be dropped once the cached
+  transcriptions of that file are evicted.
+  """
+  _save_json(os.path.join(_HASH_INDEX_DIR, entry_name), entry)
+  with open(os.path.join(_cache_dir, _HASH_INDEX_DIR, f"{entry['digest']}.refs"), 'a') as file:
+    file.write(entry_name + "\n")
+  try:
+    os.remove(os.path.join(_cache_dir, _LEGACY_HASH_INDEX_NAME))
+  except FileNotFoundError:
+    pass
+
+def _drop_index_entries(digest: str):
+  """Removes the digest index entries that are listed under the given digest."""
+  refs_path = os.path.join(_cache_dir, _HASH_INDEX_DIR, f"{digest}.refs")
+  try:
+    with open(refs_path) as file:
+      entry_names = set(file.read().split())
+    os.remove(refs_path)
+  except FileNotFoundError:
+    return
+  for entry_name in entry_names:
+    entry_path = os.path.join(_cache_dir, _HASH_INDEX_DIR, entry_name)
+    # The file may have changed and been indexed again with a different digest since it was listed
+    if _load_json(os.path.join(_HASH_INDEX_DIR, entry_name)).get("digest") == digest:
+      try:
+        os.remove(entry_path)
+      except FileNotFoundError:
+        pass
+
+def _get_file_sha1_digest(path: str) -> str:
+  """Computes the SHA-1 hash of the file at the given path."""
+  sha1 = hashlib.sha1()
+  buffer = memoryview(bytearray(_HASH_BUFFER_SIZE))
+  with open(path, 'rb', buffering=0) as file:
+    while True:
+      n = file.readinto(buffer)
+      if not n:
+        break
+      sha1.update(buffer[:n])
+  return sha1.hexdigest()
+
+def _get_file_fingerprint(path: str) -> str:
+  """
+  Computes a fast, non-cryptographic fingerprint of the file at the given path: a CRC-32 of the whole file, plus a SHA-1
+  of its size and first and last megabytes.
+  """
+  crc = 0
+  buffer = memoryview(bytearray(_HASH_BUFFER_SIZE))
+  with open(path, 'rb', buffering=0) as file:
+    while True:
+      n = file.readinto(buffer)
+      if not n:
+        break
+      crc = zlib.crc32(buffer[:n], crc)
+    sample = _get_content_sample(file)
+  return f"{crc:08x}{sample}"
+
+def _get_content_sample(file: BinaryIO) -> str:
+  """Computes a SHA-1 hash of the size and first and last megabytes of an open file."""
+  size = file.seek(0, os.SEEK_END)
+  file.seek(0)
+  head = file.read(_FINGERPRINT_SAMPLE_SIZE)
+  file.seek(max(size - _FINGERPRINT_SAMPLE_SIZE, 0))
+  tail = file.read(_FINGERPRINT_SAMPLE_SIZE)
+  return hashlib.sha1(str(size).encode() + head + tail).hexdigest()
+
+def get_tuning_profile(key: str) -> Optional[dict]:
+  """Gets the stored tuning profile (see tuning.py) with the given key, or None if there isn't one."""
+  return _load_json(_TUNING_PROFILES_NAME).get(key)
+
+def save_tuning_profile(key: str, profile: dict):
+  """Stores a tuning profile under the given key, replacing any previous profile with that key."""
+  with _lock_file(_TUNING_PROFILES_NAME):
+    profiles = _load_json(_TUNING_PROFILES_NAME)
+    profiles[key] = profile
+    _save_json(_TUNING_PROFILES_NAME, profiles)
+
+def _load_json(name: str) -> dict:
+  """Loads a JSON object from the cache directory. Returns an empty object if it doesn't exist or can't be read."""
+  try:
+    with open(os.path.join(_cache_dir, name)) as file:
+      return json.load(file)
+  except (OSError, json.JSONDecodeError):
+    return {}
+
+def _save_json(name: str, data: dict):
+  """Saves a JSON object to the cache directory, replacing the old one atomically."""
+  with open(_get_temp_path(name), 'w') as file:
+    json.dump(data, file)
+  os.replace(file.name, os.path.join(_cache_dir, name))
+
+def get_cache_key(path: str, settings: dict, fast_hash: bool = False) -> tuple[str, dict]:
+  """Computes the cache key for a given path with the given settings. Returns both a hashkey and a dictionary."""
+  return _make_cache_key(get_file_digest(path, fast_hash), settings, fast_hash)
+
+def _make_cache_key(digest: str, settings: dict, fast_hash: bool) -> tuple[str, dict]:
+  if fast_hash:
+    key_dict = dict(input_file_fingerprint=digest, settings=_normalize_settings(settings))
+  else:
+    key_dict = dict(input_file_sha1=digest, settings=_normalize_settings(settings))
+  key_hash = hashlib.sha1(json.dumps(key_dict).encode()).hexdigest()
+  return key_hash, key_dict
+
+def get_chunk_cache_key(audio: bytes, settings: dict) -> tuple[str, dict]:
+  """
+  Computes the cache key for a chunk of decoded audio with the given settings. Returns both a hashkey and a dictionary.
+  The key is a hash of the raw samples, so a chunk is only reused if its decoded audio is bit-identical. Re-encoding the input,
+  changing its volume or decoding it with a different ffmpeg version or resampler changes every chunk's key.
+  """
+  key_dict = dict(
+    audio_chunk_sha1=hashlib.sha1(audio).hexdigest(),
+    settings=_normalize_settings(settings)
+  )
+  key_hash = hashlib.sha1(json.dumps(key_dict).encode()).hexdigest()
+  return key_hash, key_dict
+
+def _normalize_settings(settings: dict) -> dict:
+  """Replaces any hotwords in the settings with their hash, to keep cache keys short."""
+  if "transcribe_kwargs" in settings and settings["transcribe_kwargs"]["hotwords"]:
+    new_kwargs = {**settings["transcribe_kwargs"]}
+    new_kwargs["hotwords"] = hashlib.sha1(new_kwargs["hotwords"].encode()).hexdigest()
+    settings = {**settings, "transcribe_kwargs": new_kwargs}
+  return settings
+
+def get_cached_transcription(key: tuple[str, dict]) -> Optional[Sequence[Segment]]:
+  """
+  Attempts to find a cached transcription for a file with the given SHA-1 digest.
+  Entries in the old JSON format are converted to the binary format when they are found.
+  """
+  key_hash, key_dict = key
+  path = os.path.join(_cache_dir, f"{key_hash}.bin")
+  if not os.path.isfile(path):
+    return _migrate_json_transcription(key)
+
+  try:
+    with open(path, 'rb') as file:
+      data = file.read()
+  except FileNotFoundError:
+    return None # Evicted by another process
+  try:
+    os.utime(path) # Entries are evicted in order of their modification times
+  except OSError:
+    pass # The cache is read-only (e.g., shared by another user), or the entry was just evicted
+
+  try:
+    cached_key, segments = cache_format.decode_transcription(data)
+  except (cache_format.FormatError, ValueError, KeyError, zlib.error):
+    print("Failed to parse cached transcription")
+    return None
+
+  if cached_key != key_dict:
+    return None
+  return segments
+
+def cache_transcription(key: tuple[str, dict], segments: Sequence[Segment]):
+  """Saves a transcription to the transcription cache, then trims the cache (see trim)."""
+  path = _save_entry(key, segments)
+  print("Added transcription to cache")
+  _evict_entries(_max_size_bytes, path)
+
+def cache_chunk_transcription(key: tuple[str, dict], segments: Sequence[Segment]):
+  """
+  Saves the transcription of a chunk of audio (see get_chunk_cache_key) to the transcription cache. Unlike cache_transcription,
+  this doesn't report or evict anything, since a file can have hundreds of chunks. Call trim once all of them are saved
+  (cache_transcription also trims the cache).
+  """
+  _save_entry(key, segments)
+
+def trim():
+  """
+  Evicts the least recently used entries if the cache is larger than its maximum size, and deletes partial transcriptions that
+  haven't been resumed for a while.
+  """
+  if os.path.isdir(_cache_dir):
+    _evict_entries(_max_size_bytes, None)
+
+def _save_entry(key: tuple[str, dict], segments: Sequence[Segment]) -> str:
+  """Writes a transcription to the cache atomically. Returns the path of the entry."""
+  key_hash, key_dict = key
+  data = cache_format.encode_transcription(key_dict, segments)
+
+  with open(_get_temp_path(f"{key_hash}.bin"), 'wb') as file:
+    file.write(data)
+  path = os.path.join(_cache_dir, f"{key_hash}.bin")
+  os.replace(file.name, path)
+  return path
+
+class PartialTranscription:
+  """
+  A transcription that is still in progress. Segments are appended to a file in the cache as they are transcribed, so an
+  interrupted transcription can be resumed from its last segment instead of starting over.
+  """
+
+  def __init__(self, key: tuple[str, dict], resume: bool = True):
+    key_hash, self._key_dict = key
+    self._path = os.path.join(_cache_dir, f"{key_hash}.partial")
+    self.segment_count = 0
+    self.resume_time = 0.0
+    if resume:
+      self._load()
+    if self.segment_count == 0:
+      with open(_get_temp_path(f"{key_hash}.partial"), 'w') as file:
+        file.write(json.dumps(dict(key=self._key_dict)) + "\n")
+      os.replace(file.name, self._path)
+    self._file = open(self._path, 'a')
+
+  def append(self, segment: Segment):
+    """Saves a newly transcribed segment."""
+    data = serialization.object_to_json(segment)
+    data.setdefault("words", None) # The serializer leaves out words that are None, but the deserializer requires them
+    self._file.write(json.dumps(data) + "\n")
+    self._file.flush()
+    self.segment_count += 1
+    self.resume_time = segment.end
+
+  def load_segments(self) -> list[Segment]:
+    """Loads all of the segments that have been saved."""
+    self._file.flush()
+    with open(self._path) as file:
+      file.readline()
+      return [serialization.json_to_object(Segment, json.loads(line)) for line in file]
+
+  def close(self):
+    self._file.close()
+
+  def remove(self):
+    """Deletes the partial transcription, e.g., once the complete transcription has been cached."""
+    self.close()
+    os.remove(self._path)
+
+  def _load(self):
+    """Reads the segments saved by an earlier, interrupted run. Anything after the last complete segment is discarded."""
+    try:
+      file = open(self._path, 'r+')
+    except FileNotFoundError:
+      return
+    with file:
+      try:
+        if json.loads(file.readline())["key"] != self._key_dict:
+          return
+      except (json.JSONDecodeError, KeyError):
+        return
+      valid_length = file.tell()
+      for line in iter(file.readline, ''):
+        if not line.endswith("\n"):
+          break
+        try:
+          segment = serialization.json_to_object(Segment, json.loads(line))
+        except Exception:
+          break
+        self.segment_count += 1
+        self.resume_time = segment.end
+        valid_length = file.tell()
+      file.truncate(valid_length)
+
+def get_cached_speech_map(key: tuple[str, dict]) -> Optional[list[tuple[float, float]]]:
+  """Attempts to find a cached speech map (see speech.py) with the given key."""
+  key_hash, key_dict = key
+  try:
+    with open(os.path.join(_cache_dir, f"{key_hash}.speech.json")) as file:
+      data = json.load(file)
+  except (OSError, json.JSONDecodeError):
+    return None
+  if data["key"] != key_dict:
+    return None
+  return [(start, end) for start, end in data["speech"]]
+
+def cache_speech_map(key: tuple[str, dict], speech_map: list[tuple[float, float]]):
+  """Caches a speech map. Speech maps are small, so they are stored as JSON and not counted towards the cache size limit."""
+  key_hash, key_dict = key
+  name = f"{key_hash}.speech.json"
+  _save_json(name, dict(key=key_dict, speech=speech_map))
+
+def _migrate_json_transcription(key: tuple[str, dict]) -> Optional[list[Segment]]:
+  """Loads a transcription cached in the old JSON format, and replaces it with one in the binary format."""
+  key_hash, key_dict = key
+  path = os.path.join(_cache_dir, f"{key_hash}.json")
+  if not os.path.isfile(path):
+    return None
+
+  data = None
+  with open(path) as file:
+    try:
+      data = json.load(file)
+    except json.JSONDecodeError:
+      print("Failed to parse cached transcription")
+      return None
+  
+  if data["key"] != key_dict:
+    return None
+
+  try:
+    segments = serialization.json_to_object(list[Segment], data["segments"])
+  except:
+    print("Failed to parse cached transcription")
+    return None
+
+  cache_transcription(key, segments)
+  os.remove(path)
+  return segments
+
+def configure(cache_dir: Optional[str] = None, max_size_mb: Optional[float] = None):
+  """
+  Changes where the transcription cache is stored and how large it can grow before the least recently used entries are evicted.
+  These default to the AUTOMUTE_CACHE_DIR and AUTOMUTE_CACHE_MAX_MB environment variables.
+  """
+  global _cache_dir, _max_size_bytes
+  if cache_dir is not None:
+    _cache_dir = cache_dir
+  if max_size_mb is not None:
+    _max_size_bytes = int(max_size_mb * 1024 * 1024)
+
+@contextmanager
+def lock_entry(key: tuple[str, dict]) -> Iterator[bool]:
+  """
+  Locks the cache entry with the given key, across threads and processes. Yields whether the lock was held by someone else,
+  in which case the entry may have been added to the cache while waiting.
+  """
+  key_hash, _ = key
+  with _lock_file(f"{key_hash}.bin") as waited:
+    yield waited
+
+@contextmanager
+def _lock_file(name: str) -> Iterator[bool]:
+  """
+  Takes an exclusive lock on a lock file in the cache directory. Yields whether it had to wait for the lock.
+  The lock file is deleted when the lock is released, so lock files don't pile up in the cache.
+  """
+  if fcntl is None:
+    yield False
+    return
+  os.makedirs(_cache_dir, exist_ok=True)
+  path = os.path.join(_cache_dir, f"{name}.lock")
+  file, waited = _open_locked(path, blocking=True)
+  try:
+    yield waited
+  finally:
+    _release_lock(path, file)
+
+def _open_locked(path: str, blocking: bool) -> tuple[Optional[IO], bool]:
+  """
+  Opens and locks a lock file. Returns the locked file, or None if blocking is False and the lock is held by someone else, and
+  whether it had to wait for the lock. If the file was deleted by its previous holder in the meantime, the lock is taken again
+  on a new file, since anyone else who opens the path from now on gets the new one.
+  """
+  waited = False
+  while True:
+    file = open(path, 'a')
+    try:
+      fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      if not blocking:
+        file.close()
+        return None, False
+      if not waited:
+        print("Waiting for another process to finish with the transcription cache")
+      fcntl.flock(file, fcntl.LOCK_EX)
+      waited = True
+    try:
+      if os.stat(path).st_ino == os.fstat(file.fileno()).st_ino:
+        return file, waited
+    except FileNotFoundError:
+      pass
+    file.close()
+
+def _release_lock(path: str, file: IO):
+  # The file is deleted before it's unlocked, so whoever gets the lock next notices that it has to lock a new file
+  try:
+    os.remove(path)
+  except FileNotFoundError:
+    pass
+  fcntl.flock(file, fcntl.LOCK_UN)
+  file.close()
+
+def _get_temp_path(name: str) -> str:
+  """Creates a path for a temporary file in the cache directory, which can be renamed over the given file once it is complete."""
+  path = os.path.join(_cache_dir, f"{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  return path
+
+def _evict_entries(max_size_bytes: Optional[int], keep_path: Optional[str]):
+  """
+  Deletes the least recently used cache entries, except for the given one (if any), until the cache is no larger than the given
+  size. Partial transcriptions count toward the size like other entries, and are deleted regardless of the size once they haven't
+  been resumed for a while. Neither they nor lock files are touched while someone holds their lock.
+  The digest index entries of the files whose transcriptions are deleted are dropped too.
+  """
+  entries = []
+  now = time.time()
+  for entry in os.scandir(_cache_dir):
+    if entry.name.endswith(".lock"):
+      _remove_unlocked(entry.path, entry.path)
+      continue
+    if not entry.name.endswith((".bin", ".partial")):
+      continue
+    try:
+      stat = entry.stat()
+    except FileNotFoundError:
+      continue
+    if entry.name.endswith(".partial") and now - stat.st_mtime > _STALE_PARTIAL_SECONDS:
+      if _remove_partial(entry.path):
+        continue
+    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+  if max_size_bytes is None:
+    return
+
+  total_size = sum(size for _, size, _ in entries)
+  for _, size, path in sorted(entries):
+    if total_size <= max_size_bytes:
+      break
+    if path == keep_path:
+      continue
+    if path.endswith(".partial"):
+      if _remove_partial(path):
+        total_size -= size
+      continue
+    digest = _get_input_digest(path)
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
+    total_size -= size
+    if digest is not None:
+      _drop_index_entries(digest)
+
+def _remove_partial(path: str) -> bool:
+  """Deletes a partial transcription, unless a transcription that is still running holds its entry's lock. Returns whether it was deleted."""
+  return _remove_unlocked(path, f"{path[:-len('.partial')]}.bin.lock")
+
+def _remove_unlocked(path: str, lock_path: str) -> bool:
+  """Deletes a file if no one holds the given lock, taking the lock while deleting it. Returns whether the file was deleted."""
+  if fcntl is None:
+    return False # Without locks, there's no telling whether the file is still in use
+  file, _ = _open_locked(lock_path, blocking=False)
+  if file is None:
+    return False
+  try:
+    if path != lock_path:
+      os.remove(path)
+  except FileNotFoundError:
+    pass
+  finally:
+    _release_lock(lock_path, file)
+  return True
+
+def _get_input_digest(path: str) -> Optional[str]:
+  """Reads the digest of the input file from the key of a cache entry. Returns None for entries of audio chunks."""
+  try:
+    with open(path, 'rb') as file:
+      key_dict = cache_format.read_key(file)
+  except (OSError, cache_format.FormatError, ValueError):
+    return None
+  return key_dict.get("input_file_sha1") or key_dict.get("input_file_fingerprint")
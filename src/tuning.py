@@ -0,0 +1,125 @@
+"""
+Auto-tuning of the settings that only affect how fast the Whisper model runs on a machine: the number of CPU threads, the
+number of workers (transcriptions sharing one model concurrently), and the compute type (quantization).
+Candidate settings are timed on a short sample of the input, and the fastest ones are stored in a per-host profile in the
+cache directory, so that later runs on the same host with the same model reuse them without calibrating again.
+"""
+from transcribe import TranscribeOptions, load_model, transcribe_audio
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+import json, os, platform, profiling, time, transcription_cache
+
+_SAMPLING_RATE = 16000
+_SAMPLE_SECONDS = 20
+_WORKER_COUNTS = [1, 2, 4]
+_CPU_COMPUTE_TYPES = ['int8', 'int8_float32', 'float32']
+_CUDA_COMPUTE_TYPES = ['float16', 'int8_float16', 'int8', 'float32']
+
+class TuningProfile(NamedTuple):
+  cpu_threads: int
+  num_workers: int
+  compute_type: str
+  real_time_factor: float # Seconds of transcription per second of audio, for the sample the settings were chosen on
+
+def tune_options(options: TranscribeOptions, input_file: str, cpu_threads: Optional[int] = None, num_workers: Optional[int] = None,
+                 compute_type: Optional[str] = None, recalibrate: bool = False) -> TranscribeOptions:
+  """
+  Returns the given options with the thread count, worker count and compute type that transcribe fastest on this host.
+  Settings that are given are kept as they are, and only the others are tuned. The stored profile for this host, model and
+  fixed settings is used if there is one; otherwise (or if recalibrate is set) the candidates are timed on a sample of the input.
+  Chunked transcriptions divide the CPU cores between their processes themselves, so only their compute type is tuned.
+  """
+  if options.processes != 1 or options.incremental:
+    cpu_threads = cpu_threads or options.cpu_threads
+    num_workers = 1
+  # Profiles are keyed on the requested device, so reusing one doesn't need ctranslate2 to find out which device 'auto' means
+  key = _get_profile_key(options.model, options.device, cpu_threads, num_workers, compute_type)
+
+  stored = transcription_cache.get_tuning_profile(key) if not recalibrate else None
+  if stored is not None:
+    profile = TuningProfile(**stored)
+  else:
+    with profiling.stage("auto_tune", file=input_file, model=options.model):
+      profile = _calibrate(options._replace(device=_get_device(options.device)), input_file, cpu_threads, num_workers, compute_type)
+    transcription_cache.save_tuning_profile(key, profile._asdict())
+  print(f"Using {profile.cpu_threads} threads, {profile.num_workers} workers and {profile.compute_type} computation " +
+        f"({profile.real_time_factor:.3f} seconds per second of audio when tuned)")
+  return options._replace(cpu_threads=profile.cpu_threads, num_workers=profile.num_workers, compute_type=profile.compute_type)
+
+def _calibrate(options: TranscribeOptions, input_file: str, cpu_threads: Optional[int], num_workers: Optional[int],
+               compute_type: Optional[str]) -> TuningProfile:
+  """
+  Times candidate settings on a sample of the input. Rather than timing every combination, each setting is tuned in turn
+  with the best of the ones before it: the compute type, then the thread count, then the worker count.
+  """
+  print("Tuning transcription settings for this machine")
+  sample = _get_sample(input_file)
+  cpu_count = os.cpu_count() or 1
+  timings: dict[tuple[int, int, str], float] = {}
+  def measure(threads: int, workers: int, compute: str) -> float:
+    if (threads, workers, compute) not in timings:
+      timings[threads, workers, compute] = _time_settings(options._replace(cpu_threads=threads, num_workers=workers, compute_type=compute), sample)
+      print(f"  {threads} threads, {workers} workers, {compute}: {timings[threads, workers, compute]:.3f} seconds per second of audio")
+    return timings[threads, workers, compute]
+
+  threads = cpu_threads or (options.cpu_threads if options.device == 'cuda' else cpu_count)
+  compute_types = [compute_type] if compute_type is not None else _get_compute_types(options.device)
+  compute = min(compute_types, key=lambda c: measure(threads, 1, c))
+
+  # Threads barely matter when the model runs on a GPU
+  if cpu_threads is None and options.device == 'cpu':
+    threads = min(sorted({max(1, cpu_count // d) for d in (4, 2, 1)}), key=lambda t: measure(t, 1, compute))
+
+  workers = 1
+  if num_workers is not None:
+    workers = num_workers
+  else:
+    # Concurrent workers share the CPU cores, so each one gets a share of the threads unless the thread count is fixed
+    worker_threads = lambda w: cpu_threads or max(1, threads // w)
+    workers = min([w for w in _WORKER_COUNTS if w <= cpu_count], key=lambda w: measure(worker_threads(w), w, compute))
+    threads = worker_threads(workers)
+  return TuningProfile(threads, workers, compute, round(measure(threads, workers, compute), 4))
+
+def _time_settings(options: TranscribeOptions, sample) -> float:
+  """Loads the model with the given settings, and returns the seconds it takes per second of audio to transcribe the sample in each worker at once."""
+  model = load_model(options)
+  def run(_):
+    for _ in transcribe_audio(model, sample, options):
+      pass
+  start = time.perf_counter()
+  with ThreadPoolExecutor(options.num_workers) as pool:
+    list(pool.map(run, range(options.num_workers)))
+  return (time.perf_counter() - start) / (len(sample) / _SAMPLING_RATE * options.num_workers)
+
+def _get_sample(input_file: str):
+  """Decodes a sample from the middle of the input, which is more likely to contain speech than its start."""
+  import ffmpeg
+  from decode import decode_sample
+  duration = float(ffmpeg.probe(input_file)["format"]["duration"])
+  start = max(0.0, (duration - _SAMPLE_SECONDS) / 2)
+  return decode_sample(input_file, start, _SAMPLE_SECONDS, _SAMPLING_RATE)
+
+def _get_device(device: str) -> str:
+  if device != 'auto':
+    return device
+  import ctranslate2
+  return 'cuda' if ctranslate2.get_cuda_device_count() > 0 else 'cpu'
+
+def _get_compute_types(device: str) -> list[str]:
+  """Returns the compute types worth timing on the given device, from the ones the device supports."""
+  import ctranslate2
+  supported = ctranslate2.get_supported_compute_types(device)
+  return [c for c in (_CUDA_COMPUTE_TYPES if device == 'cuda' else _CPU_COMPUTE_TYPES) if c in supported]
+
+def _get_profile_key(model: str, device: str, cpu_threads: Optional[int], num_workers: Optional[int], compute_type: Optional[str]) -> str:
+  """Identifies the host (the cache directory may be shared between machines), the model, and any settings that weren't tuned."""
+  return json.dumps(dict(
+    host=platform.node(),
+    machine=platform.machine(),
+    cpu_count=os.cpu_count(),
+    model=model,
+    device=device,
+    cpu_threads=cpu_threads,
+    num_workers=num_workers,
+    compute_type=compute_type,
+  ), sort_keys=True)
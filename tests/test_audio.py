@@ -0,0 +1,77 @@
+from audio import can_mute_in_place, filter_audio, mute_wav_in_place, _probe_packets, _split_at_packets
+from filters import TimeSegment
+import audio, ffmpeg, os, pytest, shutil, struct
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None, reason="ffmpeg is not installed")
+
+def _make_aac_input(path: str, seconds: int):
+  video = ffmpeg.input(f"testsrc=duration={seconds}:rate=1:size=32x32", f="lavfi")
+  sine = ffmpeg.input(f"sine=frequency=440:duration={seconds}", f="lavfi")
+  ffmpeg.run(ffmpeg.output(video, sine, path, vcodec="mpeg4", acodec="aac", loglevel="error"))
+
+@needs_ffmpeg
+def test_filter_audio_with_thousands_of_segments(tmp_path):
+  input_file = os.path.join(tmp_path, "input.mkv")
+  output_file = os.path.join(tmp_path, "output.mkv")
+  video = ffmpeg.input("testsrc=duration=60:rate=1:size=32x32", f="lavfi")
+  audio = ffmpeg.input("sine=frequency=440:duration=60", f="lavfi")
+  ffmpeg.run(ffmpeg.output(video, audio, input_file, vcodec="mpeg4", acodec="pcm_s16le", loglevel="error"))
+
+  # The mute expression for this many segments is far longer than a command line can be
+  segments = [TimeSegment(i * 0.02, i * 0.02 + 0.01) for i in range(3000)]
+  filter_audio(input_file, output_file, segments, (0, 0))
+  assert os.path.getsize(output_file) > 0
+
+def _write_wav(path: str, samples: bytes, header: bytes = b"RIFF", data_size=None, ds64: bool = False, format_tag: int = 1):
+  """Writes 16-bit mono 1 kHz audio, with the given data size in the data chunk header instead of the actual one."""
+  fmt = struct.pack("<HHIIHH", format_tag, 1, 1000, 2000, 2, 16)
+  chunks = b""
+  if ds64:
+    chunks += b"ds64" + struct.pack("<IQQQI", 28, 0, len(samples), len(samples) // 2, 0)
+  chunks += b"fmt " + struct.pack("<I", len(fmt)) + fmt
+  chunks += b"data" + struct.pack("<I", len(samples) if data_size is None else data_size) + samples
+  with open(path, "wb") as file:
+    file.write(header + struct.pack("<I", 0xFFFFFFFF if header == b"RF64" else 4 + len(chunks)) + b"WAVE" + chunks)
+
+@pytest.mark.parametrize("header, data_size, ds64", [
+  (b"RIFF", None, False),
+  (b"RIFF", 0, False), # Streamed, with a placeholder size
+  (b"RIFF", 0xFFFFFFFF, False),
+  (b"RF64", 0xFFFFFFFF, True),
+])
+def test_mute_wav_in_place(tmp_path, header, data_size, ds64):
+  path = os.path.join(tmp_path, "audio.wav")
+  _write_wav(path, struct.pack("<3000h", *([1000] * 3000)), header, data_size, ds64)
+  assert can_mute_in_place(path)
+  assert mute_wav_in_place(path, [TimeSegment(1.0, 2.0), TimeSegment(2.5, 5.0)]) == 1500
+  with open(path, "rb") as file:
+    samples = struct.unpack("<3000h", file.read()[-6000:])
+  assert samples == tuple([1000] * 1000 + [0] * 1000 + [1000] * 500 + [0] * 500)
+
+def test_compressed_wav_cant_be_muted_in_place(tmp_path):
+  path = os.path.join(tmp_path, "audio.wav")
+  _write_wav(path, bytes(100), format_tag=0x55) # MP3 in a WAV file
+  assert not can_mute_in_place(path)
+  with pytest.raises(ValueError):
+    mute_wav_in_place(path, [TimeSegment(0.0, 1.0)])
+
+@needs_ffmpeg
+def test_smart_render_copies_audio_without_segments(tmp_path, capsys):
+  input_file = os.path.join(tmp_path, "input.mp4")
+  output_file = os.path.join(tmp_path, "output.mp4")
+  _make_aac_input(input_file, 5)
+  filter_audio(input_file, output_file, [], (0, 0), smart_render=True)
+  assert "Couldn't" not in capsys.readouterr().out
+  assert _probe_packets(output_file)[1] == _probe_packets(input_file)[1]
+
+@needs_ffmpeg
+def test_split_at_more_packets_than_fit_in_one_run(tmp_path, monkeypatch):
+  input_file = os.path.join(tmp_path, "input.mp4")
+  audio_file = os.path.join(tmp_path, "audio.nut")
+  _make_aac_input(input_file, 5)
+  ffmpeg.run(ffmpeg.output(ffmpeg.input(input_file)["a:0"], audio_file, acodec="copy", loglevel="error"))
+  _, packets = _probe_packets(audio_file)
+  monkeypatch.setattr(audio, "_MAX_SPLIT_CUTS", 4)
+  cuts = list(range(3, len(packets), 7))
+  pieces = _split_at_packets(audio_file, packets, cuts, os.path.join(tmp_path, "piece"))
+  assert [len(_probe_packets(piece)[1]) for piece in pieces] == [end - first for first, end in zip([0] + cuts, cuts + [len(packets)])]
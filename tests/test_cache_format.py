@@ -0,0 +1,37 @@
+from transcript import Segment, Transcript, Word
+import cache_format
+import io, pytest
+
+def _make_segments() -> list[Segment]:
+  words = [Word(0.0, 0.4, " Hello", 0.9), Word(0.4, 1.0, " wörld", 0.75)]
+  return [
+    Segment(1, 0, 0.0, 1.0, " Hello wörld", [50364, 2425, 1002], 0.0, -0.2, 1.1, 0.01, words),
+    Segment(2, 100, 1.0, 2.5, " No words", [883], 0.2, -0.5, 1.3, 0.1, None),
+    Segment(3, 250, 2.5, 2.5, "", [], 0.0, -1.0, 1.0, 0.9, []),
+  ]
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_round_trip(compress):
+  key_dict = dict(input_file_sha1="0" * 40, settings=dict(model="tiny"))
+  segments = _make_segments()
+  data = cache_format.encode_transcription(key_dict, segments, compress=compress)
+
+  decoded_key, decoded = cache_format.decode_transcription(data)
+  assert decoded_key == key_dict
+  assert list(decoded) == segments
+  assert decoded[-1] == segments[-1]
+  assert decoded[1:] == segments[1:]
+  assert cache_format.read_key(io.BytesIO(data)) == key_dict
+
+  transcript = decoded.to_transcript()
+  expected = Transcript.from_segments(segments)
+  assert [transcript.word(i) for i in range(len(transcript))] == [expected.word(i) for i in range(len(expected))]
+  assert transcript.text == expected.text
+  assert list(transcript.segment_offsets) == list(expected.segment_offsets)
+
+def test_rejects_other_files():
+  data = cache_format.encode_transcription({}, _make_segments())
+  with pytest.raises(cache_format.FormatError):
+    cache_format.decode_transcription(b"{}")
+  with pytest.raises(cache_format.FormatError):
+    cache_format.decode_transcription(data[:4] + b"\xff\xff" + data[6:])
@@ -0,0 +1,45 @@
+from decode import DecodeCancelled, DecodedAudio, decode_sample
+import ffmpeg, os, pytest, shutil, threading, time
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+
+@needs_ffmpeg
+def test_decode_first_of_several_audio_tracks(tmp_path):
+  input_file = os.path.join(tmp_path, "input.mkv")
+  first = ffmpeg.input("sine=frequency=440:duration=3", f="lavfi")
+  second = ffmpeg.input("sine=frequency=880:duration=5", f="lavfi")
+  ffmpeg.run(ffmpeg.output(first, second, input_file, acodec="pcm_s16le", loglevel="error"))
+
+  decoded_audio = DecodedAudio(input_file, os.path.join(tmp_path, "decoded"))
+  assert len(decoded_audio.get_model_audio()) == 3 * 16000
+  assert os.path.getsize(decoded_audio.path) > 0
+  assert abs(len(decode_sample(input_file, 1.0, 1.0)) - 16000) < 100
+
+@needs_ffmpeg
+@pytest.mark.skipif(not hasattr(os, "mkfifo"), reason="Named pipes aren't supported")
+def test_cancel_stops_a_running_decode(tmp_path):
+  # ffmpeg blocks reading from the pipe until the decode is cancelled
+  input_file = os.path.join(tmp_path, "input.wav")
+  os.mkfifo(input_file)
+  decoded_audio = DecodedAudio(input_file, os.path.join(tmp_path, "decoded"))
+  errors = []
+  def decode():
+    try:
+      decoded_audio.get_model_audio()
+    except DecodeCancelled as e:
+      errors.append(e)
+  thread = threading.Thread(target=decode)
+  thread.start()
+  while decoded_audio._process is None:
+    time.sleep(0.01)
+  decoded_audio.cancel()
+  thread.join(10)
+  assert not thread.is_alive() and len(errors) == 1
+  assert not decoded_audio.is_decoded
+
+  # Asking for the audio again starts a new decode
+  os.remove(input_file)
+  ffmpeg.run(ffmpeg.output(ffmpeg.input("sine=duration=2", f="lavfi"), input_file, loglevel="error"))
+  assert len(decoded_audio.get_model_audio()) == 2 * 16000
+  decoded_audio.cancel() # Nothing to stop once the audio is decoded
+  assert decoded_audio.is_decoded
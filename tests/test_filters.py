@@ -0,0 +1,63 @@
+from filters import FilterSet, TimeSegment, filter_transcription, find_time_segments_to_filter
+from transcript import Segment, Word
+from cipher import encipher
+
+def _make_transcription(*words: str) -> list[Segment]:
+  """Makes a transcription with one word per second."""
+  word_list = [Word(float(i), i + 0.5, word, 1.0) for i, word in enumerate(words)]
+  return [Segment(0, 0, 0.0, float(len(words)), ''.join(words), [], 0.0, 0.0, 1.0, 0.0, word_list)]
+
+def test_literal_words():
+  transcription = _make_transcription(" Oh", " damn,", " that", " hurt.")
+  segments = find_time_segments_to_filter(transcription, FilterSet([r'\bdamn\b']))
+  assert segments == [TimeSegment(1.0, 1.5)]
+
+def test_literal_phrases_match_across_words():
+  transcription = _make_transcription(" What", " the", " heck", " is", " the", " heck?")
+  segments = find_time_segments_to_filter(transcription, FilterSet([r'\bwhat the heck\b']))
+  assert segments == [TimeSegment(0.0, 2.5)]
+
+def test_wildcard_regexes_stay_within_a_word():
+  transcription = _make_transcription(" Oh", " damn,", " that", " hurt.")
+  segments = find_time_segments_to_filter(transcription, FilterSet(['damn.*']))
+  assert segments == [TimeSegment(1.0, 1.5)]
+
+def test_anchored_regexes_match_single_words():
+  transcription = _make_transcription(" Oh", " damn,", " that", " hurt.")
+  assert find_time_segments_to_filter(transcription, FilterSet(['^damn$'])) == []
+  assert find_time_segments_to_filter(transcription, FilterSet([r'^\s*damn\W*$'])) == [TimeSegment(1.0, 1.5)]
+  assert find_time_segments_to_filter(transcription, FilterSet([r'^ oh$'])) == [TimeSegment(0.0, 0.5)]
+
+def test_enciphered_regexes():
+  transcription = _make_transcription(" Oh", " damn,", " that", " hurt.")
+  segments = find_time_segments_to_filter(transcription, FilterSet([encipher('damn') + '.*', r'\b' + encipher('hurt') + r'\b'], enciphered=True))
+  assert segments == [TimeSegment(1.0, 1.5), TimeSegment(3.0, 3.5)]
+
+def test_filter_transcription_replaces_within_words():
+  transcription = _make_transcription(" Oh", " damn,", " that", " hurt.")
+  transcript, count = filter_transcription(transcription, FilterSet(['damn.*', r'\bhurt\b']), "***")
+  assert count == 2
+  assert [transcript.word_text(i) for i in range(len(transcript))] == [" Oh", " ***", " that", " ***."]
+
+def test_fuzzy_matches_misspellings():
+  filters = FilterSet([r'\bshit\b', r'\bfuck\b'])
+  for word in ["phuck", "fuk", "Fuck!", "shitt", "shits"]:
+    assert filters.find_fuzzy_match(word) is not None, word
+
+def test_fuzzy_doesnt_match_other_words():
+  filters = FilterSet([r'\bshit\b', r'\bfuck\b'])
+  for word in ["she", "shot", "shut", "sit", "sheet", "fake", "folk", "luck", "fork", "hit", "ship", "shid"]:
+    assert filters.find_fuzzy_match(word) is None, word
+
+def test_fuzzy_segments_dont_repeat_exact_matches():
+  transcription = _make_transcription(" Oh", " shit,", " that", " shitt.")
+  segments = find_time_segments_to_filter(transcription, FilterSet([r'\bshit\b']), fuzzy=True)
+  assert segments == [TimeSegment(1.0, 1.5), TimeSegment(3.0, 3.5)]
+
+def test_regexes_are_combined():
+  patterns = ['da+mn', '(?:heck|hell)o?', r'(\w)\1{2}', '(?x) cr a p  # verbose', '(?s)^ b.*h$']
+  filters = FilterSet(patterns)
+  assert len(filters._word_regexes) == 4 # One per set of global flags, plus the pattern with a backreference
+  for text, pattern in [(" daaamn", 'da+mn'), (" hello", '(?:heck|hell)o?'), (" zzz", r'(\w)\1{2}'), (" crap", '(?x) cr a p  # verbose'),
+                        (" blah", '(?s)^ b.*h$'), (" fine", None)]:
+    assert filters.find_match(text) == pattern, text
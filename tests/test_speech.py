@@ -0,0 +1,54 @@
+from audio import plan_mute_segments
+from filters import TimeSegment
+from speech import SpeechTimeline
+from transcript import Segment, Word
+import numpy as np, random
+
+_SAMPLING_RATE = 16000
+
+def _make_speech_map(region_count: int, seed: int = 0) -> list[tuple[float, float]]:
+  """Makes a speech map like the VAD's, with regions at arbitrary sample positions."""
+  rng = random.Random(seed)
+  speech_map = []
+  position = 0
+  for _ in range(region_count):
+    start = position + rng.randrange(1, 5 * _SAMPLING_RATE)
+    end = start + rng.randrange(1, 10 * _SAMPLING_RATE)
+    speech_map.append((start / _SAMPLING_RATE, end / _SAMPLING_RATE))
+    position = end
+  return speech_map
+
+def test_long_speech_map_restores_word_times():
+  # About 12 hours of audio in thousands of regions
+  speech_map = _make_speech_map(5000)
+  timeline = SpeechTimeline(speech_map)
+  rng = random.Random(1)
+  joined_start = 0
+  words = []
+  expected = []
+  for start, end in speech_map:
+    start_sample, end_sample = round(start * _SAMPLING_RATE), round(end * _SAMPLING_RATE)
+    # A word in the middle of each region, at a time in the joined speech
+    offset = rng.randrange(0, end_sample - start_sample)
+    words.append(Word((joined_start + offset) / _SAMPLING_RATE, (joined_start + offset) / _SAMPLING_RATE, " word", 1.0))
+    expected.append((start_sample + offset) / _SAMPLING_RATE)
+    joined_start += end_sample - start_sample
+  segment = Segment(1, 0, words[0].start, words[-1].end, "", [], 0.0, 0.0, 1.0, 0.0, words)
+  restored = timeline.restore_segment(segment)
+  assert [w.start for w in restored.words] == expected
+  assert [w.end for w in restored.words] == expected
+
+def test_collected_samples_line_up_with_restored_times():
+  speech_map = _make_speech_map(500)
+  sample_count = round(speech_map[-1][1] * _SAMPLING_RATE)
+  audio = np.arange(sample_count, dtype=np.int32) # Each sample holds its own position
+  start_sample = sample_count // 3
+  timeline = SpeechTimeline(speech_map, start_sample)
+  joined = timeline.collect(audio[start_sample:])
+  for i in random.Random(2).sample(range(len(joined)), 1000):
+    assert round(timeline.to_original_time(i / _SAMPLING_RATE) * _SAMPLING_RATE) + start_sample == joined[i]
+
+def test_mute_segments_are_clipped_to_speech():
+  speech_map = [(1.0, 2.0), (2.5, 4.0), (10.0, 11.0)]
+  segments = plan_mute_segments([TimeSegment(1.9, 2.6), TimeSegment(10.5, 10.6), TimeSegment(6.0, 7.0)], (100, 100), speech_map)
+  assert [(round(s.start, 6), round(s.end, 6)) for s in segments] == [(1.8, 2.0), (2.5, 2.7), (10.4, 10.7)]
@@ -0,0 +1,175 @@
+from transcript import Segment, Word
+from strong_typing import serialization
+import transcription_cache
+import json, os, pytest, threading, time
+
+needs_fcntl = pytest.mark.skipif(transcription_cache.fcntl is None, reason="File locking isn't available")
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+  monkeypatch.setattr(transcription_cache, "_cache_dir", str(tmp_path / "cache"))
+  monkeypatch.setattr(transcription_cache, "_max_size_bytes", None)
+  return tmp_path / "cache"
+
+def _make_input(tmp_path, name: str, contents: bytes) -> str:
+  path = tmp_path / name
+  path.write_bytes(contents)
+  return str(path)
+
+def _is_indexed(path: str) -> bool:
+  return transcription_cache._get_indexed_digest(path, False) is not None
+
+def test_digest_index_is_dropped_with_evicted_entries(tmp_path, cache_dir):
+  old_input = _make_input(tmp_path, "old.wav", b"old")
+  new_input = _make_input(tmp_path, "new.wav", b"new")
+  old_key = transcription_cache.get_cache_key(old_input, dict(model="tiny"))
+  transcription_cache.cache_transcription(old_key, [])
+  os.utime(cache_dir / f"{old_key[0]}.bin", (1, 1))
+  new_key = transcription_cache.get_cache_key(new_input, dict(model="tiny"))
+  transcription_cache.cache_transcription(new_key, [])
+  assert _is_indexed(old_input)
+
+  transcription_cache._evict_entries(0, str(cache_dir / f"{new_key[0]}.bin"))
+  assert not _is_indexed(old_input)
+  assert _is_indexed(new_input)
+  assert not transcription_cache.is_probably_cached(old_input, dict(model="tiny"))
+  # The new file's entries (by path and by content sample) and the list of entries with its digest
+  assert len(os.listdir(cache_dir / "hash_index")) == 3
+
+def test_digest_index_ignores_changed_files(tmp_path, cache_dir):
+  path = _make_input(tmp_path, "input.wav", b"before")
+  before = transcription_cache.get_file_digest(path)
+  with open(path, 'ab') as file:
+    file.write(b" and after")
+  assert not _is_indexed(path)
+  assert transcription_cache.get_file_digest(path) != before
+
+def test_probably_cached_when_moved_to_another_path(tmp_path, cache_dir):
+  settings = dict(model="tiny")
+  path = _make_input(tmp_path, "input.wav", b"contents")
+  assert not transcription_cache.is_probably_cached(path, settings)
+  transcription_cache.cache_transcription(transcription_cache.get_cache_key(path, settings), [])
+  assert transcription_cache.is_probably_cached(path, settings)
+  assert not transcription_cache.is_probably_cached(path, dict(model="base"))
+
+  # e.g., the same file on another machine that shares the cache directory
+  moved = _make_input(tmp_path, "moved.wav", b"contents")
+  assert not _is_indexed(moved)
+  assert transcription_cache.is_probably_cached(moved, settings)
+
+def test_chunks_are_saved_without_evicting(cache_dir, monkeypatch, capsys):
+  monkeypatch.setattr(transcription_cache, "_max_size_bytes", 0)
+  keys = [transcription_cache.get_chunk_cache_key(bytes([i]), dict(model="tiny")) for i in range(3)]
+  for key in keys:
+    transcription_cache.cache_chunk_transcription(key, [])
+  assert all(len(transcription_cache.get_cached_transcription(key)) == 0 for key in keys)
+  assert capsys.readouterr().out == ""
+
+  transcription_cache.trim()
+  assert all(transcription_cache.get_cached_transcription(key) is None for key in keys)
+
+@needs_fcntl
+def test_lock_file_is_deleted_on_release(cache_dir):
+  key = transcription_cache.get_chunk_cache_key(b"audio", dict(model="tiny"))
+  with transcription_cache.lock_entry(key) as waited:
+    assert not waited
+    assert os.path.exists(cache_dir / f"{key[0]}.bin.lock")
+  assert not os.path.exists(cache_dir / f"{key[0]}.bin.lock")
+
+@needs_fcntl
+def test_lock_is_exclusive_although_lock_files_are_deleted(cache_dir):
+  key = transcription_cache.get_chunk_cache_key(b"audio", dict(model="tiny"))
+  holders = []
+  overlaps = []
+  def hold():
+    for _ in range(20):
+      with transcription_cache.lock_entry(key):
+        holders.append(1)
+        if len(holders) > 1:
+          overlaps.append(1)
+        time.sleep(0.001)
+        holders.pop()
+  threads = [threading.Thread(target=hold) for _ in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert len(overlaps) == 0
+  assert not os.path.exists(cache_dir / f"{key[0]}.bin.lock")
+
+def test_eviction_removes_least_recently_used_first(cache_dir):
+  keys = [transcription_cache.get_chunk_cache_key(bytes([i]), dict(model="tiny")) for i in range(4)]
+  for i, key in enumerate(keys):
+    transcription_cache.cache_chunk_transcription(key, [])
+    os.utime(cache_dir / f"{key[0]}.bin", (i + 1, i + 1))
+  assert transcription_cache.get_cached_transcription(keys[0]) is not None # Reading an entry makes it the most recently used
+
+  entry_size = os.path.getsize(cache_dir / f"{keys[0][0]}.bin")
+  transcription_cache._evict_entries(2 * entry_size, None)
+  assert [transcription_cache.get_cached_transcription(key) is not None for key in keys] == [True, False, False, True]
+
+@needs_fcntl
+def test_eviction_counts_partial_transcriptions_unless_they_are_running(cache_dir):
+  running_key = transcription_cache.get_chunk_cache_key(b"running", dict(model="tiny"))
+  abandoned_key = transcription_cache.get_chunk_cache_key(b"abandoned", dict(model="tiny"))
+  transcription_cache.PartialTranscription(abandoned_key).close()
+  with transcription_cache.lock_entry(running_key):
+    transcription_cache.PartialTranscription(running_key).close()
+    transcription_cache._evict_entries(0, None)
+    assert os.path.exists(cache_dir / f"{running_key[0]}.partial")
+    assert not os.path.exists(cache_dir / f"{abandoned_key[0]}.partial")
+
+@needs_fcntl
+def test_stale_partial_transcriptions_are_deleted(cache_dir):
+  key = transcription_cache.get_chunk_cache_key(b"audio", dict(model="tiny"))
+  transcription_cache.PartialTranscription(key).close()
+  transcription_cache.trim()
+  assert os.path.exists(cache_dir / f"{key[0]}.partial")
+  os.utime(cache_dir / f"{key[0]}.partial", (1, 1))
+  transcription_cache.trim()
+  assert not os.path.exists(cache_dir / f"{key[0]}.partial")
+
+def test_json_entries_are_migrated_to_the_binary_format(cache_dir):
+  key = transcription_cache.get_chunk_cache_key(b"audio", dict(model="tiny"))
+  segments = [Segment(1, 0, 0.0, 1.0, " Hello", [50364, 2425], 0.0, -0.2, 1.1, 0.01, [Word(0.0, 1.0, " Hello", 0.9)])]
+  os.makedirs(cache_dir)
+  with open(cache_dir / f"{key[0]}.json", 'w') as file:
+    json.dump(dict(key=key[1], segments=serialization.object_to_json(segments)), file)
+
+  assert list(transcription_cache.get_cached_transcription(key)) == segments
+  assert not os.path.exists(cache_dir / f"{key[0]}.json")
+  assert os.path.exists(cache_dir / f"{key[0]}.bin")
+  assert list(transcription_cache.get_cached_transcription(key)) == segments
+
+def _make_segment(i: int) -> Segment:
+  return Segment(i, 0, float(i), float(i + 1), f" Segment {i}", [i], 0.0, -0.2, 1.1, 0.01, None)
+
+def test_partial_transcription_resumes_after_the_last_complete_segment(cache_dir):
+  key = transcription_cache.get_chunk_cache_key(b"audio", dict(model="tiny"))
+  partial = transcription_cache.PartialTranscription(key)
+  for i in range(1, 4):
+    partial.append(_make_segment(i))
+  partial.close()
+  # An interrupted write leaves a torn last line
+  with open(cache_dir / f"{key[0]}.partial", 'a') as file:
+    file.write('{"id": 4, "seek": 0, "sta')
+
+  partial = transcription_cache.PartialTranscription(key)
+  assert partial.segment_count == 3
+  assert partial.resume_time == 4.0
+  partial.append(_make_segment(4))
+  assert partial.load_segments() == [_make_segment(i) for i in range(1, 5)]
+  partial.remove()
+  assert not os.path.exists(cache_dir / f"{key[0]}.partial")
+
+def test_partial_transcription_of_other_settings_starts_over(cache_dir):
+  key = transcription_cache.get_chunk_cache_key(b"audio", dict(model="tiny"))
+  partial = transcription_cache.PartialTranscription(key)
+  partial.append(_make_segment(1))
+  partial.close()
+
+  assert transcription_cache.PartialTranscription(key, resume=False).segment_count == 0
+  partial = transcription_cache.PartialTranscription((key[0], dict(key[1], settings=dict(model="base"))))
+  assert partial.segment_count == 0
+  assert partial.load_segments() == []
+  partial.close()